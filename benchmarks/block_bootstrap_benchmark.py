@@ -0,0 +1,192 @@
+# Benchmark of raw_data_analysis/block_bootstrap.py against the bootstrap loop of bootstrap_analysis.ipynb
+#
+# Runs the notebook loop (kept here as the reference, for the arrays block_bootstrap.py computes) and
+# notebook_statistics() on a synthetic article table with the columns of self_citation_data.xlsx, including
+# 'Error' and missing genders and 'Error' topics, and reports the time of both and whether all arrays are equal.
+#
+# Usage (from the repository root):
+#   python benchmarks/block_bootstrap_benchmark.py --nboot 20
+#   python benchmarks/block_bootstrap_benchmark.py --xlsx raw_data_analysis/self_citation_data.xlsx --nboot 10
+#
+# Requirements:
+#   numpy, pandas, scipy
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats import linregress
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'raw_data_analysis'))
+from block_bootstrap import BlockBootstrap, notebook_statistics
+
+recent_years = [2016, 2017, 2018, 2019, 2020]
+
+
+def synthetic_articles(narticles, nblocks, seed=0):
+    # one row per article and SC Type, like self_citation_data.xlsx; about 15% of genders are missing and 5% 'Error'
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'eb': rng.integers(0, nblocks, narticles),
+        'Year': rng.integers(2000, 2021, narticles),
+        'field': rng.choice(['Neurology', 'Neuroscience', 'Psychiatry'], narticles),
+        'SC Type': rng.choice(['FA', 'LA', 'Any'], narticles),
+        'numref': rng.integers(10, 80, narticles),
+        'numpapers': 1,
+        'ac_age': rng.integers(0, 39, narticles),
+        'papers_before_by_date': rng.integers(1, 300, narticles),
+        'topic': [t if t < 13 else 'Error' for t in rng.integers(0, 14, narticles)],
+        'affil_country': rng.choice(['United States', 'Germany', 'China', 'Error'], narticles),
+        'gender_binary': rng.choice(np.array(['Female', 'Male', 'Error', None], dtype=object), narticles,
+                                    p=[0.35, 0.45, 0.05, 0.15]),
+    })
+    df['sc_count'] = rng.binomial(df['numref'], 0.05)
+    return df
+
+
+def notebook_loop(df, nboot, num_topics, ac_age_to_keep, fa_countries_to_keep, la_countries_to_keep):
+    # the notebook's main bootstrap loop, only the arrays of block_bootstrap.notebook_statistics
+    nyears = df['Year'].nunique()
+    results = {name: np.zeros((nboot, 4)) for name in ['fa_recent_sc', 'la_recent_sc', 'any_recent_sc']}
+    results.update({'r_boot': np.zeros((nboot, 3)), 'm_boot': np.zeros((nboot, 3)), 'sc_rates': np.zeros((nboot, nyears, 3)),
+                    'perc_female_fa_la_topic': np.zeros((nboot, num_topics, 2))})
+    for name in ['fa_ac_age_sc', 'la_ac_age_sc', 'fa_ac_age_sc_normed', 'la_ac_age_sc_normed',
+                 'ac_age_gender_sc_female', 'ac_age_gender_sc_male']:
+        results[name] = np.zeros((nboot, len(ac_age_to_keep)))
+    for name in ['topic_fa_sc', 'topic_la_sc', 'topic_any_sc', 'topic_gender_sc_fa_female', 'topic_gender_sc_la_female',
+                 'topic_gender_sc_fa_male', 'topic_gender_sc_la_male']:
+        results[name] = np.zeros((nboot, num_topics))
+    for name in ['time_gender_sc_fa_female', 'time_gender_sc_la_female', 'time_gender_sc_fa_male', 'time_gender_sc_la_male',
+                 'time_gender_proportion_fa_female', 'time_gender_proportion_fa_male',
+                 'time_gender_proportion_la_female', 'time_gender_proportion_la_male']:
+        results[name] = np.zeros((nboot, nyears))
+    for prefix, countries in [('fa', fa_countries_to_keep), ('la', la_countries_to_keep)]:
+        results[prefix + '_sc_rate_country'] = np.zeros((nboot, len(countries)))
+        results[prefix + '_numpapers_country'] = np.zeros((nboot, len(countries)))
+
+    for seed in range(nboot):
+        np.random.seed(seed)
+        eb_boot = np.random.choice(df['eb'].unique(), size=len(df['eb'].unique()), replace=True)
+        df_boot = df[df['eb'].isin(eb_boot)].reset_index(drop=True)
+
+        # descriptive stats
+        fields = ['Neurology', 'Neuroscience', 'Psychiatry']
+        df_recent = df_boot[(df_boot.Year.isin(recent_years)) & (df_boot['field'].isin(fields))]
+        s = df_recent.groupby(['field', 'SC Type'], as_index=False).agg({'sc_count': 'sum', 'numref': 'sum'})
+        s['sc_rate'] = s['sc_count'] / s['numref']
+        for auth_type, name in zip(['FA', 'LA', 'Any'], ['fa_recent_sc', 'la_recent_sc', 'any_recent_sc']):
+            results[name][seed, 0] = s[s['SC Type']==auth_type]['sc_count'].sum() / s[s['SC Type']==auth_type]['numref'].sum()
+            for i, field in enumerate(fields):
+                results[name][seed, i+1] = s[(s.field==field) & (s['SC Type']==auth_type)]['sc_rate'].iloc[0]
+
+        # over time
+        s = df_boot.groupby(["Year", "SC Type"]).agg({"numref": "sum", "sc_count": "sum"})
+        s['sc_rate'] = s['sc_count'] / s['numref']
+        s = s.sort_values('Year').reset_index()
+        for auth_idx, auth_type in enumerate(['FA', 'LA', 'Any']):
+            df_tmp = s[s['SC Type']==auth_type]
+            results['sc_rates'][seed, :, auth_idx] = df_tmp['sc_rate']
+            results['r_boot'][seed, auth_idx] = df_tmp['sc_rate'].corr(df_tmp['Year'])
+            results['m_boot'][seed, auth_idx] = linregress(df_tmp['Year'], df_tmp['sc_rate']).slope
+
+        # academic age
+        df_ac_age = df_boot[(df_boot.Year.isin(recent_years)) & (df_boot.ac_age.isin(ac_age_to_keep))]
+        s = df_ac_age.groupby(['SC Type', 'ac_age']).agg({"numref": "sum", "sc_count": "sum", "numpapers": "sum",
+                                                          "papers_before_by_date": "sum"})
+        s = s.sort_values('ac_age').reset_index()
+        s['sc_rate'] = s['sc_count'] / s['numref']
+        s['sc_count_normed'] = s['sc_count'] / s['papers_before_by_date']
+        for auth_type, prefix in [('FA', 'fa'), ('LA', 'la')]:
+            results[prefix + '_ac_age_sc'][seed] = s[s['SC Type']==auth_type]['sc_rate']
+            results[prefix + '_ac_age_sc_normed'][seed] = s[s['SC Type']==auth_type]['sc_count_normed']
+
+        # topics
+        df_topics = df_boot[df_boot['Year'].isin(recent_years)].reset_index(drop=True)
+        df_topics = df_topics[df_topics['topic']!='Error']
+        s = df_topics.groupby(["topic", "SC Type"]).agg({"numref": "sum", "sc_count": "sum"}).reset_index()
+        s['sc_rate'] = s['sc_count'] / s['numref']
+        s['topic'] = [int(t) for t in s.topic]
+        s = s.sort_values('topic')
+        for auth_type, name in zip(['FA', 'LA', 'Any'], ['topic_fa_sc', 'topic_la_sc', 'topic_any_sc']):
+            results[name][seed] = s[s['SC Type']==auth_type]['sc_rate']
+
+        # gender over time
+        df1 = df_boot.groupby(["SC Type", "Year"]).agg({"numpapers": "sum"}).reset_index()
+        df2 = df_boot.groupby(["SC Type", "gender_binary", "Year"]).agg({"numpapers": "sum", "numref": "sum", "sc_count": "sum"}).reset_index()
+        df2 = df2[df2['gender_binary']!='Error']
+        s = df1.merge(df2, left_on=["SC Type", "Year"], right_on=["SC Type", "Year"])
+        s = s.rename(columns={"numpapers_x": "total_papers", "numpapers_y": "gender_papers"}, errors="raise")
+        s['perc_gender'] = s['gender_papers'] / s['total_papers']
+        s['sc_rate'] = s['sc_count'] / s['numref']
+        s = s.sort_values(by='Year')
+        for auth_type in ['FA', 'LA']:
+            for gender in ['Female', 'Male']:
+                t = s[(s['SC Type']==auth_type) & (s['gender_binary']==gender)]
+                results['time_gender_proportion_{:s}_{:s}'.format(auth_type.lower(), gender.lower())][seed] = t['perc_gender']
+                results['time_gender_sc_{:s}_{:s}'.format(auth_type.lower(), gender.lower())][seed] = t['sc_rate']
+
+        # gender by topic
+        df_topics = df_topics[df_topics.gender_binary!='Error']
+        df1 = df_topics.groupby(["SC Type", "topic"]).agg({"numpapers": "sum"}).reset_index()
+        df2 = df_topics.groupby(["SC Type", "topic", "gender_binary"]).agg({"numpapers": "sum", "numref": "sum", "sc_count": "sum"}).reset_index()
+        s = df1.merge(df2, left_on=["SC Type", "topic"], right_on=["SC Type", "topic"])
+        s = s.rename(columns={"numpapers_x": "total_papers", "numpapers_y": "gender_papers"}, errors="raise")
+        s['perc_gender'] = s['gender_papers'] / s['total_papers']
+        s['sc_rate'] = s['sc_count'] / s['numref']
+        s = s.sort_values(by=['topic'])
+        for auth_idx, auth_type in enumerate(['FA', 'LA']):
+            results['perc_female_fa_la_topic'][seed, :, auth_idx] = s[(s['SC Type']==auth_type) & (s['gender_binary']=='Female')]['perc_gender']
+            for gender in ['Female', 'Male']:
+                t = s[(s['SC Type']==auth_type) & (s['gender_binary']==gender)]
+                results['topic_gender_sc_{:s}_{:s}'.format(auth_type.lower(), gender.lower())][seed] = t['sc_rate']
+
+        # gender by academic age
+        df_boot_gender = df_boot[df_boot.gender_binary!='Error']
+        df_tmp = df_boot_gender[df_boot_gender.Year.isin(recent_years) & df_boot_gender.ac_age.isin(ac_age_to_keep)]
+        s = df_tmp.groupby(['ac_age', 'gender_binary'], as_index=False).agg({'sc_count': 'sum', 'numref': 'sum'})
+        s['sc_rate'] = s['sc_count'] / s['numref']
+        results['ac_age_gender_sc_female'][seed] = s[s.gender_binary=='Female']['sc_rate']
+        results['ac_age_gender_sc_male'][seed] = s[s.gender_binary=='Male']['sc_rate']
+
+        # countries (DataFrame.append in the notebook)
+        df_countries = pd.concat([df_boot[(df_boot.affil_country.isin(fa_countries_to_keep)) & (df_boot['SC Type']=='FA')],
+                                  df_boot[(df_boot.affil_country.isin(la_countries_to_keep)) & (df_boot['SC Type']=='LA')]])
+        s = df_countries.groupby(['SC Type', 'affil_country'], as_index=False).agg({'numref': 'sum', 'sc_count': 'sum', 'numpapers': 'sum'})
+        s['sum_perc'] = s['sc_count'] / s['numref']
+        s = s.sort_values(by=['affil_country'], ascending=True)
+        for auth_type, prefix in [('FA', 'fa'), ('LA', 'la')]:
+            results[prefix + '_sc_rate_country'][seed] = s[s['SC Type']==auth_type].sum_perc
+            results[prefix + '_numpapers_country'][seed] = s[s['SC Type']==auth_type].numpapers
+    return results
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--xlsx", type=str, default=None, help="self_citation_data.xlsx (default: synthetic table)")
+parser.add_argument("--narticles", type=int, default=30000, help="rows of the synthetic table")
+parser.add_argument("--nblocks", type=int, default=2000, help="exchangeability blocks of the synthetic table")
+parser.add_argument("--nboot", type=int, default=20, help="bootstrap replicates")
+args = parser.parse_args()
+
+if args.xlsx is not None:
+    df = pd.read_excel(args.xlsx)
+    print(args.xlsx + ': {:d} rows'.format(len(df)))
+else:
+    df = synthetic_articles(args.narticles, args.nblocks)
+    print('Synthetic table: {:d} rows, {:d} missing genders'.format(len(df), int(df['gender_binary'].isna().sum())))
+num_topics, ac_age_to_keep = 13, np.arange(0, 39)
+
+start = time.perf_counter()
+fast = notebook_statistics(BlockBootstrap(df), seeds=range(args.nboot), num_topics=num_topics, ac_age_to_keep=ac_age_to_keep)
+time_fast = time.perf_counter() - start
+
+start = time.perf_counter()
+reference = notebook_loop(df, args.nboot, num_topics, ac_age_to_keep, fast['fa_countries_to_keep'], fast['la_countries_to_keep'])
+time_reference = time.perf_counter() - start
+
+different = [name for name, values in reference.items()
+             if fast[name].shape != values.shape or not np.allclose(fast[name], values, equal_nan=True)]
+print('notebook loop:      {:.3f} s'.format(time_reference))
+print('notebook_statistics: {:.3f} s ({:.1f}x faster)'.format(time_fast, time_reference / time_fast))
+print('identical output: ' + str(len(different) == 0) + ('' if len(different) == 0 else ' (differs: ' + ', '.join(different) + ')'))
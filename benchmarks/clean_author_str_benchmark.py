@@ -0,0 +1,101 @@
+# Benchmark of util_functions.clean_author_column and the memoized clean_author_str against the original clean_author_str
+#
+# Usage (from the repository root):
+#   python benchmarks/clean_author_str_benchmark.py --csv ../Neuro/Neuron/Neuron2020_ref.csv
+#   python benchmarks/clean_author_str_benchmark.py --narticles 50000   (synthetic Authors column)
+
+import argparse
+import os
+import random
+import sys
+import time
+import unidecode
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'raw_data_analysis'))
+from util_functions import clean_author_str, clean_author_column, clean_author_entry
+
+
+def clean_author_str_original(authors):
+    # clean_author_str before it was memoized, kept here as the reference
+
+    if isinstance(authors, str):
+        author_list = authors.split('.,')
+    elif isinstance(authors, list):
+        author_list = authors
+
+    author_list = [unidecode.unidecode(author_entry).replace('-', ' ') for author_entry in author_list]
+
+    # deal with II, III, IV
+    for author_index, authname in enumerate(author_list):
+      if len(authname.split(' '))>2:
+        author_list[author_index] = authname.replace(' III,', ',').replace(' IV,', ',').replace(' II,', ',')
+
+    author_list = [author_list_entry.strip() + '.' for author_list_entry in author_list]  # add in period after initial
+
+    if isinstance(authors, str):  # only if Surname, Initial format
+        author_list[-1]=author_list[-1][:-1]  # remove extra period from final author
+
+    # remove consortia
+    author_list = [s for s in author_list if "consortium" not in s.lower()
+      and "initiative" not in s.lower() and "investigators" not in s.lower()
+      and "group" not in s.lower() and "network" not in s.lower()
+      and "center" not in s.lower() and "psych" not in s.lower()
+      and "GEMRIC" not in s and 'Million Veteran Program' not in s
+      and 'Pediatric Imaging' not in s and 'Neurocognition' not in s
+      and 'schizophrenia' not in s.lower() and 'research team' not in s.lower()
+      and 'ADNI and PPMI' not in s and 'Council' not in s
+      and 'Collaborator' not in s and 'DDD study' not in s
+      and 'NBB-Psy' not in s and 'VA Cooperative Studies Program Study Team' not in s
+      and 'Collaborative Members' not in s and 'University' not in s
+      and 'Imaging' not in s and 'Biomarkers' not in s]
+
+    # get first initial only
+    author_list = [article_author_entry[:article_author_entry.find('.')] for article_author_entry in author_list]
+
+    return author_list
+
+
+def synthetic_authors(narticles, nnames=20000, seed=0):
+    # Authors column with Scopus formatting ("Surname I., Surname I.J.") and a heavy-tailed name frequency
+    rng = random.Random(seed)
+    surnames = ['Smith', 'Li', 'Müller', 'García-López', 'Nguyen', 'Kim', 'Rossi', 'Johnson III,', "O'Brien", 'Wang']
+    names = [rng.choice(surnames) + str(i) + ' ' + rng.choice('ABCDEFGHJKLMNPRSTW') + '.' for i in range(nnames)]
+    names += ['Alzheimer\'s Disease Neuroimaging Initiative', 'ENIGMA Consortium']
+    weights = [1 / (i + 1) for i in range(len(names))]
+    return [', '.join(rng.choices(names, weights=weights, k=rng.randint(1, 15))) for _ in range(narticles)]
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--csv", type=str, default=None, help="journal-year csv (or _ref.csv) with an Authors column")
+parser.add_argument("--narticles", type=int, default=50000, help="number of synthetic entries if no csv is given")
+args = parser.parse_args()
+
+if args.csv is not None:
+    import pandas as pd
+    authors = list(pd.read_csv(args.csv)['Authors'].astype(str))
+    print('Authors column of ' + args.csv + ': {:d} entries'.format(len(authors)))
+else:
+    authors = synthetic_authors(args.narticles)
+    print('Synthetic Authors column: {:d} entries'.format(len(authors)))
+
+start = time.perf_counter()
+original = [clean_author_str_original(author_str) for author_str in authors]
+time_original = time.perf_counter() - start
+
+clean_author_entry.cache_clear()
+start = time.perf_counter()
+memoized = [clean_author_str(author_str) for author_str in authors]
+time_memoized = time.perf_counter() - start
+cache_info = clean_author_entry.cache_info()
+
+clean_author_entry.cache_clear()
+start = time.perf_counter()
+column = clean_author_column(authors)
+time_column = time.perf_counter() - start
+distinct = clean_author_entry.cache_info().misses
+
+print('original clean_author_str:  {:.3f} s'.format(time_original))
+print('memoized clean_author_str:  {:.3f} s ({:.1f}x faster, name cache hit rate {:.1%})'.format(
+    time_memoized, time_original / time_memoized, cache_info.hits / max(1, cache_info.hits + cache_info.misses)))
+print('clean_author_column:        {:.3f} s ({:.1f}x faster, {:d} distinct names cleaned)'.format(
+    time_column, time_original / time_column, distinct))
+print('identical output: ' + str(original == memoized == column))
@@ -0,0 +1,213 @@
+# End-to-end benchmark of the download scripts against a synthetic corpus served by the local Scopus stand-in
+#
+# Writes a synthetic corpus (synthetic_corpus.py) in the layout the scripts read, serves its records with
+# scopus_tools.stand_in and runs each script twice: cold (empty record store and pybliometrics cache) and warm
+# (everything downloaded by the cold run). For every run it reports
+#   wall time, requests the stand-in received, records asked for and the share already in the store (hit rate),
+#   peak memory of the script and references processed per second
+# and appends the results, with the commit they were measured at, to benchmarks/results/pipeline_benchmark.jsonl,
+# printing the change against the last stored run with the same settings.
+#
+# Usage (from the repository root):
+#   python benchmarks/pipeline_benchmark.py --preset tiny
+#   python benchmarks/pipeline_benchmark.py --preset small --scripts sc_by_pair,self_citation_author --latency 0.05 --errors 404=0.01
+#
+# Requirements:
+#   everything the scripts need (pybliometrics, pandas, openpyxl, matplotlib, seaborn, ...); no API key or VPN
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from scopus_tools.stand_in import StandInServer, Faults, parse_errors
+from synthetic_corpus import SyntheticCorpus, PRESETS
+
+repo_path = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+results_file = os.path.join(repo_path, 'benchmarks', 'results', 'pipeline_benchmark.jsonl')
+# in pipeline order (get_auth_info.py reads the results of sc_journal.py)
+SCRIPTS = ['sc_journal', 'get_auth_info', 'sc_by_pair', 'self_citation_author']
+COMPARED = ['wall_s', 'requests', 'hit_rate', 'peak_rss_mb', 'refs_per_s']
+
+PYBLIOMETRICS_CONFIG = '''[Directories]
+AbstractRetrieval = {cache}/abstract_retrieval
+AffiliationRetrieval = {cache}/affiliation_retrieval
+AuthorRetrieval = {cache}/author_retrieval
+ScopusSearch = {cache}/scopus_search
+
+[Authentication]
+APIKey = {keys}
+
+[Requests]
+Timeout = 20
+Retries = 2
+'''
+
+
+def script_command(script, corpus, workdir, author_id):
+    # (script path, arguments, folder to run in); sc_journal.py and get_auth_info.py use paths relative to ../
+    store, key_state = os.path.join(workdir, 'scopus_records.db'), os.path.join(workdir, 'key_quota.json')
+    run_dir = os.path.join(workdir, 'run')
+    if script == 'sc_journal':
+        return os.path.join(repo_path, 'raw_data_analysis', 'sc_journal.py'), [], run_dir
+    if script == 'get_auth_info':
+        return os.path.join(repo_path, 'raw_data_analysis', 'get_auth_info.py'), [], run_dir
+    if script == 'sc_by_pair':
+        return (os.path.join(repo_path, 'model_data_analysis', 'sc_by_pair.py'),
+                ['--field', ','.join(corpus.fields), '--years', ','.join(str(year) for year in corpus.years),
+                 '--base_path', workdir, '--store', store, '--key_state', key_state], run_dir)
+    return (os.path.join(repo_path, 'self_citation_author.py'),
+            ['--ID', str(author_id), '--make_plots', '0', '--store', store, '--key_state', key_state], run_dir)
+
+
+def script_work(script, corpus, author_id):
+    # (articles, references) each script processes
+    if script == 'self_citation_author':
+        eids = corpus.author_papers[author_id]
+        return len(eids), corpus.numref(eids)
+    eids = [eid for eids in corpus.journal_papers.values() for eid in eids]
+    return len(eids), (corpus.numref(eids) if script != 'get_auth_info' else 0)
+
+
+def clear_caches(workdir):
+    # everything a cold run must not find: record store, key quota, pybliometrics cache, reference author lists and EID indexes
+    for name in ('scopus_records.db', 'scopus_records.db-wal', 'scopus_records.db-shm', 'key_quota.json', 'key_quota.json.lock'):
+        if os.path.exists(os.path.join(workdir, name)):
+            os.remove(os.path.join(workdir, name))
+    shutil.rmtree(os.path.join(workdir, 'pybliometrics_cache'), ignore_errors=True)
+    if os.path.exists(os.path.join(workdir, 'run', 'reference_authors.db')):  # self_citation_author.py
+        os.remove(os.path.join(workdir, 'run', 'reference_authors.db'))
+    for root, dirs, files in os.walk(workdir):
+        for name in files:
+            if name.endswith('.eid_index.json'):
+                os.remove(os.path.join(root, name))
+
+
+def run_script(script, corpus, workdir, server, author_id, label, timeout):
+    path, script_args, run_dir = script_command(script, corpus, workdir, author_id)
+    shutil.rmtree(os.path.join(workdir, 'results_1_2024'), ignore_errors=True)  # sc_by_pair.py skips finished journal-years
+    os.makedirs(os.path.join(workdir, 'results_1_2024'), exist_ok=True)
+    stats_path = os.path.join(workdir, 'logs', script + '_' + label + '.json')
+    log_path = os.path.join(workdir, 'logs', script + '_' + label + '.log')
+    env = dict(os.environ, SCOPUS_STAND_IN=server.url, PYB_CONFIG_FILE=os.path.join(workdir, 'pybliometrics.cfg'),
+               MPLBACKEND='Agg')
+    requests_before = server.stats()['requests']
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        process = subprocess.run([sys.executable, os.path.join(repo_path, 'benchmarks', 'run_instrumented.py'),
+                                  '--stats', stats_path, path] + script_args,
+                                 cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT, timeout=timeout)
+    wall = time.perf_counter() - start
+    stats = {}
+    if os.path.exists(stats_path):
+        with open(stats_path) as f:
+            stats = json.load(f)
+    articles, references = script_work(script, corpus, author_id)
+    return {'exit_code': process.returncode, 'wall_s': round(wall, 3),
+            'requests': server.stats()['requests'] - requests_before,
+            'retrieve_calls': stats.get('retrieve_calls'), 'store_hits': stats.get('store_hits'),
+            'hit_rate': round(stats['store_hits'] / stats['retrieve_calls'], 4) if stats.get('retrieve_calls') else None,
+            'peak_rss_mb': stats.get('peak_rss_mb'), 'articles': articles, 'references': references,
+            'refs_per_s': round(references / wall, 1) if references else None,
+            'articles_per_s': round(articles / wall, 2), 'log': log_path}
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_path,
+                               capture_output=True, text=True).stdout.strip() != ''
+        return commit, dirty
+    except OSError:
+        return None, None
+
+
+def previous_entry(settings):
+    # last stored run with the same settings
+    if not os.path.exists(results_file):
+        return None
+    previous = None
+    with open(results_file) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['settings'] == settings:
+                previous = entry
+    return previous
+
+
+def print_results(entry, previous):
+    print('\n{:22s} {:5s} {:>5s} {:>9s} {:>9s} {:>8s} {:>10s} {:>10s}'.format(
+        'script', 'run', 'exit', 'wall (s)', 'requests', 'hit rate', 'peak MB', 'refs/s'))
+    for script, runs in entry['results'].items():
+        for label, result in runs.items():
+            print('{:22s} {:5s} {:5d} {:9.2f} {:9d} {:>8s} {:10.1f} {:>10s}'.format(
+                script, label, result['exit_code'], result['wall_s'], result['requests'],
+                '{:.3f}'.format(result['hit_rate']) if result['hit_rate'] is not None else '-',
+                result['peak_rss_mb'] or 0, '{:.1f}'.format(result['refs_per_s']) if result['refs_per_s'] else '-'))
+            if result['exit_code'] != 0:
+                print('    failed, see ' + result['log'])
+            old = (previous or {}).get('results', {}).get(script, {}).get(label)
+            if old is not None:
+                changes = ['{:s} {:+.1%}'.format(key, result[key] / old[key] - 1) for key in COMPARED
+                           if result.get(key) and old.get(key)]
+                print('    vs {:s}: {:s}'.format(previous['commit'] or '?', ', '.join(changes)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preset", type=str, default='tiny', choices=sorted(PRESETS), help="size of the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the corpus and of injected faults")
+    parser.add_argument("--scripts", type=str, default=','.join(SCRIPTS), help="comma separated scripts to run: " + ', '.join(SCRIPTS))
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the stand-in waits before each response")
+    parser.add_argument("--errors", type=str, default='', help="injected error responses, e.g. 404=0.01,500=0.005")
+    parser.add_argument("--malformed", type=float, default=0, help="share of responses with invalid JSON")
+    parser.add_argument("--author_docs", type=int, default=20, help="number of papers of the author run with self_citation_author.py")
+    parser.add_argument("--workdir", type=str, default=None, help="folder for the corpus and the runs (default: temporary folder)")
+    parser.add_argument("--timeout", type=int, default=3600, help="seconds allowed per script run")
+    parser.add_argument("--no_save", action='store_true', help="do not append the results to " + results_file)
+    args = parser.parse_args()
+
+    scripts = [script for script in SCRIPTS if script in args.scripts.split(',')]
+    if 'get_auth_info' in scripts and 'sc_journal' not in scripts:
+        parser.error('get_auth_info reads the results of sc_journal, run both')
+
+    corpus = SyntheticCorpus(**PRESETS[args.preset], seed=args.seed)
+    author_id = corpus.pick_author(args.author_docs)
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='sc_benchmark_')
+    for folder in ('run', os.path.join('run', 'results'), 'logs'):
+        os.makedirs(os.path.join(workdir, folder), exist_ok=True)
+    corpus.write_layout(workdir)
+    with open(os.path.join(workdir, 'pybliometrics.cfg'), 'w') as f:
+        f.write(PYBLIOMETRICS_CONFIG.format(cache=os.path.join(workdir, 'pybliometrics_cache'),
+                                            keys=','.join('benchmark_key_{:d}'.format(i) for i in range(10))))
+    print('Corpus: ' + str(corpus.summary()) + ', workdir: ' + workdir)
+
+    settings = {'preset': args.preset, 'seed': args.seed, 'latency': args.latency, 'errors': args.errors,
+                'malformed': args.malformed, 'author_docs': args.author_docs}
+    results = {}
+    with StandInServer(payloads=corpus, faults=Faults(args.latency, errors=parse_errors(args.errors),
+                                                      malformed=args.malformed, seed=args.seed)) as server:
+        for script in scripts:
+            results[script] = {}
+            clear_caches(workdir)
+            for label in ('cold', 'warm'):
+                print('Running {:s} ({:s})'.format(script, label))
+                results[script][label] = run_script(script, corpus, workdir, server, author_id, label, args.timeout)
+
+    commit, dirty = git_commit()
+    entry = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'dirty': dirty,
+             'python': platform.python_version(), 'machine': platform.node(), 'settings': settings,
+             'corpus': corpus.summary(), 'results': results}
+    print_results(entry, previous_entry(settings))
+    if not args.no_save:
+        os.makedirs(os.path.dirname(results_file), exist_ok=True)
+        with open(results_file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        print('Saved to ' + results_file)
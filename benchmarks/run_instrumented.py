@@ -0,0 +1,53 @@
+# Run one of the scripts with counters around RecordStore.retrieve (used by pipeline_benchmark.py)
+#
+# Counts how many records the script asks for and how many of them were already in the store, and writes them
+# together with the peak memory of the process to a JSON file when the script ends:
+#   python benchmarks/run_instrumented.py --stats stats.json -- model_data_analysis/sc_by_pair.py --field Neuro ...
+
+import argparse
+import atexit
+import json
+import os
+import resource
+import runpy
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from scopus_tools.record_store import RecordStore, DEFAULT_VIEWS
+
+counts = {'retrieve_calls': 0, 'store_hits': 0}
+_lock = threading.Lock()
+_retrieve = RecordStore.retrieve
+
+
+def counted_retrieve(self, cls, identifier, refresh=False, view=None, **kwds):
+    stored = self.known(cls.__name__, identifier, view if view is not None else DEFAULT_VIEWS.get(cls.__name__, ''), refresh)
+    with _lock:
+        counts['retrieve_calls'] += 1
+        counts['store_hits'] += int(stored)
+    return _retrieve(self, cls, identifier, refresh=refresh, view=view, **kwds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stats", type=str, required=True, help="JSON file to write the counts to")
+    parser.add_argument("script", type=str)
+    parser.add_argument("script_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    def write_stats():
+        stats = dict(counts, seconds=time.perf_counter() - start,
+                     peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3)  # ru_maxrss is in kB on Linux
+        with open(args.stats, 'w') as f:
+            json.dump(stats, f)
+
+    atexit.register(write_stats)
+    RecordStore.retrieve = counted_retrieve
+    script = os.path.abspath(args.script)
+    sys.argv = [script] + [arg for arg in args.script_args if arg != '--']
+    sys.path.insert(0, os.path.dirname(script))  # as if the script was run directly
+    runpy.run_path(script, run_name='__main__')
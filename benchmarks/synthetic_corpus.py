@@ -0,0 +1,268 @@
+# Synthetic Scopus corpus for benchmarking the download scripts offline
+#
+# Generates journals, years, papers, authors and references with roughly realistic structure:
+#   - author productivity is heavy-tailed (Pareto), so a few authors have many papers and most have few
+#   - authors work in groups (labs) with a senior last author, and papers mostly draw co-authors from one group
+#   - papers cite 30-100 earlier papers, preferring popular papers and (sometimes) earlier papers of their own group,
+#     and a few references are not in Scopus (404)
+# The corpus is written in the layout the scripts read (All_<field>/<journal>/<journal><year>.csv and _ref.csv)
+# and serves the matching API payloads through scopus_tools.stand_in (it has the get/search methods of a source):
+#
+#   corpus = SyntheticCorpus(**PRESETS['tiny'])
+#   corpus.write_layout('/tmp/bench')
+#   server = StandInServer(payloads=corpus).start()
+#
+# Usage (from the repository root), to write a corpus and its payloads for the stand-in server:
+#   python benchmarks/synthetic_corpus.py --preset small --out /tmp/bench --payload_store /tmp/bench/payloads.db
+
+import argparse
+import json
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from scopus_tools.stand_in import abstract_payload, author_payload, affiliation_payload, search_entry
+
+# journal-years of the corpus and its size, from a quick check to a run that takes a while against the stand-in
+PRESETS = {
+    'tiny': {'fields': ('Neuro',), 'journals_per_field': 1, 'years': (2019, 2020), 'papers_per_year': 15},
+    'small': {'fields': ('Neuro', 'Neurology'), 'journals_per_field': 2, 'years': (2019, 2020), 'papers_per_year': 40},
+    'medium': {'fields': ('Neuro', 'Neurology', 'Psychiatry'), 'journals_per_field': 3, 'years': (2018, 2019, 2020),
+               'papers_per_year': 100},
+}
+# field folders sc_journal.py and get_auth_info.py look for
+ALL_FIELDS = ('Neuro', 'Neurology', 'Psychiatry')
+
+SYLLABLES = ['ka', 'ro', 'mi', 'sen', 'ta', 'lo', 'ber', 'na', 'vi', 'chen', 'dor', 'el', 'ma', 'ri', 'son', 'gu',
+             'wa', 'fen', 'to', 'ling', 'sch', 'ein', 'ost', 'ble', 'har', 'de', 'mo', 'kov', 'li', 'zu']
+COMMON_SURNAMES = ['Wang', 'Li', 'Zhang', 'Smith', 'Kim', 'Lee', 'Chen', 'Liu', 'Mueller', 'Garcia']
+GIVEN_NAMES = ['Anna', 'Ben', 'Carla', 'David', 'Elena', 'Feng', 'Grace', 'Hiro', 'Ines', 'Jonas', 'Kavya', 'Lucas',
+               'Maria', 'Noah', 'Olga', 'Pablo', 'Qing', 'Rosa', 'Sam', 'Tara', 'Uma', 'Victor', 'Wei', 'Yara', 'Zoe']
+MIDDLE_INITIALS = ['', '', '', 'J', 'M', 'K', 'S']
+COUNTRIES = ['United States', 'United Kingdom', 'Germany', 'China', 'Canada', 'Japan', 'France', 'Italy',
+             'Netherlands', 'Australia', 'Spain', 'Switzerland', 'Sweden', 'South Korea', 'Brazil']
+KEYWORDS = ['fMRI', 'connectivity', 'memory', 'dopamine', 'depression', 'schizophrenia', 'stroke', 'epilepsy',
+            'cortex', 'hippocampus', 'EEG', 'genetics', 'aging', 'attention', 'sleep', 'pain', 'autism', 'MRI']
+
+
+def initials(given_name):
+    return ''.join(part[0] + '.' for part in given_name.split())
+
+
+class SyntheticCorpus:
+
+    def __init__(self, fields=('Neuro',), journals_per_field=1, years=(2019, 2020), papers_per_year=15,
+                 nauthors=None, group_size=(3, 10), refs_per_paper=(30, 100), pool_factor=8, history_years=25,
+                 self_cite_rate=0.08, not_in_scopus_rate=0.03, seed=0):
+        # pool_factor: number of earlier (cited only) papers per journal-year paper
+        rng = np.random.default_rng(seed)
+        self.fields = tuple(fields)
+        self.years = tuple(sorted(years))
+        self.journals = {field: ['Synth' + re.sub('[^A-Za-z]', '', field) + chr(ord('A') + j)
+                                 for j in range(journals_per_field)] for field in self.fields}
+        ncited = len(self.fields)*journals_per_field*len(self.years)*papers_per_year
+        npool = ncited*pool_factor
+        nauthors = nauthors if nauthors is not None else max(200, (ncited + npool)//2)
+
+        # authors, with heavy-tailed productivity, in groups with the most productive member as senior author
+        self.affiliations = {60000000 + i: ('University ' + str(i), COUNTRIES[min(int(rng.pareto(1.2)), len(COUNTRIES) - 1)])
+                             for i in range(max(10, nauthors//40))}
+        affiliation_ids = list(self.affiliations)
+        self.authors = []
+        surnames = set()
+        for i in range(nauthors):
+            if rng.random() < 0.05:
+                surname = COMMON_SURNAMES[rng.integers(len(COMMON_SURNAMES))]  # shared surnames, as in real data
+            else:
+                surname = None
+                while surname is None or surname in surnames:
+                    surname = ''.join(SYLLABLES[k] for k in rng.integers(len(SYLLABLES), size=rng.integers(2, 4))).capitalize()
+                surnames.add(surname)
+            given_name = (GIVEN_NAMES[rng.integers(len(GIVEN_NAMES))] + ' ' + MIDDLE_INITIALS[rng.integers(len(MIDDLE_INITIALS))]).strip()
+            self.authors.append({'auid': 57000000000 + i*37, 'surname': surname, 'given_name': given_name,
+                                 'affiliation': affiliation_ids[rng.integers(len(affiliation_ids))] if rng.random() > 0.05 else None})
+        productivity = rng.pareto(1.5, size=nauthors) + 1
+        order = rng.permutation(nauthors)
+        self.groups = []
+        start = 0
+        while start < nauthors:
+            members = list(order[start:start + rng.integers(group_size[0], group_size[1] + 1)])
+            members.sort(key=lambda idx: -productivity[idx])  # senior author first
+            self.groups.append(members)
+            start += len(members)
+        group_weight = np.array([productivity[members].sum() for members in self.groups])
+        group_weight /= group_weight.sum()
+
+        # earlier papers (only cited), then the journal-year papers, in publication order
+        self.papers = {}
+        self.cited_eids = []  # papers available for citing, in publication order
+        self.journal_papers = {}  # (field, journal, year) -> [eid, ...]
+        self.author_papers = {}  # auid -> [eid, ...]
+        popularity = []
+        eid_counter = iter(range(85000000000, 86000000000, 7))
+        pool_years = rng.integers(min(self.years) - history_years, min(self.years), size=npool)
+        pool_days = rng.integers(1, 365, size=npool)
+        pool_order = np.lexsort((pool_days, pool_years))
+        for k in pool_order:
+            date = np.datetime64(str(pool_years[k]) + '-01-01') + pool_days[k]
+            paper = self.new_paper(rng, next(eid_counter), str(date), 'Synthetic Cited Journal', group_weight, productivity,
+                                   refs_per_paper=None)
+            popularity.append(rng.pareto(1.2) + 0.1)
+
+        self.not_in_scopus = set()
+        for year in self.years:
+            for field in self.fields:
+                for journal in self.journals[field]:
+                    eids = []
+                    for _ in range(papers_per_year):
+                        date = str(np.datetime64(str(year) + '-01-01') + rng.integers(0, 365))
+                        paper = self.new_paper(rng, next(eid_counter), date, journal, group_weight, productivity,
+                                               refs_per_paper, popularity, self_cite_rate, not_in_scopus_rate, eid_counter)
+                        eids.append(paper['eid'])
+                    self.journal_papers[(field, journal, year)] = eids
+            for field in self.fields:  # papers of a year can be cited from the next year on
+                for journal in self.journals[field]:
+                    for eid in self.journal_papers[(field, journal, year)]:
+                        self.cited_eids.append(eid)
+                        popularity.append(rng.pareto(1.2) + 0.1)
+
+    def new_paper(self, rng, eid_number, cover_date, journal, group_weight, productivity, refs_per_paper,
+                  popularity=None, self_cite_rate=0, not_in_scopus_rate=0, eid_counter=None):
+        group = self.groups[rng.choice(len(self.groups), p=group_weight)]
+        nauthors = int(min(len(group) + 3, 2 + rng.poisson(3)))
+        members = [idx for idx in group[1:] if rng.random() < 0.6]
+        rng.shuffle(members)
+        outsiders = list(rng.choice(len(self.authors), size=rng.integers(0, 3), p=productivity/productivity.sum()))
+        middle = [idx for idx in dict.fromkeys(members + outsiders) if idx != group[0]][:max(0, nauthors - 1)]
+        author_idx = middle + [group[0]]  # senior author last
+        eid = '2-s2.0-' + str(eid_number)
+        paper = {'eid': eid, 'title': 'Synthetic study ' + str(eid_number), 'cover_date': cover_date, 'journal': journal,
+                 'authors': [self.authors[idx] for idx in author_idx], 'references': [],
+                 'keywords': [str(keyword) for keyword in rng.choice(KEYWORDS, size=3, replace=False)]}
+
+        if refs_per_paper is not None and self.cited_eids:
+            nrefs = int(rng.integers(refs_per_paper[0], refs_per_paper[1] + 1))
+            weights = np.array(popularity[:len(self.cited_eids)])
+            refs = list(rng.choice(len(self.cited_eids), size=min(nrefs, len(self.cited_eids)), replace=False,
+                                   p=weights/weights.sum()))
+            refs = [self.cited_eids[idx] for idx in refs]
+            # self-citations: earlier papers of the same group
+            own = [e for idx in group for e in self.author_papers.get(self.authors[idx]['auid'], [])
+                   if e in self.papers and self.papers[e]['cover_date'] < cover_date]
+            own = list(dict.fromkeys(own))
+            for pos in range(len(refs)):
+                if own and rng.random() < self_cite_rate:
+                    refs[pos] = own[rng.integers(len(own))]
+                elif rng.random() < not_in_scopus_rate:
+                    refs[pos] = '2-s2.0-' + str(next(eid_counter))  # not in Scopus
+                    self.not_in_scopus.add(refs[pos])
+            paper['references'] = list(dict.fromkeys(refs))
+
+        self.papers[eid] = paper
+        if refs_per_paper is None:
+            self.cited_eids.append(eid)
+        for author in paper['authors']:
+            self.author_papers.setdefault(author['auid'], []).append(eid)
+        return paper
+
+    def pick_author(self, ndocs=20):
+        # author ID whose number of papers is closest to ndocs (for self_citation_author.py)
+        return min(self.author_papers, key=lambda auid: (abs(len(self.author_papers[auid]) - ndocs), auid))
+
+    def numref(self, eids):
+        return sum(len(self.papers[eid]['references']) for eid in eids)
+
+    ######################## source for scopus_tools.stand_in ########################
+
+    def get(self, record_type, identifier, view):
+        if record_type == 'AbstractRetrieval':
+            paper = self.papers.get(identifier if identifier.startswith('2-s2.0-') else '2-s2.0-' + identifier)
+            return None if paper is None else json.dumps(abstract_payload(paper, view or 'META_ABS', self.papers)).encode()
+        if record_type == 'AuthorRetrieval':
+            auid = int(identifier.split('-')[-1])
+            if auid not in self.author_papers:
+                return None
+            author = self.papers[self.author_papers[auid][0]]['authors']
+            author = next(entry for entry in author if entry['auid'] == auid)
+            return json.dumps(author_payload(author, [self.papers[eid] for eid in self.author_papers[auid]])).encode()
+        if record_type == 'AffiliationRetrieval':
+            affiliation = self.affiliations.get(int(identifier)) if identifier.isdigit() else None
+            if affiliation is None:
+                return None
+            return json.dumps(affiliation_payload(identifier, affiliation[0], affiliation[1])).encode()
+        return None
+
+    def search(self, query, view):
+        match = re.fullmatch(r'AU-ID\((\d+)\)', query.strip())
+        if match is None:
+            return None
+        eids = self.author_papers.get(int(match.group(1)), [])
+        return [search_entry(self.papers[eid]) for eid in sorted(eids, key=lambda e: self.papers[e]['cover_date'], reverse=True)]
+
+    ######################## files ########################
+
+    def export_rows(self, eids):
+        # rows of a Scopus csv export
+        rows = []
+        for eid in eids:
+            paper = self.papers[eid]
+            rows.append({'Authors': ', '.join(author['surname'] + ' ' + initials(author['given_name']) for author in paper['authors']),
+                         'Author(s) ID': ''.join(str(author['auid']) + ';' for author in paper['authors']),
+                         'Title': paper['title'], 'Year': int(paper['cover_date'][:4]), 'Source title': paper['journal'],
+                         'Cited by': 0, 'Document Type': 'Article', 'EID': eid})
+        return pd.DataFrame(rows)
+
+    def write_layout(self, base_path):
+        # All_<field>/<journal>/<journal><year>.csv (the articles) and <journal><year>_ref.csv (their references in Scopus)
+        for field in ALL_FIELDS + self.fields:
+            os.makedirs(os.path.join(base_path, 'All_' + field), exist_ok=True)
+        for (field, journal, year), eids in self.journal_papers.items():
+            folder = os.path.join(base_path, 'All_' + field, journal)
+            os.makedirs(folder, exist_ok=True)
+            self.export_rows(eids).to_csv(os.path.join(folder, journal + str(year) + '.csv'), index=False)
+            refs = list(dict.fromkeys(ref for eid in eids for ref in self.papers[eid]['references'] if ref in self.papers))
+            self.export_rows(refs).to_csv(os.path.join(folder, journal + str(year) + '_ref.csv'), index=False)
+
+    def write_payloads(self, store):
+        # all records into a RecordStore, to serve them with python -m scopus_tools.stand_in --store ...
+        rows = []
+        for eid in self.papers:
+            for view in ('FULL', 'REF', 'META_ABS'):
+                rows.append(('AbstractRetrieval', eid, view, self.get('AbstractRetrieval', eid, view), 0, None))
+        for auid, eids in self.author_papers.items():
+            rows.append(('AuthorRetrieval', str(auid), 'ENHANCED', self.get('AuthorRetrieval', str(auid), 'ENHANCED'), 0, None))
+            entries = self.search('AU-ID({:d})'.format(auid), None)
+            data = '\n'.join(json.dumps(entry) for entry in entries).encode()
+            rows.extend(('ScopusSearch', 'AU-ID({:d})'.format(auid), view, data, 0, None) for view in ('COMPLETE', 'STANDARD'))
+        for afid in self.affiliations:
+            rows.append(('AffiliationRetrieval', str(afid), 'STANDARD', self.get('AffiliationRetrieval', str(afid), 'STANDARD'), 0, None))
+        for start in range(0, len(rows), 5000):
+            store.put_many(rows[start:start + 5000])
+        return len(rows)
+
+    def summary(self):
+        ncited = [len(self.papers[eid]['references']) for eids in self.journal_papers.values() for eid in eids]
+        ndocs = np.array([len(eids) for eids in self.author_papers.values()])
+        return {'journal_years': len(self.journal_papers), 'articles': len(ncited), 'papers': len(self.papers),
+                'authors_with_papers': len(ndocs), 'references': int(sum(ncited)),
+                'papers_per_author_median': float(np.median(ndocs)), 'papers_per_author_max': int(ndocs.max())}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preset", type=str, default='tiny', choices=sorted(PRESETS), help="size of the corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, required=True, help="folder to write the All_<field> journal folders to")
+    parser.add_argument("--payload_store", type=str, default=None, help="also write all API records to this RecordStore file")
+    args = parser.parse_args()
+
+    corpus = SyntheticCorpus(**PRESETS[args.preset], seed=args.seed)
+    corpus.write_layout(args.out)
+    print(corpus.summary())
+    if args.payload_store is not None:
+        from scopus_tools.record_store import RecordStore
+        print('{:d} records written to {:s}'.format(corpus.write_payloads(RecordStore(args.payload_store)), args.payload_store))
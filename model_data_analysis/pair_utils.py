@@ -0,0 +1,360 @@
+'''
+Helper functions and classes for sc_by_pair.py
+'''
+
+import json
+import os
+import sys
+import time
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+# output columns of sc_by_pair.py, in csv order
+OUTPUT_COLUMNS = ['eid_citing', 'eid_cited', 'title_citing', 'title_cited', 'document_type',
+                  'journal_citing', 'journal_cited', 'date_citing', 'date_cited',
+                  'year_citing', 'year_cited', 'num_auth_citing', 'num_auth_cited', 'num_ref_citing',
+                  'sc_fa', 'sc_la', 'sc_any', 'position_fa_sc', 'position_la_sc',
+                  'affil_name_fa', 'affil_name_la', 'affil_country_fa', 'affil_country_la',
+                  'academic_age_fa', 'academic_age_la', 'num_prev_papers_fa', 'num_prev_papers_la',
+                  'kw_recent_fa', 'kw_recent_la', 'auid_fa', 'auid_la', 'name_fa', 'name_la',
+                  'surname_fa', 'surname_la', 'given_name_fa', 'given_name_la']
+
+# columns that only hold integers or None
+INT_COLUMNS = ['year_citing', 'num_auth_citing', 'num_auth_cited', 'num_ref_citing',
+               'sc_fa', 'sc_la', 'sc_any', 'position_fa_sc', 'position_la_sc',
+               'academic_age_fa', 'academic_age_la', 'num_prev_papers_fa', 'num_prev_papers_la',
+               'auid_fa', 'auid_la']
+
+
+def to_json_value(value):
+    # numpy scalars (e.g., from np.where or np.sum) are not JSON serializable
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('cannot save value of type ' + str(type(value)))
+
+
+class ArticleCheckpoint:
+    '''
+    Append-only log of the articles of one journal-year that are already done.
+    Each line is one article: its index in the journal-year, its EID and its rows (None if it was skipped),
+    so a restarted run only processes the articles that are not in the log yet.
+    Only the position of each article in the log is kept in memory, rows are read back by finished_rows().
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # entry index -> (eid, offset of the line in the log or None if skipped)
+        if os.path.exists(path):
+            valid_lines = []
+            offset = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:  # last line may be cut off by a crash
+                        continue
+                    line = line if line.endswith(b'\n') else line + b'\n'
+                    self.entries[entry['entry_idx']] = (entry['eid'], None if entry['rows'] is None else offset)
+                    valid_lines.append(line)
+                    offset += len(line)
+            with open(path + '.tmp', 'wb') as f:  # rewrite without the broken line before appending to it
+                f.writelines(valid_lines)
+            os.replace(path + '.tmp', path)
+        self._f = open(path, 'ab')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_done(self, entry_idx, eid):
+        return entry_idx in self.entries and self.entries[entry_idx][0] == eid
+
+    def append(self, entry_idx, eid, rows):
+        line = (json.dumps({'entry_idx': entry_idx, 'eid': eid, 'rows': rows}, default=to_json_value) + '\n').encode()
+        offset = self._f.tell()
+        self._f.write(line)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.entries[entry_idx] = (eid, None if rows is None else offset)
+
+    def finished_rows(self):
+        # rows of all finished (not skipped) articles, in journal-year order, read one article at a time
+        with open(self.path, 'rb') as f:
+            for entry_idx in sorted(self.entries):
+                offset = self.entries[entry_idx][1]
+                if offset is not None:
+                    f.seek(offset)
+                    yield json.loads(f.readline())['rows']
+
+    def remove(self):
+        self._f.close()
+        os.remove(self.path)
+
+
+class RowAccumulator:
+    '''
+    Column-wise collection of output rows. Rows are appended one article at a time (amortized O(1) per row).
+    Integer columns are kept in int64 arrays with a missing-value mask, other columns in lists.
+    write_csv() appends the collected rows to a csv and starts over, so memory stays bounded by the chunk size.
+    '''
+
+    def __init__(self, columns=OUTPUT_COLUMNS, int_columns=INT_COLUMNS):
+        self.columns = list(columns)
+        self.int_columns = set(int_columns)
+        self.total_rows = 0
+        self.peak_nbytes = 0
+        self.written = False
+        self.reset()
+
+    def reset(self):
+        self.data = {col: array('q') if col in self.int_columns else [] for col in self.columns}
+        self.missing = {col: bytearray() for col in self.columns if col in self.int_columns}
+        self.nrows = 0
+        self.object_nbytes = 0
+
+    def append(self, rows):
+        # rows: dict of equal length lists, one entry per reference
+        nrows = len(rows[self.columns[0]])
+        for col in self.columns:
+            values = rows[col] if col in rows else [None]*nrows  # column added after the rows were checkpointed
+            if len(values) != nrows:
+                raise ValueError('column {:s} has {:d} rows, expected {:d}'.format(col, len(values), nrows))
+            if col in self.int_columns:
+                self.data[col].extend([0 if value is None else int(value) for value in values])
+                self.missing[col].extend([value is None for value in values])
+            else:
+                self.data[col].extend(values)
+                self.object_nbytes += sum(sys.getsizeof(value) for value in values)
+        self.nrows += nrows
+        self.total_rows += nrows
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes())
+
+    def nbytes(self):
+        # approximate memory used by the collected rows
+        nbytes = self.object_nbytes
+        for col in self.columns:
+            if col in self.int_columns:
+                nbytes += self.data[col].itemsize*len(self.data[col]) + len(self.missing[col])
+            else:
+                nbytes += 8*len(self.data[col])  # list pointers
+        return nbytes
+
+    def to_frame(self):
+        import pandas as pd
+        frame = {}
+        for col in self.columns:
+            if col in self.int_columns:
+                values = np.array(self.data[col], dtype=np.int64)
+                mask = np.frombuffer(bytes(self.missing[col]), dtype=bool)
+                frame[col] = pd.arrays.IntegerArray(values, mask.copy())
+            else:
+                frame[col] = self.data[col]
+        return pd.DataFrame(frame, columns=self.columns)
+
+    def write_csv(self, path):
+        # append the collected rows to path (with a header the first time) and start over
+        if self.nrows > 0 or not self.written:
+            self.to_frame().to_csv(path, mode='a' if self.written else 'w', header=not self.written, index=False)
+            self.written = True
+        self.reset()
+
+
+class ProgressAggregator:
+    '''
+    Combined progress of all journal-years (and worker processes): articles and references per second.
+    '''
+
+    def __init__(self, report_every=30):
+        self.start = time.time()
+        self.last_report = self.start
+        self.report_every = report_every
+        self.narticles = 0
+        self.nrefs = 0
+        self.nunits = 0
+
+    def update(self, narticles, nrefs):
+        self.narticles += narticles
+        self.nrefs += nrefs
+        self.report()
+
+    def unit_done(self):
+        self.nunits += 1
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.report_every:
+            return
+        self.last_report = now
+        elapsed = max(now - self.start, 1e-9)
+        print('Progress: {:d} journal-years, {:d} articles ({:.2f}/s), {:d} references ({:.1f}/s)'.format(
+            self.nunits, self.narticles, self.narticles / elapsed, self.nrefs, self.nrefs / elapsed))
+
+
+def parse_cover_date(cover_date):
+    # 'YYYY-MM-DD' -> datetime64[D], with months of 00 read as 01
+    # note: the month is also used as the day, as in the original academic age code
+    parts = cover_date.replace('-00', '-01').split('-')
+    year, month = int(parts[0]), int(parts[1])
+    return np.datetime64((year - 1970)*12 + month - 1, 'M').astype('datetime64[D]') + (month - 1)
+
+
+def parse_cover_dates(cover_dates):
+    # parse_cover_date for a whole list/column of cover dates at once
+    cover_dates = np.asarray(cover_dates, dtype=str)
+    chars = cover_dates.astype('S10').view(np.uint8).reshape(len(cover_dates), 10).astype(np.int64)
+    digits = chars - ord('0')
+    digit_pos = [0, 1, 2, 3, 5, 6, 8, 9]
+    well_formed = (np.char.str_len(cover_dates) == 10) & (chars[:, 4] == ord('-')) & (chars[:, 7] == ord('-')) & \
+        np.all((digits[:, digit_pos] >= 0) & (digits[:, digit_pos] <= 9), axis=1)
+    if not well_formed.all():  # e.g. months without leading zero, parse one by one
+        return np.array([parse_cover_date(cover_date) for cover_date in cover_dates], dtype='datetime64[D]')
+    year = digits[:, 0]*1000 + digits[:, 1]*100 + digits[:, 2]*10 + digits[:, 3]
+    month = digits[:, 5]*10 + digits[:, 6]
+    month[month == 0] = 1
+    return ((year - 1970)*12 + month - 1).astype('datetime64[M]').astype('datetime64[D]') + (month - 1)
+
+
+class CitingArticle:
+    '''
+    What sc_by_pair.py needs of one citing article, read from its FULL and REF views: EID, title, journal,
+    cover date, authors and the references of both views. The plan of a journal-year reads the views once
+    and keeps only this, so the articles are not parsed again when they are processed.
+    '''
+
+    __slots__ = ('eid', 'title', 'publicationName', 'coverDate', 'authors', 'references', 'ref_references')
+
+    def __init__(self, ab_full, ab_ref):
+        self.eid = ab_full.eid
+        self.title = ab_full.title
+        self.publicationName = ab_full.publicationName
+        self.coverDate = ab_full.coverDate
+        self.authors = ab_full.authors
+        self.references = ab_full.references
+        self.ref_references = ab_ref.references
+
+
+class AuthorRecord:
+    '''
+    What sc_by_pair.py needs of one author: names, first publication year and the author's documents
+    (cover dates, EIDs and keywords, in the order Scopus returns them, plus the cover dates sorted).
+    complete=False marks records with a temporary download problem, which are not kept by the AuthorFeatureStore.
+    '''
+
+    __slots__ = ('given_name', 'surname', 'start_year', 'dates', 'sorted_dates', 'eids', 'eid_pos', 'keywords',
+                 'keyword_idx', 'complete', 'nbytes')
+
+    def __init__(self, given_name, surname, start_year, documents=None, complete=True):
+        self.given_name = given_name
+        self.surname = surname
+        self.start_year = start_year
+        self.complete = complete
+        self.dates, self.sorted_dates, self.eids, self.eid_pos, self.keywords, self.keyword_idx = [None]*6
+        if documents:
+            self.dates = parse_cover_dates([doc.coverDate for doc in documents])
+            self.sorted_dates = np.sort(self.dates)
+            self.eids = [doc.eid for doc in documents]
+            self.eid_pos = {}
+            for pos, eid in enumerate(self.eids):
+                self.eid_pos.setdefault(eid, pos)  # first position, like list.index
+            self.keywords = [doc.authkeywords for doc in documents]
+            self.keyword_idx = np.array([idx for idx, kw in enumerate(self.keywords) if kw is not None], dtype=np.int64)
+        self.nbytes = 200 + sum(sys.getsizeof(value) for value in (given_name, surname))
+        if self.dates is not None:
+            self.nbytes += 2*self.dates.nbytes + self.keyword_idx.nbytes + 120*len(self.eids) + \
+                sum(sys.getsizeof(value) for value in self.eids) + \
+                sum(sys.getsizeof(value) for value in self.keywords if value is not None)
+
+    def features(self, citing_cover_date, citing_eid, k=10):
+        # (academic age, number of previous papers, keywords of the k papers closest in time) for a citing article,
+        # or (None, None, None) if the author has no publication range or documents
+        return self.features_many([citing_cover_date], [citing_eid], k)[0]
+
+    def features_many(self, citing_cover_dates, citing_eids, k=10):
+        # features() for several citing articles of this author at once
+        if self.start_year is None or self.dates is None:
+            return [(None, None, None)]*len(citing_cover_dates)
+        d0 = parse_cover_dates(citing_cover_dates)
+        academic_age = [int(cover_date[:4]) - self.start_year for cover_date in citing_cover_dates]
+
+        # number of previous papers: documents listed after the citing article, or if it is not in the list
+        # (e.g., maybe inconsitencies in author id on scopus), documents with an earlier cover date
+        num_earlier = np.searchsorted(self.sorted_dates, d0, side='left')
+        num_prev_papers = [len(self.eids) - 1 - self.eid_pos[eid] if eid in self.eid_pos else int(num_earlier[i])
+                           for i, eid in enumerate(citing_eids)]
+
+        kw_recent = self.nearest_keywords(d0, k)
+        return list(zip(academic_age, num_prev_papers, kw_recent))
+
+    def nearest_keywords(self, d0, k=10):
+        # keywords of the k keyworded documents closest in time to each date in d0, joined by ';;;;'
+        # Same result as going through np.argsort(abs(days between)) and keeping the first k with keywords:
+        # argpartition finds the k closest keyworded documents, and if distances are tied (where the result
+        # depends on how np.argsort orders ties) the full argsort is used for that date.
+        dist = np.abs((self.dates[None, :] - d0[:, None]).astype(np.int64))
+        dist_kw = dist[:, self.keyword_idx]
+        nkw = len(self.keyword_idx)
+        if nkw > k:
+            part = np.argpartition(dist_kw, [k - 1, k], axis=1)
+            chosen = part[:, :k]
+            # a tie between the k-th and (k+1)-th closest changes which documents are chosen
+            tied_at_k = np.take_along_axis(dist_kw, part[:, [k - 1]], 1)[:, 0] == np.take_along_axis(dist_kw, part[:, [k]], 1)[:, 0]
+        else:
+            chosen = np.broadcast_to(np.arange(nkw), (len(d0), nkw))
+            tied_at_k = np.zeros(len(d0), dtype=bool)
+        chosen_dist = np.take_along_axis(dist_kw, chosen, 1)
+        order = np.argsort(chosen_dist, axis=1, kind='stable')
+        chosen = np.take_along_axis(chosen, order, 1)
+        chosen_dist = np.take_along_axis(chosen_dist, order, 1)
+        tied = tied_at_k | np.any(chosen_dist[:, 1:] == chosen_dist[:, :-1], axis=1)
+
+        kw_recent = []
+        for i in range(len(d0)):
+            if tied[i]:
+                kw = []
+                for sorted_date_idx in np.argsort(dist[i]):  # sort closest articles to current (by date)
+                    if self.keywords[sorted_date_idx] is not None:
+                        kw.append(self.keywords[sorted_date_idx])
+                    if len(kw) == k:
+                        break
+            else:
+                kw = [self.keywords[idx] for idx in self.keyword_idx[chosen[i]]]
+            kw_recent.append(';;;;'.join(kw))
+        return kw_recent
+
+
+class AuthorFeatureStore:
+    '''
+    AuthorRecords shared by all articles of a run, so an author (e.g. the PI of a lab) is downloaded once.
+    load(auid) returns an AuthorRecord, or None if the author is unknown (kept, so not asked again).
+    Least recently used authors are dropped once the records take more than max_nbytes.
+    '''
+
+    def __init__(self, load, max_nbytes=512*2**20):
+        self.load = load
+        self.max_nbytes = max_nbytes
+        self.records = OrderedDict()  # auid -> AuthorRecord or None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, auid):
+        if auid in self.records:
+            self.hits += 1
+            self.records.move_to_end(auid)
+            return self.records[auid]
+        self.misses += 1
+        record = self.load(auid)
+        if record is None or record.complete:
+            self.records[auid] = record
+            self.nbytes += 0 if record is None else record.nbytes
+            while self.nbytes > self.max_nbytes and len(self.records) > 1:
+                _, dropped = self.records.popitem(last=False)
+                self.nbytes -= 0 if dropped is None else dropped.nbytes
+                self.evictions += 1
+        return record
+
+    def stats(self):
+        return {'authors': len(self.records), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'MB': round(self.nbytes / 1e6, 1)}
@@ -10,13 +10,23 @@ from pybliometrics.scopus import AbstractRetrieval, AuthorRetrieval, Affiliation
 import pandas as pd
 from tqdm import tqdm
 import os
+import sys
+import resource
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
 import glob
 import re
-import numpy as np
-from datetime import date
 from pybliometrics.scopus.exception import Scopus404Error, Scopus500Error
 import argparse
 from json.decoder import JSONDecodeError
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from scopus_tools.record_store import RecordStore
+from scopus_tools.key_scheduler import KeyScheduler
+from scopus_tools.fetch_plan import FetchPlan, prefetch
+from scopus_tools.metrics import Metrics
+from scopus_tools.self_citation_kernel import SelfCitationBatch, COLUMNS as SC_COLUMNS
+from pair_utils import ArticleCheckpoint, RowAccumulator, ProgressAggregator, CitingArticle, AuthorRecord, AuthorFeatureStore
 
 import urllib3, socket
 from urllib3.connection import HTTPConnection
@@ -32,6 +42,13 @@ HTTPConnection.default_socket_options = (
 parser = argparse.ArgumentParser()
 parser.add_argument("--field", type=str, help="which field(s) to run for")
 parser.add_argument("--years", type=str, help="which years to run for")
+parser.add_argument("--store", type=str, default='/data_dustin/store3/training/matt/self_citation/scopus_records.db', help="file where downloaded Scopus records are stored")
+parser.add_argument("--key_state", type=str, default='/data_dustin/store3/training/matt/self_citation/key_quota.json', help="file where the remaining quota of each API key is kept between runs")
+parser.add_argument("--jobs", type=int, default=1, help="number of journal-years to run at the same time (separate processes)")
+parser.add_argument("--prefetch_workers", type=int, default=8, help="number of parallel downloads when prefetching the records of a journal-year")
+parser.add_argument("--plan_only", action='store_true', help="only report how many records each journal-year needs and how many must be downloaded")
+parser.add_argument("--base_path", type=str, default='/data_dustin/store3/training/matt/self_citation', help="folder with the All_<field> journal folders, results are saved in its results_1_2024 folder")
+parser.add_argument("--metrics_dir", type=str, default=None, help="folder for the timing and retrieval metrics of each journal-year (.json and Prometheus .prom), default results_1_2024/metrics")
 
 
 # parse arguments
@@ -41,8 +58,16 @@ field_list_arg = [item for item in args.field.split(',')]
 print(field_list_arg)
 select_years = [int(item) for item in args.years.split(',')]
 print(select_years)
+jobs = max(1, args.jobs)
 
 refresh_days = 10000
+metrics = Metrics()  # retrieval latency, store hits and errors, stage timings; written for each journal-year
+if jobs == 1:
+    scheduler = KeyScheduler(state_path=args.key_state, metrics=metrics)  # spread downloads over all API keys in the pybliometrics config
+    store = RecordStore(args.store, fetch=scheduler.fetch, metrics=metrics)
+else:  # each worker process opens its own (see init_worker), nothing is opened before the fork
+    scheduler, store = None, None
+author_features = AuthorFeatureStore(lambda auid: load_author(auid))  # citing authors, kept across articles and journal-years
 # Overall summary
 # Download all relevant articles in both FULL and REF view
 # Three self-citation values for each reference
@@ -72,12 +97,382 @@ refresh_days = 10000
 
 
 dir_list = []
-base_path = '/data_dustin/store3/training/matt/self_citation'
+base_path = args.base_path
+results_path = os.path.join(base_path, 'results_1_2024')
+metrics_path = args.metrics_dir if args.metrics_dir is not None else os.path.join(results_path, 'metrics')
+chunk_rows = 200000  # number of rows kept in memory before writing them to the results csv
+sc_batch_articles = 500  # number of articles whose self-citations are computed together, and then checkpointed
 for field_folder in field_list_arg:  # 'Neuro', 'Neurology', 'Psychiatry'
     tmp = [f.path for f in os.scandir( os.path.join(base_path, 'All_' + field_folder + '/' ) ) if f.is_dir()]
     dir_list.extend(tmp)
 
+
+def process_article(this_eid, document_type_entry, article=None):
+    # download one citing article and its references, returns the article's rows (one per reference)
+    # as a dict of column lists, the citing author IDs and the author IDs of each reference (None if not known),
+    # or None if the article could not be downloaded. The self-citation columns are filled in by checkpoint_batch
+    # article: the CitingArticle read by plan_journal_year, read here if the plan did not have it
+    if article is None:
+        # Full view
+        try:
+            ab_full = store.retrieve(AbstractRetrieval, this_eid, view='FULL', refresh=refresh_days)
+        except JSONDecodeError:
+            return None  # skip to next loop (next article entry)
+        except Scopus404Error:
+            return None
+        except Scopus500Error:
+            return None
+
+        # Reference view
+        try:
+            ab_ref = store.retrieve(AbstractRetrieval, this_eid, view='REF', refresh=refresh_days)
+        except JSONDecodeError:
+            return None  # skip to next loop (next article entry)
+        except Scopus404Error:
+            return None
+        except Scopus500Error:
+            return None
+        article = CitingArticle(ab_full, ab_ref)
+
+
+    if article.references is not None:
+        numref = len(article.references)
+    else:
+        return None  # skip to next loop (next article entry)
+
+
+
+    ######################## Article level traits ########################
+
+    # initialize empty lists
+    eid_citing = [this_eid]*numref
+    eid_cited = [None if ref_full.id is None else '2-s2.0-' + ref_full.id for ref_full in article.references]
+    title_cited = [None]*numref
+    title_citing = [article.title]*numref
+    journal_cited = [None]*numref
+    journal_citing = [article.publicationName]*numref
+    date_cited = [None]*numref
+    date_citing = [article.coverDate]*numref
+    year_cited = [None]*numref
+    year_citing = [int(article.coverDate[:4])]*numref
+    num_auth_cited = [None]*numref
+    num_auth_citing = [len(article.authors)]*numref
+    cited_auids = [None]*numref
+    num_ref_citing = [numref]*numref
+    document_type = [document_type_entry]*numref
+
+    # Note: not present
+    eid_full = [ab.id for ab in article.references]
+    eid_ref = [ab.id for ab in article.ref_references]
+    missing_ref_eid = [ eid for eid in eid_full if eid not in eid_ref]
+    citing_auid = [int(citing_auth.auid) for citing_auth in article.authors]
+    stage_start = time.perf_counter()
+    for ref_idx, ref_full in enumerate(article.references):
+
+        if ref_full.id in missing_ref_eid:  # in this case, try to download reference in a different way
+            missing_key = True
+            try:
+                ref_ref = store.retrieve(AbstractRetrieval, '2-s2.0-' + ref_full.id, refresh=refresh_days, view='FULL')
+                ref_auid = [ref_auth.auid for ref_auth in ref_ref.authors]
+            except Scopus404Error:  # either ID is not known by scopus
+                continue  # skip to next loop (next reference)
+            except Scopus500Error:
+                continue
+            except TypeError:  # ID not present
+                continue
+            except JSONDecodeError:
+                continue
+            except Exception as e:  # try to find what type of exception
+                print(e)
+                print(type(e))
+
+        else:  # otherwise, if reference info is already present, just use this
+            missing_key = False
+            ref_ref = article.ref_references[eid_ref.index(ref_full.id)]
+            if ref_ref.authors_auid is not None:
+                ref_auid = ref_ref.authors_auid.split(';')
+            else:
+                ref_auid = None
+
+        # print(ref_full.title)
+        title_cited[ref_idx] = ref_full.title
+
+        if missing_key:
+            journal_cited[ref_idx] = ref_ref.title  
+
+            if ref_ref.authors is not None:
+                num_auth_cited[ref_idx] = len(ref_ref.authors)
+
+            if ref_ref.coverDate is not None:
+                year_cited[ref_idx] = int(ref_ref.coverDate[:4])
+        else:
+            journal_cited[ref_idx] = ref_ref.sourcetitle
+
+            num_auth_cited[ref_idx] = ref_ref.authors.count(';') + 1
+
+            year_cited[ref_idx] = ref_full.publicationyear
+
+        date_cited[ref_idx] = ref_ref.coverDate
+
+
+
+
+
+        #********************** Self-citation - by AUID **********************
+        # only the author IDs are collected here, the self-citations of all articles of a batch are computed at once
+        try:
+            cited_auids[ref_idx] = [int(cited_auid) for cited_auid in ref_auid]
+        except AttributeError:
+            pass  # if can't find any info, just leave as None
+        except TypeError:  # if no auid
+            pass
+    metrics.add_time('references (with downloads)', time.perf_counter() - stage_start)
+
+
+
+    ######################## Author level traits ########################
+    auid_fa = [citing_auid[0]]*numref
+    auid_la = [citing_auid[-1]]*numref
+
+    name_fa = [str(article.authors[0].surname) + ', ' + str(article.authors[0].given_name)]*numref  # do str() in case of None
+    name_la = [str(article.authors[-1].surname) + ', ' + str(article.authors[-1].given_name)]*numref
+
+
+    ######## get author data (names, academic age, previous papers and keywords), shared across articles
+    features = {}
+    for position, auid in (('fa', citing_auid[0]), ('la', citing_auid[-1])):
+        try:
+            with metrics.stage('author features (with downloads)'):
+                author = author_features.get(auid)
+        except Scopus500Error:
+            author = None
+        if author is None:  # skip
+            given_name, surname = None, None
+            academic_age, num_prev_papers, kw_recent = None, None, None
+        else:
+            given_name, surname = author.given_name, author.surname
+            academic_age, num_prev_papers, kw_recent = author.features(article.coverDate, article.eid)
+        features['given_name_' + position] = [given_name]*numref
+        features['surname_' + position] = [surname]*numref
+        features['academic_age_' + position] = [academic_age]*numref
+        features['num_prev_papers_' + position] = [num_prev_papers]*numref
+        features['kw_recent_' + position] = [None]*numref
+        if kw_recent is not None:
+            features['kw_recent_' + position][0] = kw_recent
+
+
+    ######## affiliation country - if multiple, take first (split by ; line)
+    if article.authors[0].affiliation is not None:
+        try:
+            affil_fa = store.retrieve(AffiliationRetrieval, article.authors[0].affiliation.split(';')[0], refresh=refresh_days)
+            affil_name_fa = [affil_fa.affiliation_name]*numref
+            affil_country_fa = [affil_fa.country]*numref
+        except Scopus404Error:
+            affil_name_fa = [None]*numref
+            affil_country_fa = [None]*numref
+        except Scopus500Error:
+            affil_name_fa = [None]*numref
+            affil_country_fa = [None]*numref
+    else:
+        affil_fa = [None]*numref
+        affil_name_fa = [None]*numref
+        affil_country_fa = [None]*numref
+
+
+    if article.authors[-1].affiliation is not None:
+        try:
+            affil_la = store.retrieve(AffiliationRetrieval, article.authors[-1].affiliation.split(';')[0], refresh=refresh_days)
+            affil_name_la = [affil_la.affiliation_name]*numref
+            affil_country_la = [affil_la.country]*numref
+        except Scopus404Error:
+            affil_name_la = [None]*numref
+            affil_country_la = [None]*numref
+        except Scopus500Error:
+            affil_name_la = [None]*numref
+            affil_country_la = [None]*numref
+    else:
+        affil_la = [None]*numref
+        affil_name_la = [None]*numref
+        affil_country_la = [None]*numref
+
+    ######################## Rows for this article ########################
+    return {'eid_citing':eid_citing, 'eid_cited':eid_cited,
+            'title_citing':title_citing,'title_cited':title_cited,
+            'document_type':document_type,
+            'journal_citing':journal_citing, 'journal_cited':journal_cited, 
+            'date_citing':date_citing, 'date_cited':date_cited, 
+            'year_citing':year_citing, 'year_cited':year_cited,
+            'num_auth_citing':num_auth_citing, 'num_auth_cited':num_auth_cited, 
+            'num_ref_citing':num_ref_citing,
+            'affil_name_fa':affil_name_fa, 'affil_name_la':affil_name_la,
+            'affil_country_fa':affil_country_fa, 'affil_country_la':affil_country_la,
+            'auid_fa':auid_fa , 'auid_la':auid_la ,
+            'name_fa':name_fa , 'name_la':name_la,
+            **features}, citing_auid, cited_auids
+
+
+def load_author(auid):
+    # record of one citing author for the author feature store, None if Scopus does not know the author
+    try:
+        a = store.retrieve(AuthorRetrieval, auid, refresh=refresh_days)
+    except Scopus404Error:
+        return None
+    if a.publication_range is None:  # no author dates
+        return AuthorRecord(a.given_name, a.surname, None)
+    try:
+        with metrics.stage('author document search'):
+            return AuthorRecord(a.given_name, a.surname, a.publication_range[0], a.get_documents())
+    except (JSONDecodeError, Scopus500Error) as e:  # names are fine, try the documents again next time
+        metrics.count_error('ScopusSearch', '', e)  # searches do not go through the record store
+        return AuthorRecord(a.given_name, a.surname, a.publication_range[0], complete=False)
+
+
+def plan_journal_year(name, EIDs, fetch=True):
+    # plan: collect every record the articles of a journal-year need, each once, and download them before
+    # the articles are processed (citing articles first, since their references and authors are read from them)
+    # returns the plan and the CitingArticle of each article that was read, for process_article
+    article_plan = FetchPlan()
+    for this_eid in EIDs:
+        article_plan.add(AbstractRetrieval, this_eid, view='FULL')
+        article_plan.add(AbstractRetrieval, this_eid, view='REF')
+    if fetch:
+        ndownloaded, nfailed = prefetch(store, article_plan.to_fetch(store, refresh_days), refresh_days, args.prefetch_workers)
+        print(name + ': prefetched {:d} articles ({:d} failed)'.format(ndownloaded, nfailed))
+
+    plan = FetchPlan()
+    articles = {}
+    nunknown = 0
+    for this_eid in EIDs:
+        if not (store.contains('AbstractRetrieval', this_eid, 'FULL', refresh_days) and
+                store.contains('AbstractRetrieval', this_eid, 'REF', refresh_days)):
+            nunknown += 1  # not downloaded (yet), so its references and authors are not known
+            continue
+        try:
+            ab_full = store.retrieve(AbstractRetrieval, this_eid, view='FULL', refresh=refresh_days)
+            ab_ref = store.retrieve(AbstractRetrieval, this_eid, view='REF', refresh=refresh_days)
+        except Exception:
+            continue
+        article = CitingArticle(ab_full, ab_ref)
+        if article.references is None or article.ref_references is None:
+            continue
+        articles[this_eid] = article
+        # references missing from the REF view are downloaded one by one
+        eid_ref = set(ab.id for ab in article.ref_references)
+        for ref_full in article.references:
+            if ref_full.id is not None and ref_full.id not in eid_ref:
+                plan.add(AbstractRetrieval, '2-s2.0-' + ref_full.id, view='FULL')
+        # first and last author, and their first affiliation
+        for author in (article.authors[0], article.authors[-1]):
+            plan.add(AuthorRetrieval, int(author.auid))
+            if author.affiliation is not None:
+                plan.add(AffiliationRetrieval, author.affiliation.split(';')[0])
+
+    print(name + ': plan for {:d} articles ({:d} not downloaded yet): {:d} requests, {:d} unique records, dedup ratio {:.2f}'.format(
+        len(EIDs), nunknown, article_plan.requests + plan.requests, len(article_plan) + len(plan),
+        (article_plan.requests + plan.requests) / max(len(article_plan) + len(plan), 1)))
+    print(name + ': ' + str({**article_plan.summary(store, refresh_days), **plan.summary(store, refresh_days)}))
+    if fetch:
+        ndownloaded, nfailed = prefetch(store, plan.to_fetch(store, refresh_days), refresh_days, args.prefetch_workers)
+        print(name + ': prefetched {:d} references, authors and affiliations ({:d} failed)'.format(ndownloaded, nfailed))
+    return plan, articles
+
+
+def process_journal_year(field_name, journal_name, year):
+    # process all articles of one journal-year and save them to their own results csv
+    metrics.reset()
+    # read in main set of articles
+    with metrics.stage('read journal csv'):
+        df_journal = pd.read_csv (  os.path.join(base_path, field_name, journal_name, journal_name + str(year) + '.csv')  )
+    df_journal = df_journal[df_journal['Authors'] != '[No author name available]']  # remove entried w missing authors
+    EIDs= list(df_journal['EID'])
+    doc_types_for_year = list(df_journal['Document Type'])
+    nentries = df_journal.shape[0]
+    print(journal_name + str(year) + ': total entries: ' + '{:d}'.format(nentries))
+
+    results_file = os.path.join(results_path, journal_name + str(year) + '.csv')
+
+    if args.plan_only:
+        plan_journal_year(journal_name + str(year), EIDs, fetch=False)
+        return 0
+
+    # articles finished by an earlier (interrupted) run are read from the checkpoint log instead of redone
+    checkpoint = ArticleCheckpoint(results_file + '.checkpoint.jsonl')
+    if len(checkpoint) > 0:
+        print('Resuming from checkpoint: {:d} of {:d} articles already done'.format(len(checkpoint), nentries))
+    with metrics.stage('plan and prefetch'):
+        _, articles = plan_journal_year(journal_name + str(year), [eid for idx, eid in enumerate(EIDs) if not checkpoint.is_done(idx, eid)])
+
+    pending = []  # (entry index, EID, rows or None, slice of its references in the batch)
+    batch = SelfCitationBatch()
+    for entry_idx, this_eid in tqdm(enumerate(EIDs), disable=(jobs > 1)):
+        if checkpoint.is_done(entry_idx, this_eid):
+            continue
+        with metrics.stage('articles'):
+            article = process_article(this_eid, doc_types_for_year[entry_idx], articles.pop(this_eid, None))
+        if article is None:
+            pending.append((entry_idx, this_eid, None, None))
+        else:
+            row_entry, citing_auid, cited_auids = article
+            pending.append((entry_idx, this_eid, row_entry, batch.add(citing_auid, cited_auids)))
+        if len(pending) >= sc_batch_articles:
+            checkpoint_batch(checkpoint, pending, batch)
+            pending, batch = [], SelfCitationBatch()
+    checkpoint_batch(checkpoint, pending, batch)
+
+    # collect rows column-wise and stream them to a temporary file in chunks,
+    # so that a partial csv is never mistaken for a finished journal-year
+    stage_start = time.perf_counter()
+    rows_year = RowAccumulator()
+    for row_entry in checkpoint.finished_rows():
+        rows_year.append(row_entry)
+        if rows_year.nrows >= chunk_rows:
+            rows_year.write_csv(results_file + '.tmp')
+    rows_year.write_csv(results_file + '.tmp')
+    metrics.add_time('write results', time.perf_counter() - stage_start)
+    os.replace(results_file + '.tmp', results_file)
+    checkpoint.remove()
+    print(journal_name + str(year) + ': saved {:d} rows, peak memory for rows: {:.1f} MB, peak process memory: {:.1f} MB'.format(
+        rows_year.total_rows, rows_year.peak_nbytes / 1e6, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
+    print('Author feature store: ' + str(author_features.stats()))
+    print('Remaining API quota (all keys): ' + str(scheduler.summary()))
+    scheduler.save()  # worker processes exit without running atexit
+    metrics.write(os.path.join(metrics_path, journal_name + str(year)),
+                  labels={'script': 'sc_by_pair', 'field': field_name, 'journal': journal_name, 'year': year})
+    return rows_year.total_rows
+
+
+def checkpoint_batch(checkpoint, pending, batch):
+    # fill in the self-citations of a batch of articles (scopus_tools/self_citation_kernel.py) and checkpoint them
+    with metrics.stage('self-citations'):
+        sc = batch.compute()
+    for entry_idx, this_eid, row_entry, refs in pending:
+        if row_entry is not None:
+            for col in SC_COLUMNS:
+                row_entry[col] = [None if value < 0 else int(value) for value in sc[col][refs]]
+        checkpoint.append(entry_idx, this_eid, row_entry)  # None if skipped, so it is not retried
+        report_progress(1, 0 if row_entry is None else len(row_entry['eid_citing']))
+
+
+def report_progress(narticles, nrefs):
+    # send progress to the aggregator (directly, or through the queue from a worker process)
+    if progress_queue is not None:
+        progress_queue.put((narticles, nrefs))
+    else:
+        progress.update(narticles, nrefs)
+
+
+def init_worker(queue):
+    # each worker process opens its own record store and shares the per-key request rate with the other workers;
+    # their schedulers merge the quota they used into the same key state file (see KeyScheduler.save)
+    global store, scheduler, metrics, progress_queue
+    metrics = Metrics()
+    scheduler = KeyScheduler(state_path=args.key_state, rate_scale=1/jobs, metrics=metrics)
+    store = RecordStore(args.store, fetch=scheduler.fetch, metrics=metrics)
+    progress_queue = queue
+
+
 # set journal parameters
+units = []  # (field, journal, year) to run, each is independent and writes its own results csv
 for dir_name in dir_list:
     
     # (TEMPORARY) Only for testing specific journal
@@ -93,385 +488,31 @@ for dir_name in dir_list:
     years = [y for y in years if y in select_years]  # include only 2016-2020 (if available)
     
     for year in years:
-        # read in main set of articles
-        df_journal = pd.read_csv (  os.path.join(base_path, field_name, journal_name, journal_name + str(year) + '.csv')  )
-        df_journal = df_journal[df_journal['Authors'] != '[No author name available]']  # remove entried w missing authors
-        EIDs= list(df_journal['EID'])
-        doc_types_for_year = list(df_journal['Document Type'])
-        nentries = df_journal.shape[0]
-        print('Total entries: ' + '{:d}'.format(nentries))
-        
-        df_year = pd.DataFrame()
-        
-        if os.path.exists(os.path.join('/data_dustin/store3/training/matt/self_citation/results_1_2024/', journal_name + str(year) + '.csv')):
-            print('Skipping because file exists: ' + os.path.join('/data_dustin/store3/training/matt/self_citation/results_1_2024/', journal_name + str(year) + '.csv'))
+        results_file = os.path.join(results_path, journal_name + str(year) + '.csv')
+        if os.path.exists(results_file):
+            print('Skipping because file exists: ' + results_file)
             continue
-        
-        for entry_idx, this_eid in tqdm(enumerate(EIDs)):       
-            
-            # Full view
-            try:
-                ab_full = AbstractRetrieval(this_eid, view='FULL', refresh=refresh_days)
-            except JSONDecodeError:
-                continue  # skip to next loop (next article entry)
-            except Scopus404Error:
-                continue
-            except Scopus500Error:
-                continue
-                
-            # Reference view
-            try:
-                ab_ref = AbstractRetrieval(this_eid, view='REF', refresh=refresh_days)
-            except JSONDecodeError:
-                continue  # skip to next loop (next article entry)
-            except Scopus404Error:
-                continue
-            except Scopus500Error:
-                continue
-                
-                
-            if ab_full.references is not None:
-                numref = len(ab_full.references)
-            else:
-                continue  # skip to next loop (next article entry)
-    
-            
-    
-            ######################## Article level traits ########################
-
-            # initialize empty lists
-            eid_citing = [this_eid]*numref
-            title_cited = [None]*numref
-            title_citing = [ab_full.title]*numref
-            journal_cited = [None]*numref
-            journal_citing = [ab_full.publicationName]*numref
-            date_cited = [None]*numref
-            date_citing = [ab_full.coverDate]*numref
-            year_cited = [None]*numref
-            year_citing = [int(ab_full.coverDate[:4])]*numref
-            num_auth_cited = [None]*numref
-            num_auth_citing = [len(ab_full.authors)]*numref
-            sc_fa = [None]*numref
-            sc_la = [None]*numref
-            sc_any = [None]*numref
-            position_fa_sc = [None]*numref
-            position_la_sc = [None]*numref
-            num_ref_citing = [numref]*numref
-            document_type = [doc_types_for_year[entry_idx]]*numref
-            
-            # Note: not present
-            eid_full = [ab.id for ab in ab_full.references]
-            eid_ref = [ab.id for ab in ab_ref.references]
-            missing_ref_eid = [ eid for eid in eid_full if eid not in eid_ref]
-            for ref_idx, ref_full in enumerate(ab_full.references):
-                
-                if ref_full.id in missing_ref_eid:  # in this case, try to download reference in a different way
-                    missing_key = True
-                    try:
-                        ref_ref = AbstractRetrieval('2-s2.0-' + ref_full.id, refresh=refresh_days, view='FULL')
-                        ref_auid = [ref_auth.auid for ref_auth in ref_ref.authors]
-                    except Scopus404Error:  # either ID is not known by scopus
-                        continue  # skip to next loop (next reference)
-                    except Scopus500Error:
-                        continue
-                    except TypeError:  # ID not present
-                        continue
-                    except JSONDecodeError:
-                        continue
-                    except Exception as e:  # try to find what type of exception
-                        print(e)
-                        print(type(e))
-
-                else:  # otherwise, if reference info is already present, just use this
-                    missing_key = False
-                    ref_ref = ab_ref.references[eid_ref.index(ref_full.id)]
-                    if ref_ref.authors_auid is not None:
-                        ref_auid = ref_ref.authors_auid.split(';')
-                    else:
-                        ref_auid = None
-
-                # print(ref_full.title)
-                title_cited[ref_idx] = ref_full.title
-                
-                if missing_key:
-                    journal_cited[ref_idx] = ref_ref.title  
-                    
-                    if ref_ref.authors is not None:
-                        num_auth_cited[ref_idx] = len(ref_ref.authors)
-                    
-                    if ref_ref.coverDate is not None:
-                        year_cited[ref_idx] = int(ref_ref.coverDate[:4])
-                else:
-                    journal_cited[ref_idx] = ref_ref.sourcetitle
-                    
-                    num_auth_cited[ref_idx] = ref_ref.authors.count(';') + 1
-                    
-                    year_cited[ref_idx] = ref_full.publicationyear
-                
-                date_cited[ref_idx] = ref_ref.coverDate
-                    
-
-                
-                
-
-                #********************** Self-citation - by AUID **********************
-                citing_auid = [int(citing_auth.auid) for citing_auth in ab_full.authors]
-                try:
-                    cited_auid = [int(cited_auid) for cited_auid in ref_auid]
-                    sc_by_auth = [1*(citing_auid_entry in cited_auid) for citing_auid_entry in citing_auid]          
-                    
-                    if sc_by_auth[0]==1:
-                        position_fa_sc[ref_idx] = np.where(np.array(cited_auid)==citing_auid[0])[0][0]
-                        
-                    if sc_by_auth[-1]==1:
-                        position_la_sc[ref_idx] = np.where(np.array(cited_auid)==citing_auid[-1])[0][0]
-                       
-                    sc_fa[ref_idx] = sc_by_auth[0]
-                    sc_la[ref_idx] = sc_by_auth[-1]
-                    sc_any[ref_idx] = sum(sc_by_auth)
-                    
-                
-                except AttributeError:
-                    pass  # if can't find any info, just leave as None
-                except TypeError:  # if no auid
-                    pass
-            
-                
-            
-            ######################## Author level traits ########################
-            auid_fa = [citing_auid[0]]*numref
-            auid_la = [citing_auid[-1]]*numref
-            
-            name_fa = [str(ab_full.authors[0].surname) + ', ' + str(ab_full.authors[0].given_name)]*numref  # do str() in case of None
-            name_la = [str(ab_full.authors[-1].surname) + ', ' + str(ab_full.authors[-1].given_name)]*numref
-            
-            
-            ######## get author data (first author)
-            try:
-                a_f = AuthorRetrieval(citing_auid[0], refresh=refresh_days)
-                a_f_retrieved_key = True
-                
-                # names (more detailed)
-                if a_f.given_name is not None:
-                    given_name_fa = [a_f.given_name]*numref
-                else:
-                    given_name_fa = [None]*numref
-                if a_f.surname is not None:
-                    surname_fa = [a_f.surname]*numref
-                else:
-                    surname_fa = [None]*numref
-            except Scopus404Error:  # skip
-                a_f_retrieved_key = False
-                given_name_fa = [None]*numref
-                surname_fa = [None]*numref
-            except Scopus500Error:
-                a_f_retrieved_key = False
-                given_name_fa = [None]*numref
-                surname_fa = [None]*numref
-                
-            try:
-                a_l = AuthorRetrieval(citing_auid[-1], refresh=refresh_days)
-                a_l_retrieved_key = True
-                
-                # names (more detailed)   
-                if a_l.given_name is not None:
-                    given_name_la = [a_l.given_name]*numref
-                else:
-                    given_name_la = [None]*numref
-                if a_l.surname is not None:
-                    surname_la = [a_l.surname]*numref
-                else:
-                    surname_la = [None]*numref              
-            except Scopus404Error:  # skip
-                a_l_retrieved_key = False
-                given_name_la = [None]*numref
-                surname_la = [None]*numref
-            except Scopus500Error:
-                a_l_retrieved_key = False
-                given_name_la = [None]*numref
-                surname_la = [None]*numref
-                
-
-                
-            ######## affiliation country - if multiple, take first (split by ; line)
-            if ab_full.authors[0].affiliation is not None:
-                try:
-                    affil_fa = AffiliationRetrieval(ab_full.authors[0].affiliation.split(';')[0], refresh=refresh_days)
-                    affil_name_fa = [affil_fa.affiliation_name]*numref
-                    affil_country_fa = [affil_fa.country]*numref
-                except Scopus404Error:
-                    affil_name_fa = [None]*numref
-                    affil_country_fa = [None]*numref
-                except Scopus500Error:
-                    affil_name_fa = [None]*numref
-                    affil_country_fa = [None]*numref
-            else:
-                affil_fa = [None]*numref
-                affil_name_fa = [None]*numref
-                affil_country_fa = [None]*numref
-            
-            
-            if ab_full.authors[-1].affiliation is not None:
-                try:
-                    affil_la = AffiliationRetrieval(ab_full.authors[-1].affiliation.split(';')[0], refresh=refresh_days)
-                    affil_name_la = [affil_la.affiliation_name]*numref
-                    affil_country_la = [affil_la.country]*numref
-                except Scopus404Error:
-                    affil_name_la = [None]*numref
-                    affil_country_la = [None]*numref
-                except Scopus500Error:
-                    affil_name_la = [None]*numref
-                    affil_country_la = [None]*numref
-            else:
-                affil_la = [None]*numref
-                affil_name_la = [None]*numref
-                affil_country_la = [None]*numref
-            
-            ######## academic age and previous papers
-            
-            # for first author
-            if a_f_retrieved_key:
-                if a_f.publication_range is not None:
-                    fa_tmp_starting_date = a_f.publication_range[0]
-                    fa_tmp_academic_age = int(ab_full.coverDate[:4]) - fa_tmp_starting_date
-                    try:
-                        docs = pd.DataFrame(a_f.get_documents())
-
-                        if docs.empty:  # if nothing found on author search
-                            kw_recent_fa_save = [None]*numref
-                            academic_age_fa = [None]*numref
-                            num_prev_papers_fa = [None]*numref
-                        else:
-                            # find keywords of 10 papers closest in time to published one
-                            d0 = date(int(ab_full.coverDate.split('-')[0]), int(ab_full.coverDate.split('-')[1]), int(ab_full.coverDate.split('-')[1]))
-                            # some months say 00 or days say 00 - replace with 01
-                            d1_all = [ date(int(coverDate.replace('-00', '-01').split('-')[0]),
-                                            int(coverDate.replace('-00', '-01').split('-')[1]),
-                                            int(coverDate.replace('-00', '-01').split('-')[1]))
-                                        for coverDate in docs['coverDate'] ]
-                            days_between = [(d1-d0).days for d1 in d1_all]
-                            sorted_date_idx = np.argsort(np.abs(days_between))  # sort closest articles to current (by date)
-                            kw_recent_fa = []
-                            kw_all = docs['authkeywords']
-                            for sorted_date_idx_tmp in sorted_date_idx:
-                                if kw_all[sorted_date_idx_tmp] is not None:
-                                    kw_recent_fa.append(kw_all[sorted_date_idx_tmp])
-                                if len(kw_recent_fa)==10:
-                                    break
-                            kw_recent_fa_save = [None]*numref
-                            kw_recent_fa_save[0] = ';;;;'.join(kw_recent_fa)
-                            academic_age_fa = [fa_tmp_academic_age]*numref
-                            # now find number of previous papers
-                            eids_fa = list(docs['eid'])
-                            try:
-                                matching_eid_idx = eids_fa.index(ab_full.eid)
-                                num_prev_papers_fa = [len( eids_fa[1+matching_eid_idx:] ) ]*numref
-                            except ValueError:  # if can't find matching eid (e.g., maybe inconsitencies in author id on scopus)
-                                num_prev_papers_fa = [np.sum(np.array(days_between)<0)]*numref
-                    except JSONDecodeError: 
-                        kw_recent_fa_save = [None]*numref
-                        academic_age_fa = [None]*numref
-                        num_prev_papers_fa = [None]*numref
-                    except Scopus500Error: 
-                        kw_recent_fa_save = [None]*numref
-                        academic_age_fa = [None]*numref
-                        num_prev_papers_fa = [None]*numref   
-                else:
-                    kw_recent_fa_save = [None]*numref
-                    academic_age_fa = [None]*numref
-                    num_prev_papers_fa = [None]*numref
-            else:
-                kw_recent_fa_save = [None]*numref
-                academic_age_fa = [None]*numref
-                num_prev_papers_fa = [None]*numref
- 
-            # for last author
-            if a_f_retrieved_key:
-                if a_l.publication_range is not None:
-                    la_tmp_starting_date = a_l.publication_range[0]
-                    la_tmp_academic_age = int(ab_full.coverDate[:4]) - la_tmp_starting_date
-                    try:
-                        docs = pd.DataFrame(a_l.get_documents())
-
-                        if docs.empty:
-                            kw_recent_la_save = [None]*numref
-                            academic_age_la = [None]*numref
-                            num_prev_papers_la = [None]*numref
-                        else:
-                            # find keywords of 10 papers closest in time to published one
-                            d0 = date(int(ab_full.coverDate.split('-')[0]), int(ab_full.coverDate.split('-')[1]), int(ab_full.coverDate.split('-')[1]))
-                            # some months say 00 or days say 00 - replace with 01
-                            d1_all = [ date(int(coverDate.replace('-00', '-01').split('-')[0]),
-                                            int(coverDate.replace('-00', '-01').split('-')[1]),
-                                            int(coverDate.replace('-00', '-01').split('-')[1]))
-                                    for coverDate in docs['coverDate'] ]
-
-                            days_between = [(d1-d0).days for d1 in d1_all]
-                            sorted_date_idx = np.argsort(np.abs(days_between))  # sort closest articles to current (by date)
-                            kw_recent_la = []
-                            kw_all = docs['authkeywords']
-                            for sorted_date_idx_tmp in sorted_date_idx:
-                                if kw_all[sorted_date_idx_tmp] is not None:
-                                    kw_recent_la.append(kw_all[sorted_date_idx_tmp])
-                                if len(kw_recent_la)==10:
-                                    break
-                            kw_recent_la_save = [None]*numref
-                            kw_recent_la_save[0] = ';;;;'.join(kw_recent_la)
-                            academic_age_la = [la_tmp_academic_age]*numref
-                            # now find number of previous papers
-                            eids_la = list(docs['eid'])
-                            try:
-                                matching_eid_idx = eids_la.index(ab_full.eid)
-                                num_prev_papers_la = [len( eids_la[1+matching_eid_idx:] ) ]*numref
-                            except ValueError:  # if can't find matching eid (e.g., maybe inconsitencies in author id on scopus)
-                                num_prev_papers_la = [np.sum(np.array(days_between)<0)]*numref
-                    except JSONDecodeError:
-                        kw_recent_la_save = [None]*numref
-                        academic_age_la = [None]*numref
-                        num_prev_papers_la = [None]*numref
-                    except Scopus500Error:
-                        kw_recent_la_save = [None]*numref
-                        academic_age_la = [None]*numref
-                        num_prev_papers_la = [None]*numref   
-
-                else:  # if no author dates
-                    kw_recent_la_save = [None]*numref
-                    academic_age_la = [None]*numref
-                    num_prev_papers_la = [None]*numref   
-            else:
-                kw_recent_la_save = [None]*numref
-                academic_age_la = [None]*numref
-                num_prev_papers_la = [None]*numref   
-            
-            
-            ######################## Update dataframe ########################
-            df_entry = pd.DataFrame({'eid_citing':eid_citing,
-                                     'title_citing':title_citing,'title_cited':title_cited,
-                                     'document_type':document_type,
-                                     'journal_citing':journal_citing, 'journal_cited':journal_cited, 
-                                     'date_citing':date_citing, 'date_cited':date_cited, 
-                                     'year_citing':year_citing, 'year_cited':year_cited,
-                                     'num_auth_citing':num_auth_citing, 'num_auth_cited':num_auth_cited, 
-                                     'num_ref_citing':num_ref_citing,
-                                     'sc_fa':sc_fa,'sc_la':sc_la, 'sc_any':sc_any,
-                                     'position_fa_sc':position_fa_sc, 'position_la_sc':position_la_sc,
-                                     'affil_name_fa':affil_name_fa, 'affil_name_la':affil_name_la,
-                                     'affil_country_fa':affil_country_fa, 'affil_country_la':affil_country_la,
-                                     'academic_age_fa':academic_age_fa, 'academic_age_la':academic_age_la,
-                                     'num_prev_papers_fa':num_prev_papers_fa, 'num_prev_papers_la':num_prev_papers_la,
-                                     'kw_recent_fa':kw_recent_fa_save, 'kw_recent_la':kw_recent_la_save,
-                                     'auid_fa':auid_fa , 'auid_la':auid_la ,
-                                     'name_fa':name_fa , 'name_la':name_la,
-                                     'surname_fa':surname_fa, 'surname_la':surname_la,
-                                     'given_name_fa':given_name_fa, 'given_name_la':given_name_la})
-            df_year = df_year.append(df_entry, ignore_index=True)
-        
-        df_year.to_csv(os.path.join('/data_dustin/store3/training/matt/self_citation/results_1_2024/', journal_name + str(year) + '.csv'),
-                                    index=False)
-        
-    
-
-
-
-
+        units.append((field_name, journal_name, year))
 
+progress = ProgressAggregator()
+progress_queue = None
+if jobs == 1:
+    for unit in units:
+        process_journal_year(*unit)
+        progress.unit_done()
+else:
+    # fork so workers share the functions and settings above without re-running the script
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Manager().Queue()
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=ctx, initializer=init_worker, initargs=(queue,)) as executor:
+        futures = {executor.submit(process_journal_year, *unit): unit for unit in units}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=5)
+            while not queue.empty():
+                progress.update(*queue.get())
+            for future in done:
+                future.result()  # raise errors from the worker
+                progress.unit_done()
+            progress.report()
+progress.report(force=True)
@@ -0,0 +1,249 @@
+# Block bootstrap for bootstrap_analysis.ipynb, without resampling the article table
+#
+# The notebook draws exchangeability blocks with np.random.seed(seed); np.random.choice(...) and keeps the
+# articles whose block was drawn (df['eb'].isin(eb_boot)), then sums sc_count and numref per group.
+# Here sc_count, numref, ... are summed once per (block, group), and each replicate is a vector of block weights,
+# so the group sums of all replicates are one matrix product: weights (replicates x blocks) @ sums (blocks x groups).
+#
+#   boot = BlockBootstrap(df)
+#   results = notebook_statistics(boot, seeds=range(1000), num_topics=13)
+#   results['r_boot'], results['sc_rates'], ...
+#
+# This covers all arrays of the notebook's boot_results.npz except the num_papers_* ones (self-citation by number of
+# earlier papers), which are lists of different length per replicate and are still computed by the notebook loop.
+#
+# Requirements:
+#   numpy, pandas, scipy
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+recent_years = [2016, 2017, 2018, 2019, 2020]
+fields = ['Neurology', 'Neuroscience', 'Psychiatry']
+sc_types = ['FA', 'LA', 'Any']
+genders = ['Female', 'Male']
+
+
+def block_weights(nblocks, seeds, multiplicity=False):
+    # block weights of each replicate (replicates x blocks), drawn like the notebook does for each seed:
+    # 1 if the block was drawn at all (the notebook's isin), or with multiplicity=True how often it was drawn
+    # each replicate only depends on its own seed, so any range of seeds can be computed separately
+    weights = np.zeros((len(seeds), nblocks))
+    for i, seed in enumerate(seeds):
+        np.random.seed(seed)
+        drawn = np.random.choice(nblocks, size=nblocks, replace=True)
+        counts = np.bincount(drawn, minlength=nblocks)
+        weights[i] = counts if multiplicity else counts > 0
+    return weights
+
+
+class BlockBootstrap:
+
+    def __init__(self, df, block_col='eb'):
+        self.df = df
+        self.blocks = df[block_col].unique()  # same order as in the notebook, which the random draws depend on
+        self.block_idx = pd.Index(self.blocks).get_indexer(df[block_col])
+        self.nblocks = len(self.blocks)
+
+    def weights(self, seeds, multiplicity=False):
+        return block_weights(self.nblocks, seeds, multiplicity)
+
+    def aggregate(self, by, values=('sc_count', 'numref'), mask=None):
+        # sum values per (block, group) of the articles in mask
+        # returns the groups (DataFrame of the `by` columns, sorted) and {value: sparse blocks x groups matrix}
+        df = self.df if mask is None else self.df[mask]
+        block_idx = self.block_idx if mask is None else self.block_idx[np.asarray(mask)]
+        keys = pd.MultiIndex.from_frame(df[list(by)])
+        groups = keys.unique().sort_values()  # groupby order
+        group_idx = groups.get_indexer(keys)
+        sums = {}
+        for value in values:
+            sums[value] = sparse.csr_matrix((df[value].to_numpy(dtype=float), (block_idx, group_idx)),
+                                            shape=(self.nblocks, len(groups)))  # duplicates are summed
+        return groups.to_frame(index=False), sums
+
+    @staticmethod
+    def replicate_sums(weights, sums):
+        # {value: replicates x groups} sums for every replicate
+        return {value: np.asarray((matrix.T @ weights.T).T) for value, matrix in sums.items()}
+
+
+def select(groups, sums, **conditions):
+    # columns of the replicate sums for the groups matching all conditions (column=value), in group order
+    keep = np.ones(len(groups), dtype=bool)
+    for col, value in conditions.items():
+        keep &= (groups[col] == value).to_numpy()
+    return {key: value[:, keep] for key, value in sums.items()}
+
+
+def sort_by_topic(table):
+    # groups ordered by integer topic (topics may be read as strings), then by the other columns
+    groups, sums = table
+    groups['topic'] = [int(t) for t in groups['topic']]
+    order = np.lexsort([groups[col].to_numpy() for col in reversed(groups.columns)])
+    return groups.iloc[order].reset_index(drop=True), {key: value[:, order] for key, value in sums.items()}
+
+
+def correlation_and_slope(x, y):
+    # Pearson r and least squares slope of each row of y against x (same as pandas corr and scipy linregress)
+    xc = x - x.mean()
+    yc = y - y.mean(axis=1, keepdims=True)
+    sxy = yc @ xc
+    r = sxy / np.sqrt((xc @ xc) * np.sum(yc**2, axis=1))
+    return r, sxy / (xc @ xc)
+
+
+def notebook_statistics(boot, seeds, num_topics=13, ac_age_to_keep=np.arange(0, 39), chunk_size=64,
+                        fa_countries_to_keep=None, la_countries_to_keep=None, multiplicity=False):
+    # the bootstrap arrays of bootstrap_analysis.ipynb (same names and shapes) for the given seeds
+    spec = prepare_statistics(boot, num_topics, ac_age_to_keep, fa_countries_to_keep, la_countries_to_keep)
+    results = compute_statistics(spec, seeds, chunk_size, multiplicity)
+    results['ac_age_to_keep'] = spec['ac_age_to_keep']
+    results['fa_countries_to_keep'] = spec['fa_countries_to_keep']
+    results['la_countries_to_keep'] = spec['la_countries_to_keep']
+    return results
+
+
+def prepare_statistics(boot, num_topics=13, ac_age_to_keep=np.arange(0, 39),
+                       fa_countries_to_keep=None, la_countries_to_keep=None):
+    # block x group sums and settings the statistics are computed from (no articles needed afterwards)
+    df = boot.df
+    recent = df.Year.isin(recent_years).to_numpy()
+
+    # countries - same selection as in the notebook
+    if fa_countries_to_keep is None:
+        s = df[df['SC Type']=='FA']['affil_country'].value_counts()
+        fa_countries_to_keep = sorted(country for country in s[s>=50].index if country!='Error')
+    if la_countries_to_keep is None:
+        s = df[df['SC Type']=='LA']['affil_country'].value_counts()
+        la_countries_to_keep = sorted(country for country in s[s>=50].index if country!='Error')
+
+    # the notebook leaves out 'Error' genders; groupby also leaves out missing ones (names below 80% probability),
+    # but they still count in the papers of a topic
+    known_gender = (df['gender_binary']!='Error').to_numpy()
+    gender = known_gender & df['gender_binary'].notna().to_numpy()
+    topic = recent & (df['topic'].astype(str)!='Error').to_numpy()
+
+    # pre-aggregate per block and group
+    tables = {
+        'recent': boot.aggregate(['field', 'SC Type'], mask=recent & df['field'].isin(fields).to_numpy()),
+        'year': boot.aggregate(['Year', 'SC Type'], values=('sc_count', 'numref', 'numpapers')),
+        'ac_age': boot.aggregate(['SC Type', 'ac_age'], values=('sc_count', 'numref', 'papers_before_by_date'),
+                                 mask=recent & df.ac_age.isin(ac_age_to_keep).to_numpy()),
+        'topic': sort_by_topic(boot.aggregate(['topic', 'SC Type'], mask=topic)),
+        'country': boot.aggregate(['SC Type', 'affil_country'], values=('sc_count', 'numref', 'numpapers'),
+                                  mask=(((df['SC Type']=='FA') & df.affil_country.isin(fa_countries_to_keep)) |
+                                        ((df['SC Type']=='LA') & df.affil_country.isin(la_countries_to_keep))).to_numpy()),
+        # gender: proportions of papers are out of all papers of a year, but out of the papers without an 'Error'
+        # gender of a topic
+        'gender_year': boot.aggregate(['SC Type', 'gender_binary', 'Year'], values=('sc_count', 'numref', 'numpapers'),
+                                      mask=gender),
+        'gender_topic': sort_by_topic(boot.aggregate(['topic', 'SC Type', 'gender_binary'],
+                                                     values=('sc_count', 'numref', 'numpapers'), mask=topic & gender)),
+        'gender_topic_total': sort_by_topic(boot.aggregate(['topic', 'SC Type'], values=('numpapers',),
+                                                           mask=topic & known_gender)),
+        'gender_ac_age': boot.aggregate(['ac_age', 'gender_binary'],
+                                        mask=recent & gender & df.ac_age.isin(ac_age_to_keep).to_numpy()),
+    }
+    years = np.sort(df['Year'].unique()).astype(float)
+    return {'tables': tables, 'years': years, 'nblocks': boot.nblocks, 'num_topics': num_topics,
+            'ac_age_to_keep': ac_age_to_keep,
+            'fa_countries_to_keep': fa_countries_to_keep, 'la_countries_to_keep': la_countries_to_keep}
+
+
+def result_shapes(spec, nboot):
+    nages, ncountries_fa, ncountries_la = len(spec['ac_age_to_keep']), len(spec['fa_countries_to_keep']), len(spec['la_countries_to_keep'])
+    num_topics, nyears = spec['num_topics'], len(spec['years'])
+    shapes = {
+        'fa_recent_sc': (nboot, 4), 'la_recent_sc': (nboot, 4), 'any_recent_sc': (nboot, 4),
+        'r_boot': (nboot, 3), 'm_boot': (nboot, 3), 'sc_rates': (nboot, len(spec['years']), 3),
+        'fa_ac_age_sc': (nboot, nages), 'la_ac_age_sc': (nboot, nages),
+        'fa_ac_age_sc_normed': (nboot, nages), 'la_ac_age_sc_normed': (nboot, nages),
+        'topic_fa_sc': (nboot, num_topics), 'topic_la_sc': (nboot, num_topics), 'topic_any_sc': (nboot, num_topics),
+        'fa_sc_rate_country': (nboot, ncountries_fa), 'la_sc_rate_country': (nboot, ncountries_la),
+        'fa_numpapers_country': (nboot, ncountries_fa), 'la_numpapers_country': (nboot, ncountries_la),
+        'perc_female_fa_la_topic': (nboot, num_topics, 2),
+    }
+    for gender in genders:
+        gender = gender.lower()
+        shapes['ac_age_gender_sc_' + gender] = (nboot, nages)
+        for prefix in ['fa', 'la']:
+            shapes['topic_gender_sc_{:s}_{:s}'.format(prefix, gender)] = (nboot, num_topics)
+            shapes['time_gender_sc_{:s}_{:s}'.format(prefix, gender)] = (nboot, nyears)
+            shapes['time_gender_proportion_{:s}_{:s}'.format(prefix, gender)] = (nboot, nyears)
+    return shapes
+
+
+def compute_statistics(spec, seeds, chunk_size=64, multiplicity=False):
+    # bootstrap arrays (replicates in seed order) from prepare_statistics() output
+    tables, years = spec['tables'], spec['years']
+    seeds = list(seeds)
+    nboot = len(seeds)
+    results = {name: np.zeros(shape) for name, shape in result_shapes(spec, nboot).items()}
+
+    for start in range(0, nboot, chunk_size):
+        rows = slice(start, start + chunk_size)
+        weights = block_weights(spec['nblocks'], seeds[rows], multiplicity=multiplicity)
+        sums = {name: (groups, BlockBootstrap.replicate_sums(weights, matrices)) for name, (groups, matrices) in tables.items()}
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # descriptive stats (2016-2020): overall and by field
+            groups, s = sums['recent']
+            for auth_type, name in zip(sc_types, ['fa_recent_sc', 'la_recent_sc', 'any_recent_sc']):
+                t = select(groups, s, **{'SC Type': auth_type})
+                results[name][rows, 0] = t['sc_count'].sum(axis=1) / t['numref'].sum(axis=1)
+                for i, field in enumerate(fields):
+                    t = select(groups, s, **{'SC Type': auth_type, 'field': field})
+                    results[name][rows, i+1] = t['sc_count'][:, 0] / t['numref'][:, 0]
+
+            # self-citation over time, correlation and slope with year
+            groups, s = sums['year']
+            for auth_idx, auth_type in enumerate(sc_types):
+                t = select(groups, s, **{'SC Type': auth_type})
+                sc_rate = t['sc_count'] / t['numref']
+                results['sc_rates'][rows, :, auth_idx] = sc_rate
+                results['r_boot'][rows, auth_idx], results['m_boot'][rows, auth_idx] = correlation_and_slope(years, sc_rate)
+
+            # academic age (2016-2020)
+            groups, s = sums['ac_age']
+            for auth_type, prefix in [('FA', 'fa'), ('LA', 'la')]:
+                t = select(groups, s, **{'SC Type': auth_type})
+                results[prefix + '_ac_age_sc'][rows] = t['sc_count'] / t['numref']
+                results[prefix + '_ac_age_sc_normed'][rows] = t['sc_count'] / t['papers_before_by_date']
+
+            # topics (2016-2020)
+            groups, s = sums['topic']
+            for auth_type, name in zip(sc_types, ['topic_fa_sc', 'topic_la_sc', 'topic_any_sc']):
+                t = select(groups, s, **{'SC Type': auth_type})
+                results[name][rows] = t['sc_count'] / t['numref']
+
+            # countries
+            groups, s = sums['country']
+            for auth_type, prefix in [('FA', 'fa'), ('LA', 'la')]:
+                t = select(groups, s, **{'SC Type': auth_type})
+                results[prefix + '_sc_rate_country'][rows] = t['sc_count'] / t['numref']
+                results[prefix + '_numpapers_country'][rows] = t['numpapers']
+
+            # gender over time, by topic (2016-2020) and by academic age (2016-2020)
+            groups, s = sums['gender_year']
+            year_groups, year_sums = sums['year']
+            topic_groups, topic_sums = sums['gender_topic']
+            total_groups, total_sums = sums['gender_topic_total']
+            for auth_idx, (auth_type, prefix) in enumerate([('FA', 'fa'), ('LA', 'la')]):
+                papers_year = select(year_groups, year_sums, **{'SC Type': auth_type})['numpapers']
+                papers_topic = select(total_groups, total_sums, **{'SC Type': auth_type})['numpapers']
+                for gender in genders:
+                    suffix = '{:s}_{:s}'.format(prefix, gender.lower())
+                    t = select(groups, s, **{'SC Type': auth_type, 'gender_binary': gender})
+                    results['time_gender_sc_' + suffix][rows] = t['sc_count'] / t['numref']
+                    results['time_gender_proportion_' + suffix][rows] = t['numpapers'] / papers_year
+                    t = select(topic_groups, topic_sums, **{'SC Type': auth_type, 'gender_binary': gender})
+                    results['topic_gender_sc_' + suffix][rows] = t['sc_count'] / t['numref']
+                    if gender=='Female':
+                        results['perc_female_fa_la_topic'][rows, :, auth_idx] = t['numpapers'] / papers_topic
+            groups, s = sums['gender_ac_age']
+            for gender in genders:
+                t = select(groups, s, gender_binary=gender)
+                results['ac_age_gender_sc_' + gender.lower()][rows] = t['sc_count'] / t['numref']
+
+    return results
@@ -0,0 +1,228 @@
+# Fast loading of the article and model data tables
+#
+# pd.read_excel('./self_citation_data.xlsx') is slow and keeps columns like field, SC Type and affil_country as
+# Python strings. load_table() reads a workbook or csv once and saves it as a typed Parquet file with categorical
+# (dictionary encoded) text columns, named after the hash of the source file and of the pd.read_excel / pd.read_csv
+# arguments, so the cache is rebuilt whenever the source changes. Later loads are memory-mapped and can read only some
+# columns and rows:
+#
+#   df = load_table('./self_citation_data.xlsx')
+#   df_recent = load_table('./self_citation_data.xlsx', columns=['Year', 'SC Type', 'sc_count', 'numref'],
+#                          filters=[('Year', 'in', [2016, 2017, 2018, 2019, 2020])])
+#   df_seeds = load_table('./model_100_seed_results.csv', index_col=0)
+#
+# Sources can also be URLs (e.g. the data on GitHub, for the Colab notebooks). They are downloaded once into the cache
+# folder of the current directory; remove the .url_* file there to download again.
+#
+# Note: groupby on categorical columns also returns groups that do not occur (unless observed=True), so pass
+# categorical=False to get plain columns for code written for pd.read_excel.
+#
+# Requirements:
+#   pandas (and openpyxl for .xlsx)
+#   optional: pyarrow (pip install pyarrow) for the Parquet cache; without it the cache is a pickle file
+import hashlib
+import json
+import os
+import re
+import urllib.request
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+cache_folder = '.table_cache'
+
+
+def file_hash(path):
+    # sha256 of the file contents, remembered by size and modification time so unchanged files are not re-read
+    stat = os.stat(path)
+    key_path = os.path.join(os.path.dirname(os.path.abspath(path)), cache_folder, os.path.basename(path) + '.hash.json')
+    if os.path.exists(key_path):
+        with open(key_path) as f:
+            key = json.load(f)
+        if key['size'] == stat.st_size and key['mtime'] == stat.st_mtime:
+            return key['sha256']
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    os.makedirs(os.path.dirname(key_path), exist_ok=True)
+    with open(key_path, 'w') as f:
+        json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha.hexdigest()}, f)
+    return sha.hexdigest()
+
+
+def is_url(path):
+    return path.startswith('http://') or path.startswith('https://')
+
+
+def local_copy(url):
+    # path of a downloaded copy of url, downloaded if not there yet
+    name = url.split('?')[0].rstrip('/').split('/')[-1]
+    target = os.path.join(cache_folder, '.url_' + hashlib.sha256(url.encode()).hexdigest()[:16], name)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = target + '.tmp'
+        with urllib.request.urlopen(url) as response, open(tmp_path, 'wb') as f:
+            for block in iter(lambda: response.read(2**20), b''):
+                f.write(block)
+        os.replace(tmp_path, target)
+    return target
+
+
+def kwds_hash(read_kwds):
+    # hash of the read arguments (order does not matter), '' without arguments
+    if not read_kwds:
+        return ''
+    normalized = json.dumps({key: list(value) if isinstance(value, (tuple, set)) else value
+                             for key, value in read_kwds.items()}, sort_keys=True, default=repr)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def read_source(path, **read_kwds):
+    if path.endswith('.xlsx') or path.endswith('.xls'):
+        return pd.read_excel(path, **read_kwds)
+    return pd.read_csv(path, **read_kwds)
+
+
+def value_types(series):
+    return set(type(value) for value in series.dropna())
+
+
+def to_typed(df, max_category_fraction=0.5):
+    # text columns with repeated values become categorical; returns the frame and the names of columns
+    # that mix text and numbers (e.g. 'Error' among topic numbers), which are saved as text in Parquet
+    df = df.copy()
+    mixed = []
+    for col in df.columns:
+        if df[col].dtype != object and not pd.api.types.is_string_dtype(df[col]):
+            continue
+        types = value_types(df[col])
+        if len(types) > 1:
+            mixed.append(col)
+            if pa is not None:
+                df[col] = df[col].map(lambda value: value if pd.isna(value) else str(value))
+        if df[col].nunique() <= max_category_fraction*len(df):
+            df[col] = df[col].astype('category')
+    return df, mixed
+
+
+def restore_value(value):
+    # numbers of mixed columns were saved as text
+    if not isinstance(value, str):
+        return value
+    try:
+        if str(int(value)) == value:
+            return int(value)
+    except ValueError:
+        pass
+    try:
+        if str(float(value)) == value:
+            return float(value)
+    except ValueError:
+        pass
+    return value
+
+
+def cache_path(path, source_hash, read_kwds=None):
+    # one cache file per version of the source and read arguments (e.g. index_col, sheet_name)
+    ext = '.parquet' if pa is not None else '.pkl'
+    kwds_part = kwds_hash(read_kwds)
+    return os.path.join(os.path.dirname(os.path.abspath(path)), cache_folder,
+                        os.path.basename(path) + '.' + source_hash[:16] + ('.' + kwds_part[:16] if kwds_part else '') + ext)
+
+
+def build_cache(path, **read_kwds):
+    # convert the source table to a typed cache file (once per version of the source), returns the cache path
+    if is_url(path):
+        path = local_copy(path)
+    source_hash = file_hash(path)
+    target = cache_path(path, source_hash, read_kwds)
+    if os.path.exists(target):
+        return target
+    df = read_source(path, **read_kwds)
+    index = {}
+    if pa is not None and not (isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1):
+        # index from index_col=..., saved as columns
+        index = {'columns': ['__index_{:d}__'.format(i) for i in range(df.index.nlevels)], 'names': list(df.index.names)}
+        df.index = df.index.set_names(index['columns'])
+        df = df.reset_index()
+    df, mixed = to_typed(df)
+    tmp_path = target + '.tmp'
+    if pa is not None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'data_cache'] = json.dumps({'source': os.path.basename(path), 'mixed_columns': mixed,
+                                              'index': index}, default=str).encode()
+        pq.write_table(table.replace_schema_metadata(metadata), tmp_path)
+    else:
+        df.to_pickle(tmp_path)
+    os.replace(tmp_path, target)
+    # remove caches of earlier versions of the source (caches of this version with other read arguments are kept)
+    # (only names cache_path gives this source, so e.g. the caches of x.csv.bak.csv are kept when x.csv changes)
+    folder = os.path.dirname(target)
+    cache_name = re.compile(re.escape(os.path.basename(path)) + r'\.([0-9a-f]{16})(\.[0-9a-f]{16})?\.(parquet|pkl)')
+    for name in os.listdir(folder):
+        match = cache_name.fullmatch(name)
+        if match and match.group(1) != source_hash[:16]:
+            os.remove(os.path.join(folder, name))
+    return target
+
+
+def apply_filters(df, filters):
+    # same filter format as pyarrow / pd.read_parquet: [(column, op, value), ...], all must hold
+    ops = {'==': lambda s, v: s == v, '=': lambda s, v: s == v, '!=': lambda s, v: s != v,
+           '<': lambda s, v: s < v, '<=': lambda s, v: s <= v, '>': lambda s, v: s > v, '>=': lambda s, v: s >= v,
+           'in': lambda s, v: s.isin(v), 'not in': lambda s, v: ~s.isin(v)}
+    keep = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        keep &= ops[op](df[col], value)
+    return df[keep].reset_index(drop=True)
+
+
+def load_table(path, columns=None, filters=None, categorical=True, **read_kwds):
+    # the table at path (.xlsx or .csv, file or URL) from its cache, only the given columns and rows matching filters
+    # (list of (column, op, value) with op one of ==, !=, <, <=, >, >=, in, not in)
+    # read_kwds are passed to pd.read_excel / pd.read_csv when the cache is built
+    target = build_cache(path, **read_kwds)
+    if pa is not None:
+        metadata = json.loads((pq.read_schema(target).metadata or {}).get(b'data_cache', b'{}'))
+        index = metadata.get('index') or {}
+        if columns is not None:
+            columns = index.get('columns', []) + list(columns)
+        table = pq.read_table(target, columns=columns, filters=filters, memory_map=True)
+        df = table.to_pandas()
+        for col in metadata.get('mixed_columns', []):
+            if col in df.columns:
+                is_category = isinstance(df[col].dtype, pd.CategoricalDtype)
+                df[col] = df[col].astype(object).map(restore_value)
+                if is_category:
+                    df[col] = df[col].astype('category')
+        if index:
+            for col in index['columns']:
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    df[col] = df[col].astype(df[col].cat.categories.dtype)
+            df = df.set_index(index['columns'])
+            df.index = df.index.set_names(index['names'])
+    else:
+        df = pd.read_pickle(target)
+        if filters:
+            df = apply_filters(df, filters)
+        if columns is not None:
+            df = df[list(columns)]
+    if not categorical:
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
+
+
+if __name__ == '__main__':
+    # build the caches ahead of time, e.g. python data_cache.py self_citation_data.xlsx ../model_data_analysis/data/*.csv
+    import sys
+    for source in sys.argv[1:]:
+        print(source + ' -> ' + build_cache(source))
@@ -6,17 +6,27 @@
 #   https://github.com/pybliometrics-dev/pybliometrics/issues/191
 
 from pybliometrics.scopus import AbstractRetrieval, AuthorRetrieval
+from pybliometrics.scopus.exception import Scopus429Error
 import pandas as pd
 from tqdm import tqdm
-from util_functions import clean_author_str
+from util_functions import clean_author_str, AuthorProfiles, papers_before
 import unidecode
 import numpy as np
 import os
+import sys
 import glob
 import re
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from scopus_tools.record_store import RecordStore
+from scopus_tools.key_scheduler import KeyScheduler, QuotaExhaustedError
+from scopus_tools.metrics import Metrics
 
 
 refresh_days = 365 
+metrics = Metrics()  # retrieval latency, store hits and errors, stage timings; saved next to the results of each journal-year
+scheduler = KeyScheduler(state_path='../key_quota.json', metrics=metrics)  # spread downloads over all API keys in the pybliometrics config
+store = RecordStore('../scopus_records.db', fetch=scheduler.fetch, metrics=metrics)  # downloaded records for all journals, in a single file
+author_profiles = AuthorProfiles(lambda auid: store.retrieve(AuthorRetrieval, auid, refresh=refresh_days))  # shared by all journals and years
 
 dir_list = []
 for field_name in ['Neuro', 'Neurology', 'Psychiatry']:
@@ -35,12 +45,14 @@ for dir_name in dir_list:
     print(years)
 
     for year in years:
+        metrics.reset()
         fa_given_update=[]; la_given_update=[]
         fa_start_date = []; la_start_date = []
         fa_academic_age = []; la_academic_age = []
         fa_papers_before = []; la_papers_before = []
         # read in main set of articles
-        df_results = pd.read_excel('../' + field_name + '/' + journal_name + '/results_' + journal_name + str(year) + '.xlsx')
+        with metrics.stage('read results'):
+            df_results = pd.read_excel('../' + field_name + '/' + journal_name + '/results_' + journal_name + str(year) + '.xlsx')
         nentries = df_results.shape[0]
         print('Total entries: ' + '{:d}'.format(nentries))
 
@@ -51,27 +63,20 @@ for dir_name in dir_list:
             auth_ids = auth_ids.split(';')[:-1]  # removes final semicolon
 
             try:
-                a_f=AuthorRetrieval(int(auth_ids[0]), refresh=refresh_days)
-                a_l=AuthorRetrieval(int(auth_ids[-1]), refresh=refresh_days)
+                # author information is downloaded once per author and reused for all their papers
+                with metrics.stage('author profiles (with downloads)'):
+                    profile_f = author_profiles.get(int(auth_ids[0]))
+                    profile_l = author_profiles.get(int(auth_ids[-1]))
+                if profile_f is None or profile_l is None:
+                    raise ValueError('author information not available')
+                fa_given_tmp, fa_tmp_starting_date, fa_pub_years = profile_f
+                la_given_tmp, la_tmp_starting_date, la_pub_years = profile_l
 
-                fa_given_tmp = a_f.given_name
-                la_given_tmp = a_l.given_name
-
-                fa_tmp_starting_date = a_f.publication_range[0]
                 fa_tmp_academic_age = year - fa_tmp_starting_date
-
-                all_docs = a_f.get_documents()
-                docs = pd.DataFrame(a_f.get_documents())
-                pub_years = docs['coverDate'].str[:4]
-                pub_years = np.array([int(y) for y in pub_years])
-                fa_papers_before.append(len(pub_years[pub_years<year]))
-
-                la_tmp_starting_date = a_l.publication_range[0]
                 la_tmp_academic_age = year - la_tmp_starting_date
-                docs = pd.DataFrame(a_l.get_documents())
-                pub_years = docs['coverDate'].str[:4]
-                pub_years = np.array([int(y) for y in pub_years])
-                la_papers_before.append(len(pub_years[pub_years<year]))
+
+                fa_papers_before.append(papers_before(fa_pub_years, year))
+                la_papers_before.append(papers_before(la_pub_years, year))
 
                 fa_given_update.append(fa_given_tmp)
                 la_given_update.append(la_given_tmp)
@@ -80,6 +85,8 @@ for dir_name in dir_list:
                 la_start_date.append(la_tmp_starting_date)
                 la_academic_age.append(la_tmp_academic_age)
 
+            except (QuotaExhaustedError, Scopus429Error):
+                raise  # no API key left, the rest of the run would only give errors
             except:
                 fa_given_update.append('Error')
                 la_given_update.append('Error')
@@ -101,5 +108,9 @@ for dir_name in dir_list:
         df_results['fa_papers_before'] = fa_papers_before
         df_results['la_papers_before'] = la_papers_before
         # df_results['la_papers_before'] = la_papers_before
-        df_results.to_csv('../' + field_name + '/' + journal_name + '/results_gendernames_' + journal_name + str(year) + '.csv')
+        with metrics.stage('write results'):
+            df_results.to_csv('../' + field_name + '/' + journal_name + '/results_gendernames_' + journal_name + str(year) + '.csv')
+        metrics.write('../' + field_name + '/' + journal_name + '/metrics_gendernames_' + journal_name + str(year),
+                      labels={'script': 'get_auth_info', 'journal': journal_name, 'year': year})
+        print('Author profiles: {:d} downloaded, {:d} reused'.format(author_profiles.misses, author_profiles.hits))
 
@@ -0,0 +1,106 @@
+# Run the block bootstrap (block_bootstrap.py) on several cores
+#
+# The block x group sums are put in shared memory once, so worker processes read them without a copy.
+# Seeds are split into ranges; replicate i always uses np.random.seed(seeds[i]) (like the notebook),
+# so results do not depend on the number of workers or on how the seeds are split.
+#
+#   spec = prepare_statistics(BlockBootstrap(df), num_topics=13)
+#   results = parallel_statistics(spec, seeds=range(10000), workers=8)
+#   save_boot_results('./boot_results.npz', results)
+#
+# Requirements:
+#   numpy, pandas, scipy
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+from block_bootstrap import compute_statistics, result_shapes
+
+_spec = None  # block x group sums of a worker process, attached to shared memory
+_attached = []
+
+
+def share_array(array, handles):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    handles.append(shm)
+    return (shm.name, array.dtype.str, array.shape)
+
+
+def attach_array(desc):
+    name, dtype, shape = desc
+    # workers share the resource tracker of the main process, which removes the memory in parallel_statistics()
+    shm = shared_memory.SharedMemory(name=name)
+    _attached.append(shm)  # keep the memory mapped as long as the arrays are used
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def share_spec(spec, handles):
+    # copy of spec with the sparse matrices replaced by descriptions of shared memory arrays
+    shared = dict(spec)
+    shared['tables'] = {}
+    for name, (groups, matrices) in spec['tables'].items():
+        shared['tables'][name] = (groups, {value: (matrix.shape, [share_array(array, handles) for array in
+                                                                  (matrix.data, matrix.indices, matrix.indptr)])
+                                           for value, matrix in matrices.items()})
+    return shared
+
+
+def attach_spec(shared):
+    spec = dict(shared)
+    spec['tables'] = {}
+    for name, (groups, matrices) in shared['tables'].items():
+        spec['tables'][name] = (groups, {value: sparse.csr_matrix(tuple(attach_array(desc) for desc in descs), shape=shape, copy=False)
+                                         for value, (shape, descs) in matrices.items()})
+    return spec
+
+
+def init_worker(shared):
+    global _spec
+    _spec = attach_spec(shared)
+
+
+def run_seeds(seeds, chunk_size, multiplicity):
+    return compute_statistics(_spec, seeds, chunk_size, multiplicity)
+
+
+def parallel_statistics(spec, seeds, workers=None, chunk_size=64, tasks_per_worker=4, multiplicity=False):
+    # same as compute_statistics(spec, seeds), with the seeds split over worker processes
+    seeds = list(seeds)
+    workers = workers if workers is not None else os.cpu_count()
+    results = {name: np.zeros(shape) for name, shape in result_shapes(spec, len(seeds)).items()}
+    ntasks = min(len(seeds), workers*tasks_per_worker)
+    bounds = np.linspace(0, len(seeds), ntasks + 1).astype(int) if ntasks > 0 else []
+
+    handles = []
+    try:
+        shared = share_spec(spec, handles)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(shared,)) as executor:
+            futures = [(start, stop, executor.submit(run_seeds, seeds[start:stop], chunk_size, multiplicity))
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            for start, stop, future in futures:
+                for name, values in future.result().items():
+                    results[name][start:stop] = values
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+    results['ac_age_to_keep'] = spec['ac_age_to_keep']
+    results['fa_countries_to_keep'] = spec['fa_countries_to_keep']
+    results['la_countries_to_keep'] = spec['la_countries_to_keep']
+    return results
+
+
+def save_boot_results(path, results):
+    # write results into the notebook's boot_results.npz, keeping arrays of an existing file that are not in results
+    # (e.g. the num_papers_* arrays, which the notebook loop computes)
+    arrays = {}
+    if os.path.exists(path):
+        with np.load(path, allow_pickle=True) as dat:
+            arrays = {key: dat[key] for key in dat.files}
+    arrays.update(results)
+    np.savez(path, **arrays)
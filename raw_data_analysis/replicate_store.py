@@ -0,0 +1,219 @@
+# Appendable on-disk store of bootstrap replicates
+#
+# boot_results.npz has to be rewritten (and every replicate rerun) to add replicates. A ReplicateStore is a folder
+# with one chunk of .npy files per batch of seeds and a manifest.json listing the seed ranges of each chunk,
+# so more seeds can be added to an existing run. Chunks are read memory-mapped.
+# For every array the store also keeps a running mean and a quantile sketch, so the mean and percentiles the
+# notebook prints come from the store without loading the replicates:
+#
+#   store = ReplicateStore('./boot_store')
+#   add_seeds(store, spec, range(0, 10000), workers=8)  # only seeds not in the store yet are run
+#   store.mean('r_boot'), store.percentile('r_boot', q=2.5), store.percentile('r_boot', q=97.5)
+#
+# Percentiles are exact (same as np.percentile) as long as there are at most `capacity` replicates,
+# beyond that the sketch keeps `capacity` weighted points per value.
+import json
+import os
+
+import numpy as np
+
+
+def seed_runs(seeds):
+    # [start, stop) runs of consecutive seeds
+    runs = []
+    for seed in seeds:
+        seed = int(seed)
+        if runs and runs[-1][1] == seed:
+            runs[-1][1] = seed + 1
+        else:
+            runs.append([seed, seed + 1])
+    return runs
+
+
+def runs_to_seeds(runs):
+    return [seed for start, stop in runs for seed in range(start, stop)]
+
+
+class QuantileSketch:
+    # sorted weighted points for each value of a replicate array (points x values)
+
+    def __init__(self, shape, capacity=5000):
+        self.shape = tuple(shape)
+        self.capacity = capacity
+        nvalues = int(np.prod(self.shape))
+        self.values = np.zeros((0, nvalues))
+        self.weights = np.zeros((0, nvalues))
+        self.count = 0
+        self.total = np.zeros(nvalues)
+        self.nan_count = np.zeros(nvalues, dtype=np.int64)
+
+    def update(self, replicates):
+        replicates = np.asarray(replicates, dtype=float).reshape(len(replicates), -1)
+        self.count += len(replicates)
+        self.total += np.nansum(replicates, axis=0)
+        nan = np.isnan(replicates)
+        self.nan_count += nan.sum(axis=0)
+        # NaNs sort last with weight 0, so they do not count in the quantiles (those values report NaN anyway)
+        values = np.vstack([self.values, replicates])
+        weights = np.vstack([self.weights, (~nan).astype(float)])
+        order = np.argsort(values, axis=0, kind='stable')
+        self.values = np.take_along_axis(values, order, 0)
+        self.weights = np.take_along_axis(weights, order, 0)
+        if len(self.values) > self.capacity:
+            self.compress()
+
+    def compress(self):
+        # keep `capacity` equally weighted points per value, at evenly spaced ranks
+        total = self.weights.sum(axis=0)
+        centers = np.cumsum(self.weights, axis=0) - self.weights/2
+        targets = (np.arange(self.capacity) + 0.5)[:, None] / self.capacity * total[None, :]
+        values = np.zeros((self.capacity, self.values.shape[1]))
+        for j in range(self.values.shape[1]):
+            keep = self.weights[:, j] > 0
+            if keep.any():
+                values[:, j] = np.interp(targets[:, j], centers[keep, j], self.values[keep, j])
+            else:
+                values[:, j] = np.nan
+        self.values = values
+        self.weights = np.broadcast_to(total / self.capacity, values.shape).copy()
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.total / self.count
+        mean[self.nan_count > 0] = np.nan  # like np.mean
+        return mean.reshape(self.shape)
+
+    def percentile(self, q):
+        # np.percentile(replicates, q, axis=0) (linear interpolation), from the sketch
+        result = np.full(self.values.shape[1], np.nan)
+        for j in range(self.values.shape[1]):
+            keep = self.weights[:, j] > 0
+            if self.nan_count[j] > 0 or not keep.any():
+                continue
+            weights = self.weights[keep, j]
+            centers = np.cumsum(weights) - weights/2
+            target = q/100*(weights.sum() - 1) + 0.5
+            result[j] = np.interp(target, centers, self.values[keep, j])
+        return result.reshape(self.shape)
+
+    def save(self, path):
+        np.savez(path, values=self.values, weights=self.weights, count=self.count, total=self.total,
+                 nan_count=self.nan_count, shape=np.array(self.shape, dtype=np.int64), capacity=self.capacity)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as dat:
+            sketch = cls(tuple(dat['shape']), int(dat['capacity']))
+            sketch.values, sketch.weights = dat['values'], dat['weights']
+            sketch.count, sketch.total, sketch.nan_count = int(dat['count']), dat['total'], dat['nan_count']
+        return sketch
+
+
+class ReplicateStore:
+
+    def __init__(self, path, capacity=5000):
+        self.path = path
+        self.capacity = capacity
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'chunks': [], 'arrays': {}, 'constants': {}}
+        self.sketches = {}
+        for name in self.manifest['arrays']:
+            sketch_path = os.path.join(path, 'sketch_' + name + '.npz')
+            self.sketches[name] = QuantileSketch.load(sketch_path) if os.path.exists(sketch_path) else None
+        if any(sketch is None or sketch.count != len(self) for sketch in self.sketches.values()):
+            self.rebuild_sketches()  # e.g. interrupted during append()
+
+    def rebuild_sketches(self):
+        # recompute the sketches from the stored chunks (one chunk in memory at a time)
+        for name, array in self.manifest['arrays'].items():
+            self.sketches[name] = QuantileSketch(array['shape'], self.capacity)
+            for replicates in self.chunks(name):
+                self.sketches[name].update(replicates)
+            self.sketches[name].save(os.path.join(self.path, 'sketch_' + name + '.npz'))
+
+    def seeds(self):
+        # seeds in the store, in replicate order
+        return [seed for chunk in self.manifest['chunks'] for seed in runs_to_seeds(chunk['seeds'])]
+
+    def missing_seeds(self, seeds):
+        done = set(self.seeds())
+        return [seed for seed in seeds if seed not in done]
+
+    def __len__(self):
+        return sum(chunk['nrep'] for chunk in self.manifest['chunks'])
+
+    def append(self, seeds, replicates, constants=None):
+        # add the replicates of seeds: a dict of arrays with one row per seed, plus entries that are the same for
+        # all replicates (constants, e.g. ac_age_to_keep), which must match the ones already stored
+        seeds = [int(seed) for seed in seeds]
+        if len(set(seeds)) != len(seeds) or len(self.missing_seeds(seeds)) != len(seeds):
+            raise ValueError('seeds are repeated or already in the store')
+        replicates = {name: np.asarray(value) for name, value in replicates.items()}
+        for name, value in replicates.items():
+            if len(value) != len(seeds):
+                raise ValueError('{:s} has {:d} replicates, expected {:d}'.format(name, len(value), len(seeds)))
+        constants = {name: np.asarray(value).tolist() for name, value in (constants or {}).items()}
+        if self.manifest['arrays'] and set(replicates) != set(self.manifest['arrays']):
+            raise ValueError('arrays differ from the ones in the store: ' + str(sorted(set(replicates) ^ set(self.manifest['arrays']))))
+        for name, value in constants.items():
+            if name in self.manifest['constants'] and self.manifest['constants'][name] != value:
+                raise ValueError(name + ' differs from the value in the store')
+
+        chunk_name = 'chunk_{:05d}'.format(len(self.manifest['chunks']))
+        os.makedirs(os.path.join(self.path, chunk_name), exist_ok=True)
+        for name, value in replicates.items():
+            np.save(os.path.join(self.path, chunk_name, name + '.npy'), value)
+            if name not in self.sketches:
+                self.sketches[name] = QuantileSketch(value.shape[1:], self.capacity)
+                self.manifest['arrays'][name] = {'shape': list(value.shape[1:]), 'dtype': value.dtype.str}
+            self.sketches[name].update(value)
+            self.sketches[name].save(os.path.join(self.path, 'sketch_' + name + '.tmp.npz'))
+        for name in replicates:  # replace sketches only once all of them are written
+            os.replace(os.path.join(self.path, 'sketch_' + name + '.tmp.npz'), os.path.join(self.path, 'sketch_' + name + '.npz'))
+        self.manifest['constants'].update(constants)
+        self.manifest['chunks'].append({'name': chunk_name, 'seeds': seed_runs(seeds), 'nrep': len(seeds)})
+        self.save_manifest()
+
+    def save_manifest(self):
+        tmp_path = os.path.join(self.path, 'manifest.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, os.path.join(self.path, 'manifest.json'))
+
+    def chunks(self, name):
+        # memory-mapped replicates of one array, one chunk at a time
+        for chunk in self.manifest['chunks']:
+            yield np.load(os.path.join(self.path, chunk['name'], name + '.npy'), mmap_mode='r')
+
+    def load(self, name):
+        # all replicates of one array (like dat[name] from boot_results.npz)
+        if name in self.manifest['constants']:
+            return np.array(self.manifest['constants'][name])
+        return np.concatenate(list(self.chunks(name)))
+
+    def mean(self, name):
+        return self.sketches[name].mean()
+
+    def percentile(self, name, q):
+        return self.sketches[name].percentile(q)
+
+
+def add_seeds(store, spec, seeds, workers=1, chunk_size=64, multiplicity=False):
+    # run the seeds that are not in the store yet (block_bootstrap / parallel_bootstrap) and append them
+    seeds = store.missing_seeds(seeds)
+    if len(seeds) == 0:
+        return 0
+    if workers > 1:
+        from parallel_bootstrap import parallel_statistics
+        results = parallel_statistics(spec, seeds, workers, chunk_size, multiplicity=multiplicity)
+    else:
+        from block_bootstrap import compute_statistics
+        results = compute_statistics(spec, seeds, chunk_size, multiplicity)
+    constants = {key: spec[key] for key in ('ac_age_to_keep', 'fa_countries_to_keep', 'la_countries_to_keep')}
+    store.append(seeds, {key: value for key, value in results.items() if key not in constants}, constants)
+    return len(seeds)
@@ -10,13 +10,22 @@
 from pybliometrics.scopus import AbstractRetrieval, AuthorRetrieval
 import pandas as pd
 from tqdm import tqdm
-from util_functions import clean_author_str
+from util_functions import clean_author_str, clean_author_column, load_eid_index, normalize_ref_authors, AuthorMatcher
 import unidecode
 import os
+import sys
 import glob
 import re
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from scopus_tools.record_store import RecordStore
+from scopus_tools.key_scheduler import KeyScheduler
+from scopus_tools.metrics import Metrics
 
 refresh_days = 365  # how often to update stored results via pybliometrics
+metrics = Metrics()  # retrieval latency, store hits and errors, stage timings; saved next to the results of each journal-year
+scheduler = KeyScheduler(state_path='../key_quota.json', metrics=metrics)  # spread downloads over all API keys in the pybliometrics config
+store = RecordStore('../scopus_records.db', fetch=scheduler.fetch, metrics=metrics)  # downloaded records for all journals, in a single file
 
 dir_list = []
 for field_name in ['Neuro', 'Neurology', 'Psychiatry']:
@@ -37,11 +46,14 @@ for dir_name in dir_list:
 
 
     for year in years:
+        metrics.reset()
+        stage_start = time.perf_counter()
 
         # read in main set of articles
         df_journal = pd.read_csv ('../' + field_name + '/' + journal_name + '/' + journal_name + str(year) + '.csv')
         df_journal = df_journal[df_journal['Authors'] != '[No author name available]']  # remove entried w missing authors
         EIDs= list(df_journal['EID'])
+        article_authors_all = clean_author_column(df_journal['Authors'])  # cleaned author names of every article
         nentries = df_journal.shape[0]
         print('Total entries: ' + '{:d}'.format(nentries))
 
@@ -49,7 +61,11 @@ for dir_name in dir_list:
         df_ref = pd.read_csv('../' + field_name + '/' + journal_name + '/' + journal_name + str(year) + '_ref.csv')
         df_ref['Title'] = [str(title) for title in df_ref['Title']]  # some weird non-string issue
         # print(df_ref.keys())
-        EID_str_database = ';;;;'.join(df_ref['EID'])  # make string of all EIDs for faster searching
+        ref_csv = '../' + field_name + '/' + journal_name + '/' + journal_name + str(year) + '_ref.csv'
+        eid_index = load_eid_index(ref_csv, df_ref['EID'])  # EID -> row position, saved next to the csv for later runs
+        ref_EIDs_database = list(df_ref['EID'])
+        ref_authors_norm = normalize_ref_authors(df_ref['Authors'])  # normalize author strings once, not per article
+        metrics.add_time('read journal csv', time.perf_counter() - stage_start)
 
         # initialize lists for author ID and string methods
         fa = []; la = []; fa_la = []; any_author = []
@@ -60,12 +76,12 @@ for dir_name in dir_list:
 
         for entry_idx, this_eid in tqdm(enumerate(EIDs)):
 
-            article_authors = clean_author_str(df_journal.iloc[entry_idx]['Authors'])
+            article_authors = article_authors_all[entry_idx]
             first_author = article_authors[0]
             last_author = article_authors[-1]
 
             # print('\n***** Evaluating Manuscript eid: ' + this_eid + ' *****\n')
-            ab = AbstractRetrieval(this_eid, view="FULL", refresh=refresh_days)
+            ab = store.retrieve(AbstractRetrieval, this_eid, view="FULL", refresh=refresh_days)
 
             # get author and reference IDs
             author_IDs = [author_entry.auid for author_entry in ab.authors if author_entry.auid is not None]
@@ -74,7 +90,7 @@ for dir_name in dir_list:
 
             # try to get h-index of last author
             try:
-                la_info = AuthorRetrieval(author_IDs[-1], refresh=refresh_days)
+                la_info = store.retrieve(AuthorRetrieval, author_IDs[-1], refresh=refresh_days)
                 la_h_index.append(la_info.h_index)
             except:
                 la_h_index.append('Error')
@@ -84,38 +100,18 @@ for dir_name in dir_list:
                 ref_EID = ['2-s2.0-' + ref_entry.id for ref_entry in ab.references if ref_entry.id is not None]
                 ref_count = len(ref_EID)
                 # finding matching references based on IDs
-                matching_eid_loc = []
-                for EID in ref_EID:
-                  title_end_loc = EID_str_database.find(EID)
-                  if title_end_loc>0:
-                    matching_eid_loc.append(EID_str_database[:title_end_loc].count(';;;;'))
+                matching_eid_loc = eid_index.rows(ref_EID)
                 df_ref_trimmed = df_ref.iloc[matching_eid_loc]
                 
 
                 
                 # find which references to download based on matching of last name + first initial
-                count_fa_str=0; count_la_str=0; count_fa_la_str=0; count_any_str=0
-                ref_EID_to_download = []  # download these to then check author IDs
-                for idx in range(df_ref_trimmed.shape[0]):
-                    ref_trimmed_str = unidecode.unidecode(str(df_ref_trimmed.iloc[idx]['Authors']).replace('-', ''))  # str() in case it was not string
-                    # print(ref_trimmed_str)
-                    # print(first_author)
-                    # print(last_author)
-                    # print(article_authors)
-                        
-                    # NOTE to self: can probably just do any here, then look at author IDs
-                    if first_author in ref_trimmed_str and last_author in ref_trimmed_str:
-                        count_fa_str+=1; count_la_str+=1; count_fa_la_str+=1; count_any_str+=1
-                        ref_EID_to_download.append(df_ref_trimmed.iloc[idx]['EID'])
-                    elif first_author in ref_trimmed_str and not last_author in ref_trimmed_str:
-                        count_fa_str+=1; count_fa_la_str+=1; count_any_str+=1
-                        ref_EID_to_download.append(df_ref_trimmed.iloc[idx]['EID'])
-                    elif not first_author in ref_trimmed_str and last_author in ref_trimmed_str:
-                        count_la_str+=1; count_fa_la_str+=1; count_any_str+=1
-                        ref_EID_to_download.append(df_ref_trimmed.iloc[idx]['EID'])
-                    elif any([article_authors_entry in ref_trimmed_str for article_authors_entry in article_authors]):
-                        count_any_str+=1
-                        ref_EID_to_download.append(df_ref_trimmed.iloc[idx]['EID'])
+                stage_start = time.perf_counter()
+                matcher = AuthorMatcher(article_authors)
+                count_fa_str, count_la_str, count_fa_la_str, count_any_str, matched_idx = \
+                    matcher.count([ref_authors_norm[loc] for loc in matching_eid_loc])
+                ref_EID_to_download = [ref_EIDs_database[matching_eid_loc[idx]] for idx in matched_idx]  # download these to then check author IDs
+                metrics.add_time('name matching', time.perf_counter() - stage_start)
                 # print('FA: {:d}, LA: {:d}, Any: {:d}'.format(count_fa_str, count_la_str, count_any_str) )
                 # print(count_la_str)
                 # print(county_any_str)
@@ -123,6 +119,7 @@ for dir_name in dir_list:
                 
 
                 # load authors for EIDs
+                stage_start = time.perf_counter()
                 if len(author_IDs)>0:
                     count_fa=0; count_la=0; count_fa_la=0; count_any=0
                     EID_matching_fa = []; EID_matching_la = []; EID_matching_fa_la = []; EID_matching_any = []
@@ -130,7 +127,7 @@ for dir_name in dir_list:
 
                         #  for each reference, find author IDs
                         try:
-                            ref_ab = AbstractRetrieval(download_EID, view="FULL", refresh=refresh_days)
+                            ref_ab = store.retrieve(AbstractRetrieval, download_EID, view="FULL", refresh=refresh_days)
                             ref_author_IDs = [ref_author_entry.auid for ref_author_entry in ref_ab.authors if ref_author_entry.auid is not None]
                         except:
                             ref_ab = []
@@ -182,6 +179,7 @@ for dir_name in dir_list:
                     count_fa_la = 'No IDs'; count_any = 'No IDs'
                     EID_matching_fa_la.append('No IDs'); EID_matching_fa.append('No IDs')
                     EID_matching_la.append('No IDs'); EID_matching_any.append('No IDs')
+                metrics.add_time('reference author matching (with downloads)', time.perf_counter() - stage_start)
 
 
             except:
@@ -225,4 +223,7 @@ for dir_name in dir_list:
         df_journal['la_h_index'] = la_h_index
 
         print('saving')
-        df_journal.to_excel('../' + field_name + '/' + journal_name + '/results_' + journal_name + str(year) + '.xlsx')
+        with metrics.stage('write results'):
+            df_journal.to_excel('../' + field_name + '/' + journal_name + '/results_' + journal_name + str(year) + '.xlsx')
+        metrics.write('../' + field_name + '/' + journal_name + '/metrics_' + journal_name + str(year),
+                      labels={'script': 'sc_journal', 'journal': journal_name, 'year': year})
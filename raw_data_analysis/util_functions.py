@@ -1,42 +1,248 @@
 # Requirements:
 #   see get_eids.py
 import unidecode
+import gc
+import itertools
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+from bisect import bisect_left
+from functools import lru_cache
+
+try:  # optional, C implementation of Aho-Corasick (pip install pyahocorasick)
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# consortia and groups to remove from author lists (first part is case-insensitive)
+consortium_pattern = re.compile('(?i:consortium|initiative|investigators|group|network|center|psych|schizophrenia|research team)'
+                                '|GEMRIC|Million Veteran Program|Pediatric Imaging|Neurocognition|ADNI and PPMI|Council'
+                                '|Collaborator|DDD study|NBB-Psy|VA Cooperative Studies Program Study Team'
+                                '|Collaborative Members|University|Imaging|Biomarkers')
+
+
+@lru_cache(maxsize=2**18)
+def clean_author_entry(author_entry, add_period):
+    # clean one author name, None if it is a consortium (the same names come up many times, so results are cached)
+    authname = (author_entry if author_entry.isascii() else unidecode.unidecode(author_entry)).replace('-', ' ')
+
+    # deal with II, III, IV
+    if len(authname.split(' '))>2:
+        authname = authname.replace(' III,', ',').replace(' IV,', ',').replace(' II,', ',')
+
+    authname = authname.strip() + '.' if add_period else authname.strip()  # add in period after initial
+
+    # remove consortia
+    if consortium_pattern.search(authname):
+        return None
+
+    # get first initial only
+    return authname[:authname.find('.')]
+
 
 def clean_author_str(authors):
 
     if isinstance(authors, str):
         author_list = authors.split('.,')
+        # only if Surname, Initial format: no extra period for final author
+        author_list = [clean_author_entry(author_entry, True) for author_entry in author_list[:-1]] + \
+                      [clean_author_entry(author_list[-1], False)]
     elif isinstance(authors, list):
-        author_list = authors
+        author_list = [clean_author_entry(author_entry, True) for author_entry in authors]
 
-    author_list = [unidecode.unidecode(author_entry).replace('-', ' ') for author_entry in author_list]
+    return [author_list_entry for author_list_entry in author_list if author_list_entry is not None]
 
-    # deal with II, III, IV
-    for author_index, authname in enumerate(author_list):
-      if len(authname.split(' '))>2:
-        author_list[author_index] = authname.replace(' III,', ',').replace(' IV,', ',').replace(' II,', ',')
 
-    author_list = [author_list_entry.strip() + '.' for author_list_entry in author_list]  # add in period after initial
+def clean_author_column(authors):
+    # clean_author_str for a whole Authors column (pandas Series or list), one author list per entry
+    # the column is split once and every distinct (name, final author of a string) entry is cleaned once, through
+    # the same cache as clean_author_str, then mapped back to the articles
+    gc_enabled = gc.isenabled()
+    gc.disable()  # two new lists per article and no reference cycles: collections would only rescan them
+    try:
+        authors = list(authors)
+        is_str = np.fromiter((isinstance(author_str, str) for author_str in authors), dtype=bool, count=len(authors))
+        split = [author_str.split('.,') if isinstance(author_str, str) else author_str for author_str in authors]
+        if not all(isinstance(entries, list) for entries in split):
+            raise TypeError('Authors entries must be strings or lists')
+        lengths = np.fromiter(map(len, split), dtype=np.int64, count=len(split))
+        entries = np.fromiter(itertools.chain.from_iterable(split), dtype=object, count=lengths.sum())
 
-    if isinstance(authors, str):  # only if Surname, Initial format
-        author_list[-1]=author_list[-1][:-1]  # remove extra period from final author
+        # final author of a string: no period added
+        row = np.repeat(np.arange(len(split)), lengths)
+        final = is_str[row] & (np.arange(len(entries)) == np.cumsum(lengths)[row] - 1)
 
-    # remove consortia
-    author_list = [s for s in author_list if "consortium" not in s.lower()
-      and "initiative" not in s.lower() and "investigators" not in s.lower()
-      and "group" not in s.lower() and "network" not in s.lower()
-      and "center" not in s.lower() and "psych" not in s.lower()
-      and "GEMRIC" not in s and 'Million Veteran Program' not in s
-      and 'Pediatric Imaging' not in s and 'Neurocognition' not in s
-      and 'schizophrenia' not in s.lower() and 'research team' not in s.lower()
-      and 'ADNI and PPMI' not in s and 'Council' not in s
-      and 'Collaborator' not in s and 'DDD study' not in s
-      and 'NBB-Psy' not in s and 'VA Cooperative Studies Program Study Team' not in s
-      and 'Collaborative Members' not in s and 'University' not in s
-      and 'Imaging' not in s and 'Biomarkers' not in s]
+        # clean distinct entries, then map back
+        codes, names = pd.factorize(entries)
+        keys, inverse = np.unique(codes*2 + final, return_inverse=True)
+        cleaned = np.empty(len(keys), dtype=object)
+        cleaned[:] = [clean_author_entry(names[key >> 1], not key & 1) for key in keys.tolist()]
+        keep = np.fromiter((name is not None for name in cleaned), dtype=bool, count=len(cleaned))[inverse]
+        cleaned = cleaned[inverse][keep].tolist()
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(row[keep], minlength=len(split)))]).tolist()
+        return [cleaned[bounds[i]:bounds[i+1]] for i in range(len(split))]
+    finally:
+        if gc_enabled:
+            gc.enable()
 
-    # get first initial only
-    author_list = [article_author_entry[:article_author_entry.find('.')] for article_author_entry in author_list]
 
-    return author_list
+def normalize_ref_authors(authors):
+    # reference author strings as they are matched against article authors (once per _ref.csv)
+    return [unidecode.unidecode(str(author_str).replace('-', '')) for author_str in authors]  # str() in case it was not string
+
+
+class AuthorMatcher:
+    # finds which of an article's author names (from clean_author_str) occur in reference author strings
+    # all names are searched in one pass over each string (Aho-Corasick automaton if pyahocorasick is installed,
+    # otherwise substring tests), with the same substring semantics as `name in ref_str`
+
+    def __init__(self, article_authors):
+        self.first_author = article_authors[0]
+        self.last_author = article_authors[-1]
+        self.patterns = list(dict.fromkeys(article_authors))  # unique names, in order
+        self.empty_pattern = '' in self.patterns  # '' is in every string
+        self.automaton = None
+        if ahocorasick is not None and len(self.patterns) > 0:
+            self.automaton = ahocorasick.Automaton()
+            for pattern in self.patterns:
+                if pattern != '':
+                    self.automaton.add_word(pattern, pattern)
+            if len(self.automaton) > 0:
+                self.automaton.make_automaton()
+            else:
+                self.automaton = None
+
+    def match(self, ref_str):
+        # (first author in ref_str, last author in ref_str, any article author in ref_str)
+        if self.automaton is None:
+            fa_in = self.first_author in ref_str
+            la_in = self.last_author in ref_str
+            any_in = fa_in or la_in or any([pattern in ref_str for pattern in self.patterns])
+            return fa_in, la_in, any_in
+
+        found = set([pattern for _, pattern in self.automaton.iter(ref_str)])
+        if self.empty_pattern:
+            found.add('')
+        return self.first_author in found, self.last_author in found, len(found) > 0
+
+    def count(self, ref_strs):
+        # string-based self-citation counts over references (count_fa_str, count_la_str, count_fa_la_str,
+        # count_any_str in sc_journal.py) and the indices of the references matching any author
+        count_fa = 0; count_la = 0; count_fa_la = 0; count_any = 0
+        matched_idx = []
+        for idx, ref_str in enumerate(ref_strs):
+            fa_in, la_in, any_in = self.match(ref_str)
+            count_fa += fa_in; count_la += la_in
+            count_fa_la += (fa_in or la_in); count_any += any_in
+            if any_in:
+                matched_idx.append(idx)
+        return count_fa, count_la, count_fa_la, count_any, matched_idx
+
+
+class EIDIndex:
+    # index from reference EID to row position in a _ref.csv database
+    # gives the same rows as searching the ';;;;'-joined EID string with str.find:
+    # the first row whose EID starts with the searched EID, and never row 0 (find location 0 was not counted)
+
+    def __init__(self, eids, source=None):
+        self.source = source  # size and modification time of the csv the index was built from
+        order = sorted(range(len(eids)), key=lambda pos: eids[pos])
+        self.sorted_eids = [eids[pos] for pos in order]
+        self.sorted_positions = order
+        # for each EID, the first row that starts with it (usually its own row)
+        self.first_match = {}
+        for sorted_idx, eid in enumerate(self.sorted_eids):
+            if eid not in self.first_match:
+                self.first_match[eid] = self.prefix_search(eid, sorted_idx)
+
+    def prefix_search(self, eid, sorted_idx=None):
+        # first row position whose EID starts with eid, -1 if none
+        if sorted_idx is None:
+            sorted_idx = bisect_left(self.sorted_eids, eid)
+        first_pos = -1
+        while sorted_idx < len(self.sorted_eids) and self.sorted_eids[sorted_idx].startswith(eid):
+            if first_pos < 0 or self.sorted_positions[sorted_idx] < first_pos:
+                first_pos = self.sorted_positions[sorted_idx]
+            sorted_idx += 1
+        return first_pos
+
+    def lookup(self, eid):
+        pos = self.first_match.get(eid)
+        return pos if pos is not None else self.prefix_search(eid)
+
+    def rows(self, ref_EID):
+        # row positions of the references found in the database (matching_eid_loc in sc_journal.py)
+        return [pos for pos in (self.lookup(EID) for EID in ref_EID) if pos > 0]
+
+    def save(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'source': self.source, 'sorted_eids': self.sorted_eids,
+                       'sorted_positions': self.sorted_positions, 'first_match': self.first_match}, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            saved = json.load(f)
+        index = cls.__new__(cls)
+        index.source = saved['source']
+        index.sorted_eids = saved['sorted_eids']
+        index.sorted_positions = saved['sorted_positions']
+        index.first_match = saved['first_match']
+        return index
+
+
+def load_eid_index(csv_path, eids):
+    # EID index of a _ref.csv, saved next to it (<name>_ref.eid_index.json) and rebuilt when the csv changes
+    index_path = os.path.splitext(csv_path)[0] + '.eid_index.json'
+    source = [os.path.getsize(csv_path), os.path.getmtime(csv_path)]
+    if os.path.exists(index_path):
+        try:
+            index = EIDIndex.load(index_path)
+            if index.source == source and len(index.sorted_eids) == len(eids):
+                return index
+        except (ValueError, KeyError):  # unreadable index, rebuild it
+            pass
+    index = EIDIndex(list(eids), source)
+    index.save(index_path)
+    return index
+
+
+class AuthorProfiles:
+    # per-author information needed by get_auth_info.py, downloaded once per author for the whole run
+    # retrieve(auid) returns the AuthorRetrieval for an author ID
+
+    def __init__(self, retrieve):
+        self.retrieve = retrieve
+        self.profiles = {}  # auid -> (given name, first publication year, sorted publication years) or None if not available
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, auid):
+        # profile of an author, None if Scopus does not have the author or their information is incomplete.
+        # Other errors (out of quota, server errors, timeouts) are raised and not cached, so the author is tried again
+        from pybliometrics.scopus.exception import Scopus404Error
+        if auid in self.profiles:
+            self.hits += 1
+            return self.profiles[auid]
+        self.misses += 1
+        try:
+            author = self.retrieve(auid)
+            given_name = author.given_name
+            starting_date = author.publication_range[0]
+            docs = author.get_documents()
+            if len(docs) == 0:
+                raise KeyError('coverDate')  # no documents found for author
+            pub_years = sorted([int(doc.coverDate[:4]) for doc in docs])
+            profile = (given_name, starting_date, pub_years)
+        except (Scopus404Error, KeyError, IndexError, TypeError):
+            profile = None
+        self.profiles[auid] = profile
+        return profile
+
 
+def papers_before(pub_years, year):
+    # number of papers published before year, pub_years must be sorted
+    return bisect_left(pub_years, year)
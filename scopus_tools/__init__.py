@@ -0,0 +1,9 @@
+# Shared helpers for the Scopus download scripts
+# (self_citation_author.py, raw_data_analysis/sc_journal.py, model_data_analysis/sc_by_pair.py)
+
+import os as _os
+
+# SCOPUS_STAND_IN=http://host:port sends all pybliometrics requests to a local stand-in (see stand_in.py)
+if _os.environ.get('SCOPUS_STAND_IN'):
+    from scopus_tools.stand_in import use_stand_in
+    use_stand_in(_os.environ['SCOPUS_STAND_IN'])
@@ -0,0 +1,339 @@
+# Compact, memory-mapped citation graph
+#
+# Self-citation is a join between the authors of citing papers and the authors of the papers they cite. The scripts
+# rebuild that relationship from AbstractRetrieval objects every time; this module builds it once into a folder of
+# numpy arrays that analyses can open with np.load(mmap_mode='r') in milliseconds:
+#   paper_ids.npy      int64, sorted Scopus IDs (the digits of the EID), a paper's position is its index
+#   author_ids.npy     int64, sorted Scopus author IDs, an author's position is its index
+#   ref_indptr.npy     int64, references of paper p are ref_indices[ref_indptr[p]:ref_indptr[p+1]] (in citing order)
+#   ref_indices.npy    int32, paper indices
+#   author_indptr.npy  int64, authors of paper p are author_indices[author_indptr[p]:author_indptr[p+1]] (in author order)
+#   author_indices.npy int32, author indices
+#   year.npy           int16, publication year (0 if unknown)
+#   journal.npy        int32, index into meta.json's journals (-1 if unknown)
+#   nref.npy           int32, number of references in the paper's record, including ones without a Scopus ID (-1 if unknown)
+#   flags.npy          uint8, AUTHORS_FROM_RECORD / AUTHORS_FROM_REF / AUTHORS_PARTIAL / REFERENCES_KNOWN
+#   meta.json          sizes, journal names and how the graph was built
+#
+# Build it from the record store (FULL and REF views of AbstractRetrieval), optionally only for the articles of some
+# journal csv files (e.g. one field), or from the results csv files of model_data_analysis/sc_by_pair.py (which only
+# have the first and last author of citing papers and, since they have the eid_cited column, their references):
+#   python -m scopus_tools.citation_graph --store scopus_records.db --journal_csv "All_Neuro/*/*.csv" --out graphs/Neuro
+#   python -m scopus_tools.citation_graph --pairs "results_1_2024/*.csv" --out graphs/pairs
+#
+# and open it with
+#   graph = CitationGraph('graphs/Neuro')
+#   p = graph.paper_index(['2-s2.0-85000002163'])[0]
+#   cited_authors = [graph.author_ids[graph.authors(q)] for q in graph.references(p)]
+
+import datetime
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+
+AUTHORS_FROM_RECORD = 1  # author list from the paper's own FULL record
+AUTHORS_FROM_REF = 2  # author list from the REF view of a paper citing it
+AUTHORS_PARTIAL = 4  # only first and last author known (sc_by_pair csv files)
+REFERENCES_KNOWN = 8  # the paper's references are in the graph
+
+ARRAYS = ['paper_ids', 'author_ids', 'ref_indptr', 'ref_indices', 'author_indptr', 'author_indices',
+          'year', 'journal', 'nref', 'flags']
+FORMAT_VERSION = 1
+
+
+def listify(value):
+    # Scopus returns a single dict instead of a list of one
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def scopus_id(eid):
+    # int Scopus ID of '2-s2.0-85000002163', '85000002163' or 85000002163, None if not an ID
+    try:
+        return int(str(eid).replace('2-s2.0-', ''))
+    except ValueError:
+        return None
+
+
+def parse_year(date):
+    try:
+        return int(str(date)[:4])
+    except (TypeError, ValueError):
+        return None
+
+
+class GraphBuilder:
+    # collects papers, then write() interns IDs and saves the arrays; information from better sources wins
+    # (a paper's own record over the REF view of a citing paper over the reference entry of a citing paper)
+
+    def __init__(self):
+        self.authors = {}  # scopus id -> (priority, [auid, ...], flag)
+        self.references = {}  # scopus id -> [scopus id, ...]
+        self.nref = {}  # scopus id -> number of references
+        self.year = {}  # scopus id -> (priority, year)
+        self.journal = {}  # scopus id -> (priority, name)
+
+    def add_paper(self, sid, authors=None, references=None, nref=None, year=None, journal=None, priority=0, flag=0):
+        if sid is None:
+            return
+        if authors is not None and (sid not in self.authors or self.authors[sid][0] < priority):
+            self.authors[sid] = (priority, [int(auid) for auid in authors], flag)
+        if references is not None:
+            self.references[sid] = references
+            self.nref[sid] = len(references) if nref is None else nref
+        if year is not None and (sid not in self.year or self.year[sid][0] < priority):
+            self.year[sid] = (priority, year)
+        if journal is not None and (sid not in self.journal or self.journal[sid][0] < priority):
+            self.journal[sid] = (priority, journal)
+
+    def add_full(self, data):
+        # FULL view of AbstractRetrieval: the paper's authors, references, year and journal, and year/journal of its references
+        response = json.loads(data).get('abstracts-retrieval-response') or {}
+        coredata = response.get('coredata') or {}
+        sid = scopus_id(coredata.get('eid') or str(coredata.get('dc:identifier', '')).replace('SCOPUS_ID:', ''))
+        authors = [author['@auid'] for author in listify((response.get('authors') or {}).get('author')) if author.get('@auid')]
+        bibliography = (((response.get('item') or {}).get('bibrecord') or {}).get('tail') or {}).get('bibliography') or {}
+        references = []
+        entries = listify(bibliography.get('reference'))
+        for entry in entries:
+            info = entry.get('ref-info') or {}
+            ids = [item.get('$') for item in listify((info.get('refd-itemidlist') or {}).get('itemid'))
+                   if item.get('@idtype') == 'SGR']
+            ref_sid = scopus_id(ids[0]) if ids else None
+            if ref_sid is None:
+                continue
+            references.append(ref_sid)
+            self.add_paper(ref_sid, year=parse_year((info.get('ref-publicationyear') or {}).get('@first')),
+                           journal=info.get('ref-sourcetitle'), priority=1)
+        self.add_paper(sid, authors=authors, references=references if entries else None,
+                       nref=len(entries), year=parse_year(coredata.get('prism:coverDate')),
+                       journal=coredata.get('prism:publicationName'), priority=3, flag=AUTHORS_FROM_RECORD)
+        return sid
+
+    def add_ref(self, data):
+        # REF view of AbstractRetrieval: authors, year and journal of the references
+        response = json.loads(data).get('abstracts-retrieval-response') or {}
+        for entry in listify((response.get('references') or {}).get('reference')):
+            ref_sid = scopus_id(entry.get('scopus-id'))
+            authors = [author['@auid'] for author in listify((entry.get('author-list') or {}).get('author')) if author.get('@auid')]
+            self.add_paper(ref_sid, authors=authors if authors else None, year=parse_year(entry.get('prism:coverDate')),
+                           journal=entry.get('sourcetitle'), priority=2, flag=AUTHORS_FROM_REF)
+
+    def add_pairs(self, df):
+        # rows of a sc_by_pair.py results csv (one per reference of a citing article)
+        has_cited = 'eid_cited' in df.columns
+        for eid, rows in df.groupby('eid_citing', sort=False):
+            first = rows.iloc[0]
+            authors = [value for value in (first['auid_fa'], first['auid_la']) if value == value]  # skip NaN
+            if len(authors) == 2 and authors[0] == authors[1]:
+                authors = authors[:1]
+            references = None
+            if has_cited:
+                references = [scopus_id(cited) for cited in rows['eid_cited'] if isinstance(cited, str)]
+                references = [sid for sid in references if sid is not None]
+                for cited, year, journal in zip(rows['eid_cited'], rows['year_cited'], rows['journal_cited']):
+                    if isinstance(cited, str):
+                        self.add_paper(scopus_id(cited), year=parse_year(year) if year == year else None,
+                                       journal=journal if isinstance(journal, str) else None, priority=1)
+            self.add_paper(scopus_id(eid), authors=authors, references=references, nref=int(first['num_ref_citing']),
+                           year=parse_year(first['year_citing']),
+                           journal=first['journal_citing'] if isinstance(first['journal_citing'], str) else None,
+                           priority=3, flag=AUTHORS_PARTIAL)
+
+    def restrict(self, citing):
+        # keep only the given citing papers (scopus ids) and the papers they cite
+        citing = set(citing) & set(self.references)
+        keep = set(citing)
+        for sid in citing:
+            keep.update(self.references[sid])
+        self.references = {sid: refs for sid, refs in self.references.items() if sid in citing}
+        self.nref = {sid: n for sid, n in self.nref.items() if sid in citing}
+        self.authors = {sid: value for sid, value in self.authors.items() if sid in keep}
+        self.year = {sid: value for sid, value in self.year.items() if sid in keep}
+        self.journal = {sid: value for sid, value in self.journal.items() if sid in keep}
+
+    def write(self, path, source=''):
+        # intern IDs, build the CSR arrays and save them (replacing an existing graph at path in one step)
+        sids = set(self.authors) | set(self.references) | set(self.year) | set(self.journal)
+        for refs in self.references.values():
+            sids.update(refs)
+        paper_ids = np.array(sorted(sids), dtype=np.int64)
+        author_ids = np.unique(np.array([auid for _, auids, _ in self.authors.values() for auid in auids], dtype=np.int64))
+        journals = sorted(set(name for _, name in self.journal.values()))
+        journal_idx = {name: idx for idx, name in enumerate(journals)}
+
+        npapers = len(paper_ids)
+        ref_counts = np.zeros(npapers, dtype=np.int64)
+        author_counts = np.zeros(npapers, dtype=np.int64)
+        year = np.zeros(npapers, dtype=np.int16)
+        journal = np.full(npapers, -1, dtype=np.int32)
+        nref = np.full(npapers, -1, dtype=np.int32)
+        flags = np.zeros(npapers, dtype=np.uint8)
+        ref_lists = [None]*npapers
+        author_lists = [None]*npapers
+        for p, sid in enumerate(paper_ids.tolist()):
+            if sid in self.references:
+                ref_lists[p] = self.references[sid]
+                ref_counts[p] = len(ref_lists[p])
+                nref[p] = self.nref[sid]
+                flags[p] |= REFERENCES_KNOWN
+            if sid in self.authors:
+                _, author_lists[p], flag = self.authors[sid]
+                author_counts[p] = len(author_lists[p])
+                flags[p] |= flag
+            if sid in self.year:
+                year[p] = self.year[sid][1]
+            if sid in self.journal:
+                journal[p] = journal_idx[self.journal[sid][1]]
+        ref_indptr = np.concatenate([[0], np.cumsum(ref_counts)]).astype(np.int64)
+        author_indptr = np.concatenate([[0], np.cumsum(author_counts)]).astype(np.int64)
+        all_refs = np.array([sid for refs in ref_lists if refs is not None for sid in refs], dtype=np.int64)
+        all_authors = np.array([auid for auids in author_lists if auids is not None for auid in auids], dtype=np.int64)
+        arrays = {'paper_ids': paper_ids, 'author_ids': author_ids,
+                  'ref_indptr': ref_indptr, 'ref_indices': np.searchsorted(paper_ids, all_refs).astype(np.int32),
+                  'author_indptr': author_indptr,
+                  'author_indices': np.searchsorted(author_ids, all_authors).astype(np.int32),
+                  'year': year, 'journal': journal, 'nref': nref, 'flags': flags}
+
+        tmp_path = path.rstrip('/') + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_path, name + '.npy'), arrays[name])
+        meta = {'version': FORMAT_VERSION, 'npapers': npapers, 'nauthors': len(author_ids),
+                'nreferences': len(all_refs), 'journals': journals, 'source': source,
+                'built': datetime.datetime.now().isoformat(timespec='seconds')}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        return meta
+
+
+def journal_csv_eids(pattern):
+    # EIDs of the articles in journal csv files (e.g. "All_Neuro/*/*.csv"), reference lists (_ref.csv) are skipped
+    import pandas as pd
+    eids = set()
+    for csv_path in glob.glob(pattern):
+        if csv_path.endswith('_ref.csv'):
+            continue
+        eids.update(scopus_id(eid) for eid in pd.read_csv(csv_path, usecols=['EID'])['EID'])
+    eids.discard(None)
+    return eids
+
+
+def build_from_store(store, out, journal_csv=None):
+    # graph of the AbstractRetrieval records in a RecordStore, only the articles of journal_csv (glob) and their
+    # references if given
+    builder = GraphBuilder()
+    for _, _, data in store.iter_records('AbstractRetrieval', 'FULL'):
+        builder.add_full(data)
+    for _, _, data in store.iter_records('AbstractRetrieval', 'REF'):
+        builder.add_ref(data)
+    if journal_csv is not None:
+        builder.restrict(journal_csv_eids(journal_csv))
+    return builder.write(out, source='store ' + str(store.path) + ('' if journal_csv is None else ', articles of ' + journal_csv))
+
+
+def build_from_pairs(pattern, out):
+    # graph of sc_by_pair.py results csv files (glob), e.g. "results_1_2024/*.csv"
+    import pandas as pd
+    builder = GraphBuilder()
+    columns = ['eid_citing', 'eid_cited', 'year_citing', 'journal_citing', 'year_cited', 'journal_cited',
+               'num_ref_citing', 'auid_fa', 'auid_la']
+    for csv_path in sorted(glob.glob(pattern)):
+        builder.add_pairs(pd.read_csv(csv_path, usecols=lambda col: col in columns))
+    return builder.write(out, source='sc_by_pair results ' + pattern)
+
+
+class CitationGraph:
+    # read-only view of a graph folder, arrays are memory-mapped (only the pages that are used are read)
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != FORMAT_VERSION:
+            raise ValueError('graph format version {:d} is not supported, please rebuild it'.format(self.meta['version']))
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        self.journals = self.meta['journals']
+
+    def __len__(self):
+        return len(self.paper_ids)
+
+    def paper_index(self, eids):
+        # indices of papers (EIDs or Scopus IDs), -1 for papers not in the graph
+        return lookup(self.paper_ids, [scopus_id(eid) for eid in eids])
+
+    def author_index(self, auids):
+        # indices of Scopus author IDs, -1 for authors not in the graph
+        return lookup(self.author_ids, [int(auid) for auid in auids])
+
+    def eid(self, paper):
+        return '2-s2.0-' + str(self.paper_ids[paper])
+
+    def references(self, paper):
+        # indices of the papers cited by a paper, in citing order (empty if not known, see REFERENCES_KNOWN)
+        return self.ref_indices[self.ref_indptr[paper]:self.ref_indptr[paper + 1]]
+
+    def authors(self, paper):
+        # author indices of a paper, in author order
+        return self.author_indices[self.author_indptr[paper]:self.author_indptr[paper + 1]]
+
+    def citing_papers(self, journals=None, years=None):
+        # indices of papers with known references, optionally only from some journals (names) and years
+        keep = (np.asarray(self.flags) & REFERENCES_KNOWN) > 0
+        if journals is not None:
+            wanted = [idx for idx, name in enumerate(self.journals) if name in set(journals)]
+            keep &= np.isin(self.journal, wanted)
+        if years is not None:
+            keep &= np.isin(self.year, list(years))
+        return np.flatnonzero(keep)
+
+    def summary(self):
+        return {'papers': len(self), 'authors': len(self.author_ids), 'references': len(self.ref_indices),
+                'citing_papers': int(((np.asarray(self.flags) & REFERENCES_KNOWN) > 0).sum()),
+                'journals': len(self.journals), 'source': self.meta['source']}
+
+
+def lookup(sorted_ids, ids):
+    # positions of ids in a sorted array, -1 if absent
+    ids = np.array([-1 if value is None else value for value in ids], dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return np.where(np.asarray(sorted_ids)[positions] == ids, positions, -1)
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import time
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from scopus_tools.record_store import RecordStore
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", type=str, required=True, help="folder to write the graph to (replaced if it exists)")
+    parser.add_argument("--store", type=str, default=None, help="record store to build the graph from")
+    parser.add_argument("--journal_csv", type=str, default=None, help="with --store: only the articles in these journal csv files (glob, e.g. 'All_Neuro/*/*.csv') and their references")
+    parser.add_argument("--pairs", type=str, default=None, help="build from sc_by_pair.py results csv files instead (glob)")
+    args = parser.parse_args()
+    if (args.store is None) == (args.pairs is None):
+        parser.error('give either --store or --pairs')
+
+    start = time.time()
+    if args.store is not None:
+        meta = build_from_store(RecordStore(args.store), args.out, args.journal_csv)
+    else:
+        meta = build_from_pairs(args.pairs, args.out)
+    print('Built {:s} in {:.1f} s: {:d} papers, {:d} authors, {:d} references'.format(
+        args.out, time.time() - start, meta['npapers'], meta['nauthors'], meta['nreferences']))
+    start = time.time()
+    graph = CitationGraph(args.out)
+    print('Opened in {:.1f} ms: {:s}'.format((time.time() - start)*1e3, str(graph.summary())))
@@ -0,0 +1,76 @@
+# Plan Scopus downloads before computing with them
+#
+# The scripts ask for a record whenever they need it, so the same cited article, author or affiliation is asked
+# for again every time it comes up. A FetchPlan collects the records a job will need (counting how often each is
+# asked for), so they can be downloaded once up front with prefetch(), after which the computation only reads the
+# RecordStore. summary() gives the number of records to download per API, to size quota and runtime of a job.
+#
+#   plan = FetchPlan()
+#   plan.add(AbstractRetrieval, eid, view='FULL')
+#   print(plan.summary(store, refresh=refresh_days))
+#   prefetch(store, plan.to_fetch(store, refresh=refresh_days), refresh=refresh_days)
+
+from concurrent.futures import ThreadPoolExecutor
+
+from scopus_tools.key_scheduler import QuotaExhaustedError
+from scopus_tools.record_store import DEFAULT_VIEWS
+
+
+class FetchPlan:
+
+    def __init__(self):
+        self.items = {}  # (cls, identifier, view) -> number of times asked for, in the order first asked
+        self.requests = 0
+
+    def add(self, cls, identifier, view=None):
+        view = view if view is not None else DEFAULT_VIEWS.get(cls.__name__, '')
+        item = (cls, str(identifier), view)
+        self.items[item] = self.items.get(item, 0) + 1
+        self.requests += 1
+
+    def __len__(self):
+        return len(self.items)
+
+    def dedup_ratio(self):
+        # requests the job would send without the plan per unique record
+        return self.requests / max(len(self.items), 1)
+
+    def to_fetch(self, store, refresh=False):
+        # unique records that are not in the store yet (or would be refreshed), leaving out records known not to be in Scopus
+        return [item for item in self.items if not store.known(item[0].__name__, item[1], item[2], refresh)]
+
+    def summary(self, store=None, refresh=False):
+        # per record type and view: times asked for, unique records and (with a store) records to download
+        summary = {}
+        missing = set(self.to_fetch(store, refresh)) if store is not None else None
+        for item, count in self.items.items():
+            entry = summary.setdefault(item[0].__name__ + '/' + item[2], {'requests': 0, 'unique': 0, 'download': 0})
+            entry['requests'] += count
+            entry['unique'] += 1
+            if missing is not None and item in missing:
+                entry['download'] += 1
+        for entry in summary.values():
+            entry['dedup_ratio'] = round(entry['requests'] / entry['unique'], 2)
+        return summary
+
+
+def prefetch(store, items, refresh=False, workers=8):
+    # download (cls, identifier, view) items into the store, returns (number downloaded, number failed)
+    # failures are left to the computation, which handles them as before (404s are remembered by the store, so the
+    # computation and later runs do not ask Scopus for them again)
+    def fetch_one(item):
+        cls, identifier, view = item
+        try:
+            store.retrieve(cls, identifier, refresh=refresh, view=view)
+            return True
+        except QuotaExhaustedError:
+            raise
+        except Exception:
+            return False
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(fetch_one, items))
+    else:
+        results = [fetch_one(item) for item in items]
+    return sum(results), len(results) - sum(results)
@@ -0,0 +1,20 @@
+# Import an existing pybliometrics cache directory into a RecordStore file
+#
+# Run from the repository root, e.g.:
+#   python -m scopus_tools.import_pybliometrics_cache --cache_dir ~/.pybliometrics/Scopus --store scopus_records.db
+
+import argparse
+import os
+from scopus_tools.record_store import RecordStore, import_cache
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--cache_dir", type=str, default=os.path.expanduser('~/.pybliometrics/Scopus'), help="pybliometrics cache directory")
+parser.add_argument("--store", type=str, default='scopus_records.db', help="record store file to import into (created if needed)")
+parser.add_argument("--delete", type=int, default=0, help="whether to delete cache files once they are imported", choices=[0, 1])
+args = parser.parse_args()
+
+store = RecordStore(args.store)
+nbefore = len(store)
+nimported = import_cache(store, args.cache_dir, delete=(args.delete==1))
+print('Imported {:d} records from {:s} ({:d} records in {:s})'.format(nimported, args.cache_dir, len(store), args.store))
+store.close()
@@ -0,0 +1,288 @@
+# Spread Scopus requests over several API keys
+#
+# Each Scopus API (abstract, author, affiliation retrieval) has a weekly quota and a requests/second throttle per key.
+# The KeyScheduler tracks, for every (key, API) pair, the remaining quota reported by Scopus (X-RateLimit-Remaining)
+# and a token bucket for the throttle. Each request goes to the key with the most remaining quota among the keys that
+# can send right now, and the quota state is saved to a JSON file so the next run starts where this one stopped.
+# Processes that run at the same time can share the file: save() merges the requests made since the last save into
+# the file under a lock and picks up what the other processes used.
+#
+# Use it as the fetch function of a RecordStore so that only actual downloads go through it:
+#   scheduler = KeyScheduler(state_path='key_quota.json')
+#   store = RecordStore('scopus_records.db', fetch=scheduler.fetch)
+#
+# Requirements:
+#   installed pybliometrics with the API keys in its config file (comma separated)
+
+import atexit
+import json
+import os
+import threading
+import time
+
+try:  # lock the state file while merging, so several processes can share it (not available on Windows)
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# requests per second allowed per key (see https://dev.elsevier.com/api_key_settings.html)
+RATE_LIMITS = {'AbstractRetrieval': 9, 'AuthorRetrieval': 3, 'AffiliationRetrieval': 6}
+# weekly quota per key, used until Scopus reports the actual remaining quota
+WEEKLY_QUOTAS = {'AbstractRetrieval': 10000, 'AuthorRetrieval': 5000, 'AffiliationRetrieval': 5000}
+WEEK_SECONDS = 7*24*3600
+
+
+class QuotaExhaustedError(RuntimeError):
+    pass
+
+
+def pybliometrics_keys():
+    # the API keys in the pybliometrics config
+    try:  # pybliometrics 3.x keeps the parsed keys in a module level list
+        from pybliometrics.scopus.utils import startup
+        return startup.KEYS.shared if isinstance(startup.KEYS, PinnedKeys) else startup.KEYS
+    except (ImportError, AttributeError):
+        from pybliometrics.scopus.utils import config
+        return [key.strip() for key in config.get('Authentication', 'APIKey').split(',')]
+
+
+def parse_reset(reset):
+    # pybliometrics reports the reset time either as epoch seconds or as "%Y-%m-%d %H:%M:%S"
+    try:
+        return float(reset)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return time.mktime(time.strptime(reset, "%Y-%m-%d %H:%M:%S"))
+    except (TypeError, ValueError):
+        return None
+
+
+class PinnedKeys:
+    # replaces pybliometrics' module level KEYS list. On a 429, pybliometrics 3.x drops the first key of that list and
+    # retries with another one, which the scheduler did not pick or count. While a thread sends a request for the
+    # scheduler, its KEYS is only the scheduled key, so a 429 ends the request (Scopus429Error) and the scheduler
+    # moves on. Other threads, and requests not sent through the scheduler, see the usual list.
+
+    def __init__(self, shared):
+        self.shared = shared
+        self._local = threading.local()
+
+    def keys(self):
+        return getattr(self._local, 'keys', self.shared)
+
+    def pin(self, key):
+        self._local.keys = [key]
+
+    def unpin(self):
+        self._local.__dict__.pop('keys', None)
+
+    def __getitem__(self, index):
+        return self.keys()[index]
+
+    def __setitem__(self, index, value):
+        self.keys()[index] = value
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def pop(self, index=-1):
+        return self.keys().pop(index)
+
+
+_pin_lock = threading.Lock()
+
+
+def pinned_keys():
+    # the PinnedKeys in place of pybliometrics' KEYS, None if this pybliometrics version has no such list
+    try:
+        from pybliometrics.scopus.utils import startup
+    except ImportError:
+        return None
+    with _pin_lock:
+        if not isinstance(getattr(startup, 'KEYS', None), (list, PinnedKeys)):
+            return None
+        if not isinstance(startup.KEYS, PinnedKeys):
+            startup.KEYS = PinnedKeys(startup.KEYS)
+        return startup.KEYS
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+
+    def wait_time(self):
+        # seconds until a token is available
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+
+class KeyScheduler:
+
+    def __init__(self, keys=None, state_path='key_quota.json', save_every=50, rate_scale=1, metrics=None):
+        # rate_scale: share of the per-key request rate this scheduler may use (e.g. 1/4 for each of 4 processes)
+        # metrics: optional Metrics (see metrics.py), gets the time spent waiting for a key as stage 'wait for API key'
+        self.keys = [key.strip() for key in (keys if keys is not None else list(pybliometrics_keys()))]
+        self.state_path = state_path
+        self.save_every = save_every
+        self.nrequests = 0
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self.buckets = {(key, api): TokenBucket(rate*rate_scale, capacity=max(1, rate*rate_scale))
+                        for key in self.keys for api, rate in RATE_LIMITS.items()}
+        self.quota = {}  # (key, api) -> {'remaining': int, 'reset': epoch seconds, 'estimated': not reported by Scopus yet}
+        self.used = {}  # (key, api) -> requests since the last save or quota report, merged into the state file by save()
+        if state_path is not None:
+            self.quota = self.read_state()
+            atexit.register(self.save)
+
+    def remaining(self, key, api):
+        state = self.quota.get((key, api))
+        if state is None or state['reset'] <= time.time():  # never used or quota was reset since
+            return WEEKLY_QUOTAS.get(api, 5000)
+        return state['remaining']
+
+    def acquire(self, api):
+        # pick the key with the most remaining quota that is not throttled, waiting for a token if needed
+        while True:
+            with self._lock:
+                candidates = [key for key in self.keys if self.remaining(key, api) > 0]
+                if len(candidates) == 0:
+                    resets = [self.quota[(key, api)]['reset'] for key in self.keys if (key, api) in self.quota]
+                    raise QuotaExhaustedError('All {:d} API keys are out of quota for {:s}, first reset at {:s}'.format(
+                        len(self.keys), api, time.ctime(min(resets)) if resets else 'unknown'))
+                waits = {key: self.buckets[(key, api)].wait_time() for key in candidates}
+                ready = [key for key in candidates if waits[key] == 0]
+                if ready:
+                    key = max(ready, key=lambda k: self.remaining(k, api))
+                    self.buckets[(key, api)].take()
+                    # count the request now so concurrent requests spread over keys
+                    state = self.quota.get((key, api))
+                    if state is None or state['reset'] <= time.time():  # new quota period
+                        state = {'remaining': WEEKLY_QUOTAS.get(api, 5000), 'reset': time.time() + WEEK_SECONDS,
+                                 'estimated': True}
+                    state['remaining'] -= 1
+                    self.quota[(key, api)] = state
+                    self.used[(key, api)] = self.used.get((key, api), 0) + 1
+                    return key
+                sleep_time = min(waits.values())
+            time.sleep(sleep_time)
+
+    def update(self, key, api, obj):
+        # use the quota Scopus reported with the response
+        try:
+            remaining = obj.get_key_remaining_quota()
+            reset = obj.get_key_reset_time()
+        except AttributeError:
+            return
+        with self._lock:
+            state = self.quota.setdefault((key, api), {'remaining': self.remaining(key, api),
+                                                       'reset': time.time() + WEEK_SECONDS, 'estimated': True})
+            reset = parse_reset(reset)
+            same_period = not state.get('estimated', False) and reset is not None and abs(reset - state['reset']) < 1
+            if remaining is not None:
+                # responses of concurrent requests on the same key can arrive out of order, so within a quota
+                # period the remaining quota only goes down
+                state['remaining'] = min(state['remaining'], int(remaining)) if same_period else int(remaining)
+                state.pop('estimated', None)
+                self.used[(key, api)] = 0  # Scopus counts the requests of all processes up to here
+            if reset is not None:
+                state['reset'] = reset
+
+    def exhaust(self, key, api):
+        with self._lock:
+            state = self.quota.setdefault((key, api), {'remaining': 0, 'reset': time.time() + WEEK_SECONDS})
+            state['remaining'] = 0
+            if state['reset'] <= time.time():
+                state['reset'] = time.time() + WEEK_SECONDS
+
+    def fetch(self, cls, identifier, **kwds):
+        # download through the key with the most headroom, moving on to the next key if one runs out (429)
+        from pybliometrics.scopus.exception import Scopus429Error
+        api = cls.__name__
+        keys = pinned_keys()
+        while True:
+            start = time.perf_counter()
+            key = self.acquire(api)
+            if self.metrics is not None:
+                self.metrics.add_time('wait for API key', time.perf_counter() - start)
+            if keys is not None:  # only this key is sent, also if Scopus answers 429
+                keys.pin(key)
+            try:  # pybliometrics sends the request with this key instead of the first key of its config
+                obj = cls(identifier, apikey=key, **kwds)
+            except Scopus429Error:
+                self.exhaust(key, api)
+                continue
+            finally:
+                if keys is not None:
+                    keys.unpin()
+            self.update(key, api, obj)
+            self.nrequests += 1
+            if self.state_path is not None and self.nrequests % self.save_every == 0:
+                self.save()
+            return obj
+
+    def summary(self):
+        # remaining quota per API, summed over keys
+        with self._lock:
+            return {api: sum(self.remaining(key, api) for key in self.keys) for api in RATE_LIMITS}
+
+    def read_state(self):
+        # (key, api) -> quota state saved in the state file, for the keys of this scheduler
+        quota = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                for entry in json.load(f):
+                    if entry['key'] in self.keys:
+                        quota[(entry['key'], entry['api'])] = {'remaining': entry['remaining'], 'reset': entry['reset']}
+                        if entry.get('estimated', False):
+                            quota[(entry['key'], entry['api'])]['estimated'] = True
+        return quota
+
+    def save(self):
+        # merge with the state file, which other processes may have saved to in between: quota reported by Scopus
+        # wins over local estimates and a later quota period over an earlier one; otherwise the requests made since
+        # the last save (or since Scopus last reported the quota) are taken off the file's count, and the lower of
+        # that and this scheduler's own count is kept
+        with open(self.state_path + '.lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            saved = self.read_state()
+            with self._lock:
+                for (key, api), entry in self.quota.items():
+                    other = saved.get((key, api))
+                    used = self.used.get((key, api), 0)
+                    if other is None:
+                        saved[(key, api)] = dict(entry)
+                    elif other.get('estimated', False) != entry.get('estimated', False):
+                        if other.get('estimated', False):
+                            saved[(key, api)] = dict(entry)
+                        else:
+                            other['remaining'] -= used
+                    elif entry['reset'] > other['reset'] + 1:
+                        saved[(key, api)] = dict(entry)
+                    elif abs(entry['reset'] - other['reset']) < 1:
+                        other['remaining'] = min(other['remaining'] - used, entry['remaining'])
+                self.used = {}
+                self.quota = {(key, api): dict(entry) for (key, api), entry in saved.items()}
+                state = [{'key': key, 'api': api, **entry} for (key, api), entry in saved.items()]
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, indent=1)
+            os.replace(tmp_path, self.state_path)
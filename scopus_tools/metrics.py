@@ -0,0 +1,152 @@
+# Timing and counters for the download scripts
+#
+# One Metrics object per script (or worker process) collects
+#   latency histograms of RecordStore.retrieve calls, per record type, view and store outcome, where the outcome is
+#     hit (stored and fresh), miss (not stored, downloaded), refresh (stored but older than `refresh`) or not_found
+#     (known from an earlier request not to be in Scopus, answered with Scopus404Error without a download)
+#   errors raised by retrieve calls, per record type, view and exception (Scopus404Error, Scopus500Error, JSONDecodeError...)
+#   time spent in named stages, e.g. 'download', 'parse stored record' (timed by the RecordStore) or 'name matching'
+#     (timed by the scripts); stages can be nested and run in several threads, so their times do not add up to the wall time
+# and writes them as a JSON summary and as a Prometheus text file (e.g. for node_exporter's textfile collector):
+#
+#   metrics = Metrics()
+#   store = RecordStore('scopus_records.db', fetch=scheduler.fetch, metrics=metrics)
+#   with metrics.stage('name matching'):
+#       ...
+#   metrics.write('metrics/Neuron2019', labels={'script': 'sc_journal', 'journal': 'Neuron', 'year': 2019})
+#   metrics.reset()  # start counting the next journal-year from zero
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.latency = {}  # (record type, view, outcome) -> {'buckets': [counts], 'count', 'sum', 'max'}
+        self.errors = {}  # (record type, view, exception name) -> count
+        self.stages = {}  # stage -> {'seconds', 'calls'}
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.latency = {}
+            self.errors = {}
+            self.stages = {}
+
+    def observe(self, record_type, view, outcome, seconds):
+        # one retrieve call that took `seconds`, outcome is 'hit', 'miss', 'refresh' or 'not_found'
+        with self._lock:
+            entry = self.latency.setdefault((record_type, view, outcome),
+                                            {'buckets': [0]*(len(LATENCY_BUCKETS) + 1), 'count': 0, 'sum': 0.0, 'max': 0.0})
+            bucket = next((idx for idx, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+            entry['buckets'][bucket] += 1
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+
+    def count_error(self, record_type, view, error):
+        key = (record_type, view, type(error).__name__)
+        with self._lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+            entry['seconds'] += seconds
+            entry['calls'] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def summary(self):
+        # JSON-friendly totals: store outcomes per record type, latency per record type/view/outcome, errors, stages
+        with self._lock:
+            latency, errors, stages = dict(self.latency), dict(self.errors), dict(self.stages)
+        store = {}
+        for (record_type, view, outcome), entry in latency.items():
+            counts = store.setdefault(record_type, {'hit': 0, 'miss': 0, 'refresh': 0, 'not_found': 0})
+            counts[outcome] += entry['count']
+        for counts in store.values():  # answered from the store
+            counts['hit_rate'] = round((counts['hit'] + counts['not_found']) / max(sum(counts.values()), 1), 4)
+        return {'seconds': round(time.time() - self.started, 3),
+                'store': store,
+                'latency': [{'record_type': record_type, 'view': view, 'outcome': outcome,
+                             'count': entry['count'], 'mean_s': round(entry['sum'] / entry['count'], 6),
+                             'p50_s': quantile(entry['buckets'], 0.5), 'p95_s': quantile(entry['buckets'], 0.95),
+                             'max_s': round(entry['max'], 6),
+                             'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], entry['buckets']))}
+                            for (record_type, view, outcome), entry in sorted(latency.items())],
+                'errors': [{'record_type': record_type, 'view': view, 'error': error, 'count': count}
+                           for (record_type, view, error), count in sorted(errors.items())],
+                'stages': {stage: {'seconds': round(entry['seconds'], 3), 'calls': entry['calls']}
+                           for stage, entry in stages.items()}}
+
+    def prometheus(self, labels=None):
+        # the same numbers in the Prometheus text exposition format, labels are added to every sample
+        with self._lock:
+            latency, errors, stages = dict(self.latency), dict(self.errors), dict(self.stages)
+        lines = ['# HELP scopus_retrieve_seconds Latency of record store retrieve calls',
+                 '# TYPE scopus_retrieve_seconds histogram']
+        for (record_type, view, outcome), entry in sorted(latency.items()):
+            sample_labels = dict(labels or {}, record_type=record_type, view=view, outcome=outcome)
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], entry['buckets']):
+                cumulative += count
+                lines.append('scopus_retrieve_seconds_bucket' + label_str(dict(sample_labels, le=bound)) + ' ' + str(cumulative))
+            lines.append('scopus_retrieve_seconds_sum' + label_str(sample_labels) + ' ' + repr(entry['sum']))
+            lines.append('scopus_retrieve_seconds_count' + label_str(sample_labels) + ' ' + str(entry['count']))
+        lines += ['# HELP scopus_retrieve_errors_total Exceptions raised by record store retrieve calls',
+                  '# TYPE scopus_retrieve_errors_total counter']
+        for (record_type, view, error), count in sorted(errors.items()):
+            lines.append('scopus_retrieve_errors_total' + label_str(dict(labels or {}, record_type=record_type, view=view, error=error))
+                         + ' ' + str(count))
+        lines += ['# HELP scopus_stage_seconds_total Time spent in each stage of the script',
+                  '# TYPE scopus_stage_seconds_total counter']
+        for stage, entry in sorted(stages.items()):
+            lines.append('scopus_stage_seconds_total' + label_str(dict(labels or {}, stage=stage)) + ' ' + repr(entry['seconds']))
+        lines += ['# HELP scopus_stage_calls_total Number of times each stage of the script ran',
+                  '# TYPE scopus_stage_calls_total counter']
+        for stage, entry in sorted(stages.items()):
+            lines.append('scopus_stage_calls_total' + label_str(dict(labels or {}, stage=stage)) + ' ' + str(entry['calls']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path_prefix, labels=None):
+        # writes path_prefix.json and path_prefix.prom (replacing them in one step, so readers never see half a file)
+        os.makedirs(os.path.dirname(os.path.abspath(path_prefix)), exist_ok=True)
+        summary = dict(self.summary(), labels=labels or {})
+        for ext, text in (('.json', json.dumps(summary, indent=1)), ('.prom', self.prometheus(labels))):
+            with open(path_prefix + ext + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(path_prefix + ext + '.tmp', path_prefix + ext)
+
+
+def quantile(buckets, q):
+    # upper bound of the histogram bucket containing quantile q (None for the +Inf bucket)
+    target = q*sum(buckets)
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + (None,), buckets):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return None
+
+
+def label_str(labels):
+    if not labels:
+        return ''
+    escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in labels.items()}
+    return '{' + ','.join('{:s}="{:s}"'.format(name, value) for name, value in escaped.items()) + '}'
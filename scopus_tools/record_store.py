@@ -0,0 +1,314 @@
+# Packed local store for Scopus records
+#
+# pybliometrics caches every retrieval as its own JSON file, which means millions of small files for a whole
+# corpus. The RecordStore keeps the same JSON in a single SQLite file instead, keyed by
+# (record type, identifier, view), with each record compressed (zstandard if installed, zlib otherwise).
+#
+# Records Scopus does not have (Scopus404Error) are remembered too, with the time they were asked for, so they are
+# not requested again until they are older than `refresh`; retrieve raises Scopus404Error for them right away.
+#
+# Pass a Metrics object (see metrics.py) to time retrieve calls, count hits/misses/refreshes and errors.
+#
+# pybliometrics is still what builds the AbstractRetrieval/AuthorRetrieval/AffiliationRetrieval objects: on a hit,
+# the stored JSON is written to the cache path of the current pybliometrics config with its original modification
+# time, so pybliometrics applies its usual `refresh` logic (True/False or number of days), and the file is removed
+# again afterwards. Processes sharing a store (and cache folder) lock the record while they do this, so one does not
+# remove the file while another is reading it.
+#
+# Requirements:
+#   installed pybliometrics (see https://pybliometrics.readthedocs.io/en/stable/)
+#   optional: zstandard (pip install zstandard) for better compression
+
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:  # record locks between processes (not available on Windows, where only threads are locked)
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# views pybliometrics uses when none is given, so that records are keyed the same way with or without a view
+DEFAULT_VIEWS = {'AbstractRetrieval': 'META_ABS', 'AuthorRetrieval': 'ENHANCED', 'AffiliationRetrieval': 'STANDARD'}
+
+# pybliometrics cache folder names for each record type
+CACHE_FOLDERS = {'abstract_retrieval': 'AbstractRetrieval', 'author_retrieval': 'AuthorRetrieval',
+                 'affiliation_retrieval': 'AffiliationRetrieval'}
+
+
+def compress(data):
+    # returns (codec, compressed bytes)
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'zlib', zlib.compress(data, 6)
+
+
+def decompress(codec, blob):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('record was compressed with zstandard, please install it (pip install zstandard)')
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+
+def cache_file_path(record_type, identifier, view):
+    # file pybliometrics reads and writes for a record, with the folders of its config and its own file names
+    try:
+        from pybliometrics.scopus.utils import get_folder
+    except ImportError:
+        from pybliometrics.utils import get_folder
+    identifier = str(identifier)
+    if record_type == 'AuthorRetrieval':
+        stem = identifier.split('-')[-1]
+    elif record_type == 'AffiliationRetrieval':
+        stem = str(int(identifier.split('-')[-1]))
+    else:
+        stem = identifier.replace('/', '_')
+    return str(get_folder(record_type, view) / stem)
+
+
+def is_stale(mtime, refresh):
+    # same rules as pybliometrics: refresh=True always refreshes, an int refreshes records older than that many days
+    if isinstance(refresh, bool):
+        return refresh
+    return (time.time() - mtime) / 86400 > refresh
+
+
+class RecordStore:
+
+    def __init__(self, path, fetch=None, metrics=None):
+        # fetch(cls, identifier, **kwds) is used for records that need downloading (default: call cls directly),
+        # e.g. KeyScheduler.fetch to spread downloads over several API keys
+        self.path = path
+        self.metrics = metrics
+        self.fetch = fetch if fetch is not None else (lambda cls, identifier, **kwds: cls(identifier, **kwds))
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(64)]  # one download per record at a time
+        self._lock_file = open(path + '.lock', 'a+b') if fcntl is not None else None  # same, between processes
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS records (
+                                  record_type TEXT NOT NULL,
+                                  identifier TEXT NOT NULL,
+                                  view TEXT NOT NULL,
+                                  cache_path TEXT,
+                                  mtime REAL NOT NULL,
+                                  codec TEXT NOT NULL,
+                                  data BLOB NOT NULL,
+                                  PRIMARY KEY (record_type, identifier, view)) WITHOUT ROWID''')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS not_found (
+                                  record_type TEXT NOT NULL,
+                                  identifier TEXT NOT NULL,
+                                  view TEXT NOT NULL,
+                                  mtime REAL NOT NULL,
+                                  PRIMARY KEY (record_type, identifier, view)) WITHOUT ROWID''')
+        self._conn.commit()
+
+    def get(self, record_type, identifier, view):
+        # returns (raw JSON bytes, modification time, cache path the record was stored from) or None
+        with self._lock:
+            row = self._conn.execute('SELECT data, codec, mtime, cache_path FROM records '
+                                     'WHERE record_type=? AND identifier=? AND view=?',
+                                     (record_type, str(identifier), view)).fetchone()
+        if row is None:
+            return None
+        return decompress(row[1], row[0]), row[2], row[3]
+
+    def put(self, record_type, identifier, view, data, mtime=None, cache_path=None):
+        codec, blob = compress(data)
+        mtime = time.time() if mtime is None else mtime
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (record_type, str(identifier), view, cache_path, mtime, codec, blob))
+            self._conn.execute('DELETE FROM not_found WHERE record_type=? AND identifier=? AND view=?',
+                               (record_type, str(identifier), view))
+            self._conn.commit()
+
+    def put_many(self, rows):
+        # rows of (record_type, identifier, view, data, mtime, cache_path), written in one transaction
+        packed = []
+        for record_type, identifier, view, data, mtime, cache_path in rows:
+            codec, blob = compress(data)
+            packed.append((record_type, str(identifier), view, cache_path, mtime, codec, blob))
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)', packed)
+            self._conn.executemany('DELETE FROM not_found WHERE record_type=? AND identifier=? AND view=?',
+                                   [row[:3] for row in packed])
+            self._conn.commit()
+
+    def mark_not_found(self, record_type, identifier, view, mtime=None):
+        # remember that Scopus does not have this record (it answered with a 404)
+        mtime = time.time() if mtime is None else mtime
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO not_found VALUES (?, ?, ?, ?)',
+                               (record_type, str(identifier), view, mtime))
+            self._conn.commit()
+
+    def is_not_found(self, record_type, identifier, view, refresh=False):
+        # True if Scopus did not have this record when it was last asked for, and that is not older than refresh
+        with self._lock:
+            row = self._conn.execute('SELECT mtime FROM not_found WHERE record_type=? AND identifier=? AND view=?',
+                                     (record_type, str(identifier), view)).fetchone()
+        return row is not None and not is_stale(row[0], refresh)
+
+    def contains(self, record_type, identifier, view, refresh=False):
+        # True if a record is stored and would not be refreshed
+        with self._lock:
+            row = self._conn.execute('SELECT mtime FROM records WHERE record_type=? AND identifier=? AND view=?',
+                                     (record_type, str(identifier), view)).fetchone()
+        return row is not None and not is_stale(row[0], refresh)
+
+    def known(self, record_type, identifier, view, refresh=False):
+        # True if retrieve would answer without a download: stored, or known not to be in Scopus
+        return self.contains(record_type, identifier, view, refresh) or self.is_not_found(record_type, identifier, view, refresh)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def iter_records(self, record_type, view=None):
+        # (identifier, view, raw JSON bytes) of every stored record of a type (and view), read in batches
+        query = 'SELECT identifier, view, codec, data FROM records WHERE record_type=?'
+        params = (record_type,) if view is None else (record_type, view)
+        query += '' if view is None else ' AND view=?'
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute(query, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for identifier, row_view, codec, blob in rows:
+                yield identifier, row_view, decompress(codec, blob)
+
+    def retrieve(self, cls, identifier, refresh=False, view=None, **kwds):
+        # drop-in for cls(identifier, refresh=refresh, view=view, **kwds), e.g.
+        #   store.retrieve(AbstractRetrieval, eid, refresh=refresh_days, view='FULL')
+        # raises the same exceptions as pybliometrics (Scopus404Error etc.)
+        from pybliometrics.scopus.exception import Scopus404Error
+        record_type = cls.__name__
+        view = view if view is not None else DEFAULT_VIEWS.get(record_type, '')
+        key = (record_type, str(identifier), view)
+        start = time.perf_counter()
+        outcome = 'miss'
+
+        try:
+            with self._record_lock(key):
+                stage_start = time.perf_counter()
+                stored = self.get(*key)
+                cache_path = None
+                if (stored is None or is_stale(stored[1], refresh)) and self.is_not_found(*key, refresh=refresh):
+                    outcome = 'not_found'
+                    self._add_time('read store', stage_start)
+                    raise Scopus404Error('The resource specified cannot be found. (known from an earlier request)')
+                if stored is not None:  # put record back where pybliometrics looks for it
+                    data, mtime = stored[:2]
+                    cache_path = cache_file_path(record_type, identifier, view)
+                    with open(cache_path, 'wb') as f:
+                        f.write(data)
+                    os.utime(cache_path, (mtime, mtime))
+                    outcome = 'refresh' if is_stale(mtime, refresh) else 'hit'
+                self._add_time('read store', stage_start)
+
+                try:
+                    stage_start = time.perf_counter()
+                    if outcome == 'hit':
+                        obj = cls(identifier, refresh=refresh, view=view, **kwds)  # read from the stored record only
+                        self._add_time('parse stored record', stage_start)
+                    else:
+                        try:
+                            obj = self.fetch(cls, identifier, refresh=refresh, view=view, **kwds)
+                        except Scopus404Error:
+                            self.mark_not_found(*key)
+                            raise
+                        self._add_time('download', stage_start)
+                    cache_path = str(obj._cache_file_path)
+                    new_mtime = os.path.getmtime(cache_path)
+                    if stored is None or new_mtime != stored[1]:  # new or refreshed record
+                        stage_start = time.perf_counter()
+                        with open(cache_path, 'rb') as f:
+                            self.put(record_type, identifier, view, f.read(), new_mtime, cache_path)
+                        self._add_time('write store', stage_start)
+                finally:
+                    if cache_path is not None and os.path.exists(cache_path):
+                        os.remove(cache_path)
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.count_error(record_type, view, e)
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe(record_type, view, outcome, time.perf_counter() - start)
+        return obj
+
+    @contextmanager
+    def _record_lock(self, key):
+        # lock a record (one of 64 buckets) for the threads of this process and, where possible, other processes
+        bucket = zlib.crc32('\t'.join(key).encode()) % len(self._key_locks)
+        with self._key_locks[bucket]:
+            if self._lock_file is None:
+                yield
+                return
+            fcntl.lockf(self._lock_file, fcntl.LOCK_EX, 1, bucket)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, bucket)
+
+    def _add_time(self, stage, start):
+        if self.metrics is not None:
+            self.metrics.add_time(stage, time.perf_counter() - start)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+
+def import_cache(store, cache_dir, delete=False, batch_size=5000):
+    # import an existing pybliometrics cache directory (e.g. ~/.pybliometrics/Scopus) into the store
+    # layout is <cache_dir>/<record folder>/<view>/<identifier>, returns number of imported records
+    # (the files' paths are kept for reference only, hits are served from the folders of the current config)
+    nimported = 0
+    batch = []
+    imported_paths = []
+    for folder, record_type in CACHE_FOLDERS.items():
+        record_dir = os.path.join(cache_dir, folder)
+        if not os.path.isdir(record_dir):
+            continue
+        for view_entry in os.scandir(record_dir):
+            if not view_entry.is_dir():
+                continue
+            for file_entry in os.scandir(view_entry.path):
+                if not file_entry.is_file():
+                    continue
+                with open(file_entry.path, 'rb') as f:
+                    data = f.read()
+                batch.append((record_type, file_entry.name, view_entry.name, data,
+                              file_entry.stat().st_mtime, os.path.abspath(file_entry.path)))
+                imported_paths.append(file_entry.path)
+                if len(batch) >= batch_size:
+                    store.put_many(batch)
+                    nimported += len(batch)
+                    batch = []
+                    if delete:
+                        for path in imported_paths:
+                            os.remove(path)
+                    imported_paths = []
+    if batch:
+        store.put_many(batch)
+        nimported += len(batch)
+    if delete:
+        for path in imported_paths:
+            os.remove(path)
+    return nimported
@@ -0,0 +1,93 @@
+# Author IDs of cited papers, shared by all authors of a run
+#
+# self_citation_author.py needs the author IDs of every reference that the REF view of the citing article does not
+# cover, which means reading (or downloading) the FULL record of the cited paper. Authors of the same group cite the
+# same papers, so the ReferenceAuthorCache keeps these lists in memory and in a small SQLite file
+# (EID -> author IDs, or None if Scopus does not have the paper or its author IDs), which is checked before the
+# record store. Entries older than `refresh` days are computed again, like records in the store.
+#
+#   cache = ReferenceAuthorCache('reference_authors.db', refresh=30)
+#   auids = cache.get(eid, download_reference_authors)  # download_reference_authors(eid) -> np.array or None
+#   cache.flush()
+#   print(cache.stats())
+
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class ReferenceAuthorCache:
+
+    def __init__(self, path=None, refresh=30, flush_every=1000):
+        # path=None keeps the lists in memory only
+        self.path = path
+        self.refresh = refresh
+        self.flush_every = flush_every
+        self.memory = {}  # eid -> np.array of author IDs or None
+        self.pending = []  # (eid, JSON author IDs or None, time) not written to disk yet
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS reference_authors (
+                                      eid TEXT PRIMARY KEY,
+                                      auids TEXT,
+                                      mtime REAL NOT NULL)''')
+            self._conn.commit()
+
+    def _read_disk(self, eid):
+        # (found, author IDs) from the file, entries older than refresh days count as not found
+        if self._conn is None:
+            return False, None
+        row = self._conn.execute('SELECT auids, mtime FROM reference_authors WHERE eid=?', (eid,)).fetchone()
+        if row is None or (time.time() - row[1]) / 86400 > self.refresh:
+            return False, None
+        return True, (None if row[0] is None else np.array(json.loads(row[0])))
+
+    def get(self, eid, compute):
+        # author IDs of the paper with this EID, compute(eid) is called if no one asked for it before
+        with self._lock:
+            if eid in self.memory:
+                self.memory_hits += 1
+                return self.memory[eid]
+            found, auids = self._read_disk(eid)
+            if found:
+                self.disk_hits += 1
+                self.memory[eid] = auids
+                return auids
+        auids = compute(eid)
+        with self._lock:
+            self.misses += 1
+            self.memory[eid] = auids
+            if self._conn is not None:
+                self.pending.append((eid, None if auids is None else json.dumps([int(auid) for auid in auids]), time.time()))
+                if len(self.pending) >= self.flush_every:
+                    self._flush()
+        return auids
+
+    def _flush(self):
+        if self._conn is not None and self.pending:
+            self._conn.executemany('INSERT OR REPLACE INTO reference_authors VALUES (?, ?, ?)', self.pending)
+            self._conn.commit()
+        self.pending = []
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def stats(self):
+        # lookups, how many were reused (from this run or from the file) and how many had to be computed
+        with self._lock:
+            return {'lookups': self.memory_hits + self.disk_hits + self.misses, 'reused_memory': self.memory_hits,
+                    'reused_disk': self.disk_hits, 'computed': self.misses}
+
+    def close(self):
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
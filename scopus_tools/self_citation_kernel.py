@@ -0,0 +1,146 @@
+# Self-citations of many references at once
+#
+# sc_by_pair.py and self_citation_author.py check, reference by reference, which authors of the citing paper are
+# also authors of the cited paper (Python membership tests on lists or arrays). This module does the same for a
+# whole batch (e.g., a journal-year) with sorted numpy arrays: the (reference, author) pairs of the cited papers are
+# sorted once, and every (reference, citing author) pair is looked up with one np.searchsorted call.
+# For each reference it returns
+#   sc_fa, sc_la     1 if the first / last author of the citing paper is an author of the cited paper, else 0
+#   sc_any           number of authors of the citing paper (counting every author position) who are authors of it
+#   position_fa_sc   position (from 0) of the citing first / last author in the cited paper's author list,
+#   position_la_sc   first occurrence, -1 if not a self-citation
+# and -1 for all of them if the authors of the cited paper (or of the citing paper) are not known, which is the same
+# as what the per-reference code computes.
+#
+#   batch = SelfCitationBatch()
+#   rows = batch.add(citing_auids, [cited_auids or None for each reference])  # slice of this paper's references
+#   sc = batch.compute()
+#   sc['sc_fa'][rows]
+#
+# or, for papers of a citation graph (scopus_tools/citation_graph.py):
+#   sc = graph_self_citations(graph, graph.citing_papers(journals=['Neuron'], years=[2019]))
+
+import numpy as np
+
+from scopus_tools.citation_graph import AUTHORS_FROM_RECORD, AUTHORS_FROM_REF, AUTHORS_PARTIAL
+
+COLUMNS = ['sc_fa', 'sc_la', 'sc_any', 'position_fa_sc', 'position_la_sc']
+
+
+def gather(indptr, indices, rows):
+    # CSR (indptr, indices) of the given rows, in that order
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(indptr, dtype=np.int64)[rows]
+    lengths = np.asarray(indptr, dtype=np.int64)[rows + 1] - starts
+    new_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_indptr[1:])
+    entry_row = np.repeat(np.arange(len(rows)), lengths)
+    entries = starts[entry_row] + np.arange(new_indptr[-1]) - new_indptr[entry_row]
+    return new_indptr, np.asarray(indices)[entries]
+
+
+def self_citations(citing_indptr, citing_authors, ref_citing, cited_indptr, cited_authors, cited_known=None):
+    '''
+    citing_authors[citing_indptr[p]:citing_indptr[p+1]]: author IDs of citing paper p, in author order
+    ref_citing[r]: citing paper of reference r
+    cited_authors[cited_indptr[r]:cited_indptr[r+1]]: author IDs of the paper cited by reference r, in author order
+    cited_known[r]: False if the authors of reference r are not known (default: all known)
+    Author IDs can be Scopus author IDs or indices from an interned graph.
+    Returns a dict of int64 arrays with one entry per reference (see COLUMNS)
+    '''
+    citing_indptr = np.asarray(citing_indptr, dtype=np.int64)
+    cited_indptr = np.asarray(cited_indptr, dtype=np.int64)
+    ref_citing = np.asarray(ref_citing, dtype=np.int64)
+    nrefs = len(ref_citing)
+    known = np.ones(nrefs, dtype=bool) if cited_known is None else np.asarray(cited_known, dtype=bool).copy()
+    ncited = np.diff(cited_indptr)
+
+    # intern the author IDs, so that (reference, author) fits into one int64 key
+    author_ids, codes = np.unique(np.concatenate([np.asarray(citing_authors, dtype=np.int64),
+                                                  np.asarray(cited_authors, dtype=np.int64)]), return_inverse=True)
+    nauthors = max(len(author_ids), 1)
+    citing_codes = codes[:len(citing_authors)]
+    cited_codes = codes[len(citing_authors):]
+
+    # cited side: sorted (reference, author) keys, with the author position; the stable sort keeps the first
+    # occurrence of an author in a reference first
+    cited_row = np.repeat(np.arange(nrefs, dtype=np.int64), ncited)
+    cited_position = np.arange(len(cited_codes), dtype=np.int64) - cited_indptr[cited_row]
+    cited_keys = cited_row * nauthors + cited_codes
+    order = np.argsort(cited_keys, kind='stable')
+    cited_keys = cited_keys[order]
+    cited_position = cited_position[order]
+
+    # citing side: every author of the citing paper for every reference
+    query_indptr, query_codes = gather(citing_indptr, citing_codes, ref_citing)
+    nquery = np.diff(query_indptr)
+    known &= nquery > 0
+    query_row = np.repeat(np.arange(nrefs, dtype=np.int64), nquery)
+    query_keys = query_row * nauthors + query_codes
+    found_at = np.searchsorted(cited_keys, query_keys)
+    found = found_at < len(cited_keys)
+    found[found] = cited_keys[found_at[found]] == query_keys[found]
+    position = np.full(len(query_keys), -1, dtype=np.int64)
+    position[found] = cited_position[found_at[found]]
+
+    result = {name: np.full(nrefs, -1, dtype=np.int64) for name in COLUMNS}
+    rows = np.flatnonzero(known)
+    first_query = query_indptr[rows]
+    last_query = query_indptr[rows + 1] - 1
+    result['sc_fa'][rows] = found[first_query]
+    result['sc_la'][rows] = found[last_query]
+    result['sc_any'][rows] = np.bincount(query_row, weights=found, minlength=nrefs)[rows].astype(np.int64)
+    result['position_fa_sc'][rows] = position[first_query]
+    result['position_la_sc'][rows] = position[last_query]
+    return result
+
+
+class SelfCitationBatch:
+    # collects citing papers and the author IDs of their references, compute() runs the kernel on all of them
+
+    def __init__(self):
+        self.citing_indptr = [0]
+        self.citing_authors = []
+        self.ref_citing = []
+        self.cited_indptr = [0]
+        self.cited_authors = []
+        self.cited_known = []
+
+    def __len__(self):
+        return len(self.ref_citing)
+
+    def add(self, citing_auids, cited_auids):
+        # citing_auids: author IDs of the citing paper; cited_auids: one entry per reference, its author IDs or None
+        # if not known. Returns the slice of this paper's references in the results of compute()
+        paper = len(self.citing_indptr) - 1
+        self.citing_authors.extend(int(auid) for auid in citing_auids)
+        self.citing_indptr.append(len(self.citing_authors))
+        start = len(self.ref_citing)
+        for auids in cited_auids:
+            self.ref_citing.append(paper)
+            self.cited_known.append(auids is not None)
+            if auids is not None:
+                self.cited_authors.extend(int(auid) for auid in auids)
+            self.cited_indptr.append(len(self.cited_authors))
+        return slice(start, len(self.ref_citing))
+
+    def compute(self):
+        return self_citations(self.citing_indptr, np.array(self.citing_authors, dtype=np.int64), self.ref_citing,
+                              self.cited_indptr, np.array(self.cited_authors, dtype=np.int64), self.cited_known)
+
+
+def graph_self_citations(graph, papers):
+    # self-citations of all references of some papers of a CitationGraph (e.g., graph.citing_papers(...)).
+    # Returns the results of self_citations() plus 'citing' and 'cited' (paper indices) for each reference.
+    # References whose authors are not in the graph are -1; for graphs built from sc_by_pair csv files only the
+    # first and last authors are known (AUTHORS_PARTIAL), so sc_any and positions only count those.
+    papers = np.asarray(papers, dtype=np.int64)
+    ref_indptr, cited = gather(graph.ref_indptr, graph.ref_indices, papers)
+    ref_citing = np.repeat(np.arange(len(papers), dtype=np.int64), np.diff(ref_indptr))
+    citing_indptr, citing_authors = gather(graph.author_indptr, graph.author_indices, papers)
+    cited_indptr, cited_authors = gather(graph.author_indptr, graph.author_indices, cited)
+    cited_known = (np.asarray(graph.flags)[cited] & (AUTHORS_FROM_RECORD | AUTHORS_FROM_REF | AUTHORS_PARTIAL)) > 0
+    result = self_citations(citing_indptr, citing_authors, ref_citing, cited_indptr, cited_authors, cited_known)
+    result['citing'] = papers[ref_citing]
+    result['cited'] = cited.astype(np.int64)
+    return result
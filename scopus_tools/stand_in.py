@@ -0,0 +1,468 @@
+# Local stand-in for the Scopus APIs the scripts use
+#
+# Serves the abstract (META_ABS, REF, FULL), author (incl. the Scopus search behind get_documents) and affiliation
+# retrieval endpoints from local data, so the download scripts can be run and timed without VPN access or quota:
+#   - records in a RecordStore (e.g. an imported pybliometrics cache, or a recording made with upstream=...)
+#   - synthetic records, built from plain dicts with the *_payload functions below
+# Faults can be injected (latency, 404/500/429 responses and malformed JSON), which reach the scripts as the
+# exceptions they already handle (Scopus404Error, Scopus500Error/HTTP errors, Scopus429Error, JSONDecodeError).
+# With upstream='https://api.elsevier.com' records that are not available locally are downloaded with the caller's
+# API key, passed on and added to the store, so a real session can be recorded once and replayed later.
+#
+#   server = StandInServer(store=RecordStore('recording.db'), faults=Faults(latency=0.05, errors={404: 0.01}))
+#   server.start()
+#   use_stand_in(server.url)  # pybliometrics now sends its requests to the stand-in
+#
+# or, for the scripts, run the server on its own and set SCOPUS_STAND_IN (read when scopus_tools is imported):
+#   python -m scopus_tools.stand_in --store recording.db --port 8080 --latency 0.05 --errors 404=0.01,500=0.01
+#   SCOPUS_STAND_IN=http://127.0.0.1:8080 python self_citation_author.py --ID 25628822400 --store offline.db
+#
+# Requirements:
+#   installed pybliometrics, with a config file holding at least one (possibly made up) API key
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCOPUS_URL = 'https://api.elsevier.com'
+
+# path prefix -> record type
+ENDPOINTS = {'/content/abstract/': 'AbstractRetrieval', '/content/author/author_id/': 'AuthorRetrieval',
+             '/content/affiliation/affiliation_id/': 'AffiliationRetrieval', '/content/search/scopus': 'ScopusSearch'}
+ERROR_TEXT = {404: ('RESOURCE_NOT_FOUND', 'The resource specified cannot be found.'),
+              429: ('QUOTA_EXCEEDED', 'Quota Exceeded'),
+              500: ('GENERAL_SYSTEM_ERROR', 'The system encountered an unexpected error.')}
+
+_original_urls = {}
+
+
+def pybliometrics_urls():
+    # the URL table pybliometrics builds its requests from (changed in place, so every module sees the change)
+    try:
+        from pybliometrics.scopus.utils.constants import URLS
+    except ImportError:
+        from pybliometrics.utils.constants import URLS
+    return URLS
+
+
+def use_stand_in(url):
+    # send pybliometrics requests to the stand-in at url instead of api.elsevier.com (url=None switches back)
+    urls = pybliometrics_urls()
+    if not _original_urls:
+        _original_urls.update(urls)
+    for api, original in _original_urls.items():
+        urls[api] = original if url is None else original.replace(SCOPUS_URL, url.rstrip('/'))
+
+
+######################## synthetic records ########################
+# paper: {'eid', 'title', 'cover_date' ('YYYY-MM-DD'), 'journal', 'authors': [author, ...], 'references': [eid, ...],
+#         'keywords': [...]}, author entries: {'auid', 'surname', 'given_name', 'affiliation' (id or None)}
+
+def indexed_name(author):
+    return author['surname'] + ' ' + ''.join(part[0] + '.' for part in author['given_name'].split())
+
+
+def abstract_payload(paper, view='FULL', papers=None):
+    # abstracts-retrieval-response of a paper; references are looked up in papers (eid -> paper), references that
+    # are not in papers appear without authors in the FULL view and are left out of the REF view (as with Scopus)
+    papers = papers or {}
+    scopus_id = paper['eid'].replace('2-s2.0-', '')
+    authors = [{'@seq': str(seq + 1), '@auid': str(author['auid']), 'ce:surname': author['surname'],
+                'ce:given-name': author['given_name'], 'ce:indexed-name': indexed_name(author),
+                'preferred-name': {'ce:surname': author['surname'], 'ce:given-name': author['given_name'],
+                                   'ce:indexed-name': indexed_name(author)},
+                'affiliation': {'@id': str(author['affiliation'])} if author.get('affiliation') is not None else None}
+               for seq, author in enumerate(paper['authors'])]
+    response = {'coredata': {'eid': paper['eid'], 'dc:identifier': 'SCOPUS_ID:' + scopus_id, 'dc:title': paper['title'],
+                             'prism:coverDate': paper['cover_date'], 'prism:publicationName': paper['journal'],
+                             'prism:aggregationType': 'Journal', 'subtype': 'ar', 'subtypeDescription': 'Article',
+                             'citedby-count': '0'},
+                'authors': {'author': authors}}
+    if paper.get('keywords'):
+        response['authkeywords'] = {'author-keyword': [{'$': keyword} for keyword in paper['keywords']]}
+    if view == 'REF':
+        references = []
+        for position, eid in enumerate(paper['references']):
+            cited = papers.get(eid)
+            if cited is None:
+                continue
+            references.append({'@id': str(position + 1), 'scopus-id': eid.replace('2-s2.0-', ''),
+                               'title': cited['title'], 'sourcetitle': cited['journal'],
+                               'prism:coverDate': cited['cover_date'], 'type': 'resolvedReference',
+                               'author-list': {'author': [{'@seq': str(seq + 1), '@auid': str(author['auid']),
+                                                           'ce:surname': author['surname'],
+                                                           'ce:given-name': author['given_name'],
+                                                           'ce:indexed-name': indexed_name(author)}
+                                                          for seq, author in enumerate(cited['authors'])]}})
+        return {'abstracts-retrieval-response': {'references': {'@total-references': str(len(references)),
+                                                                'reference': references}}}
+    if view == 'FULL':
+        references = []
+        for position, eid in enumerate(paper['references']):
+            cited = papers.get(eid)
+            info = {'refd-itemidlist': {'itemid': [{'$': eid.replace('2-s2.0-', ''), '@idtype': 'SGR'}]}}
+            if cited is not None:
+                info['ref-title'] = {'ref-titletext': cited['title']}
+                info['ref-sourcetitle'] = cited['journal']
+                info['ref-publicationyear'] = {'@first': cited['cover_date'][:4]}
+                info['ref-authors'] = {'author': [{'@seq': str(seq + 1), 'ce:surname': author['surname'],
+                                                   'ce:initials': ''.join(part[0] + '.' for part in author['given_name'].split())}
+                                                  for seq, author in enumerate(cited['authors'])]}
+            references.append({'@id': str(position + 1), 'ref-info': info})
+        response['item'] = {'bibrecord': {'head': {}, 'tail': {'bibliography': {'@refcount': str(len(references)),
+                                                                                'reference': references}}}}
+    return {'abstracts-retrieval-response': response}
+
+
+def author_payload(author, documents=(), h_index=None):
+    # author-retrieval-response of an author ({'auid', 'surname', 'given_name', 'affiliation'}) with documents (papers)
+    years = [int(paper['cover_date'][:4]) for paper in documents]
+    profile = {'preferred-name': {'surname': author['surname'], 'given-name': author['given_name'],
+                                  'indexed-name': indexed_name(author)},
+               'status': 'update'}
+    if years:
+        profile['publication-range'] = {'@start': str(min(years)), '@end': str(max(years))}
+    if author.get('affiliation') is not None:
+        profile['affiliation-current'] = {'affiliation': {'@affiliation-id': str(author['affiliation'])}}
+    return {'author-retrieval-response': [{
+        'coredata': {'dc:identifier': 'AUTHOR_ID:' + str(author['auid']), 'eid': '9-s2.0-' + str(author['auid']),
+                     'document-count': str(len(documents)), 'cited-by-count': '0', 'citation-count': '0'},
+        'h-index': str(h_index if h_index is not None else min(len(documents), 10)),
+        'author-profile': profile}]}
+
+
+def affiliation_payload(affiliation_id, name, country, city=None):
+    return {'affiliation-retrieval-response': {
+        'coredata': {'dc:identifier': 'AFFILIATION_ID:' + str(affiliation_id), 'eid': '10-s2.0-' + str(affiliation_id),
+                     'document-count': '0', 'author-count': '0'},
+        'affiliation-name': name, 'country': country, 'city': city}}
+
+
+def search_entry(paper):
+    # Scopus search result of a paper, as returned for an author's documents (get_documents)
+    entry = {'eid': paper['eid'], 'dc:identifier': 'SCOPUS_ID:' + paper['eid'].replace('2-s2.0-', ''),
+             'dc:title': paper['title'], 'prism:coverDate': paper['cover_date'],
+             'prism:coverDisplayDate': paper['cover_date'], 'prism:publicationName': paper['journal'],
+             'prism:aggregationType': 'Journal', 'subtype': 'ar', 'subtypeDescription': 'Article',
+             'citedby-count': '0', 'openaccess': '0', 'author-count': {'$': str(len(paper['authors']))},
+             'author': [{'authid': str(author['auid']), 'surname': author['surname'], 'given-name': author['given_name'],
+                         'authname': indexed_name(author)} for author in paper['authors']]}
+    if paper.get('keywords'):
+        entry['authkeywords'] = ' | '.join(paper['keywords'])
+    return entry
+
+
+class PayloadSource:
+    # in-memory records: {(record type, identifier, view): JSON dict or bytes}, and search results
+    # {(query, view): [entry, ...]}; subclasses can build records on demand by overriding get() and search()
+
+    def __init__(self, records=None, searches=None):
+        self.records = records if records is not None else {}
+        self.searches = searches if searches is not None else {}
+
+    def get(self, record_type, identifier, view):
+        record = self.records.get((record_type, identifier, view))
+        if record is None or isinstance(record, bytes):
+            return record
+        return json.dumps(record).encode()
+
+    def search(self, query, view):
+        return self.searches.get((query, view), self.searches.get((query, None)))
+
+
+class StoreSource:
+    # records of a RecordStore (raw Scopus responses, as pybliometrics caches them); search results are stored as
+    # ('ScopusSearch', query, view) records with one JSON entry per line (pybliometrics' cache format for searches)
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, record_type, identifier, view):
+        stored = self.store.get(record_type, identifier, view)
+        return stored[0] if stored is not None else None
+
+    def search(self, query, view):
+        stored = self.store.get('ScopusSearch', query, view)
+        if stored is None:
+            return None
+        return [json.loads(line) for line in stored[0].decode().split('\n') if line]
+
+    def not_found(self, record_type, identifier, view):
+        # recorded 404s, so a replay fails where the recorded session failed
+        return self.store.get('NotFound', record_type + '/' + identifier, view) is not None
+
+
+######################## faults ########################
+
+class Faults:
+
+    def __init__(self, latency=0, jitter=0, errors=None, malformed=0, fixed=None, seed=0):
+        # latency: seconds added to every response (plus up to jitter seconds at random)
+        # errors: {status: probability}, e.g. {404: 0.01, 500: 0.005, 429: 0.001}
+        # malformed: probability of a truncated (invalid JSON) body
+        # fixed: {identifier: status or 'malformed'}, always applied to these records
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors or {}
+        self.malformed = malformed
+        self.fixed = {str(identifier): fault for identifier, fault in (fixed or {}).items()}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            jitter = self._random.random()*self.jitter if self.jitter else 0
+        return self.latency + jitter
+
+    def draw(self, identifier):
+        # None, an HTTP status or 'malformed'
+        if identifier in self.fixed:
+            return self.fixed[identifier]
+        with self._lock:
+            for status, probability in self.errors.items():
+                if self._random.random() < probability:
+                    return int(status)
+            if self.malformed and self._random.random() < self.malformed:
+                return 'malformed'
+        return None
+
+
+def parse_errors(text):
+    # "404=0.01,500=0.005" -> {404: 0.01, 500: 0.005}
+    errors = {}
+    for item in filter(None, text.split(',')):
+        status, probability = item.split('=')
+        errors[int(status)] = float(probability)
+    return errors
+
+
+######################## server ########################
+
+class StandInServer:
+
+    def __init__(self, store=None, payloads=None, faults=None, upstream=None, host='127.0.0.1', port=0,
+                 quota=None, timeout=30):
+        # store: RecordStore to serve (and record into), payloads: PayloadSource (or any object with get/search),
+        # upstream: URL to download missing records from (recording), quota: weekly requests per key and API
+        # (None: unlimited), after which that key gets 429 responses
+        self.sources = [source for source in (payloads, StoreSource(store) if store is not None else None)
+                        if source is not None]
+        self.store = store
+        self.faults = faults if faults is not None else Faults()
+        self.upstream = upstream.rstrip('/') if upstream else None
+        self.quota = quota
+        self.timeout = timeout
+        self.used = Counter()  # (key, record type) -> requests
+        self.counts = Counter()  # (record type, view, status) -> responses
+        self.latency = Counter()  # record type -> seconds spent answering
+        self.recorded = 0
+        self._pages = {}  # (query, view) -> entries of a search being recorded
+        self._lock = threading.Lock()
+        self.reset = int(time.time()) + 7*24*3600
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://{:s}:{:d}'.format(*self.httpd.server_address[:2])
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        # responses per record type, view and status, plus time spent and records recorded
+        with self._lock:
+            return {'requests': sum(self.counts.values()),
+                    'responses': [{'record_type': record_type, 'view': view, 'status': status, 'count': count}
+                                  for (record_type, view, status), count in sorted(self.counts.items(), key=str)],
+                    'seconds': dict(self.latency), 'recorded': self.recorded}
+
+    def route(self, path):
+        # (record type, identifier) of a request path
+        for prefix, record_type in ENDPOINTS.items():
+            if path.startswith(prefix):
+                rest = urllib.parse.unquote(path[len(prefix):])
+                if record_type == 'AbstractRetrieval':
+                    rest = rest.split('/', 1)[-1]  # drop the id type (eid, scopus_id, doi, ...)
+                return record_type, rest
+        return None, None
+
+    def handle(self, request):
+        start = time.monotonic()
+        url = urllib.parse.urlsplit(request.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/stand_in/stats':
+            return self.respond(request, 200, json.dumps(self.stats()).encode())
+        record_type, identifier = self.route(url.path)
+        if record_type is None:
+            return self.respond(request, 404, error_body(404))
+        view = params.get('view', '')
+        key = request.headers.get('X-ELS-APIKey', '')
+
+        delay = self.faults.delay()
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            self.used[(key, record_type)] += 1
+            over_quota = self.quota is not None and self.used[(key, record_type)] > self.quota
+        fault = 429 if over_quota else self.faults.draw(params.get('query', identifier))
+        headers = {}
+        if fault in (404, 429, 500):
+            status, body = fault, error_body(fault)
+        elif record_type == 'ScopusSearch':
+            status, body, headers = self.search(request, params)
+        else:
+            status, body, headers = self.retrieve(request, record_type, identifier, view)
+        if fault == 'malformed' and status == 200:
+            body = body[:len(body)//2]
+        with self._lock:
+            self.counts[(record_type, view, status)] += 1
+            self.latency[record_type] += time.monotonic() - start
+            remaining = max(0, self.quota - self.used[(key, record_type)]) if self.quota is not None else 9999
+        headers.setdefault('X-RateLimit-Limit', str(self.quota if self.quota is not None else 10000))
+        headers.setdefault('X-RateLimit-Remaining', str(remaining))
+        headers.setdefault('X-RateLimit-Reset', str(self.reset))
+        self.respond(request, status, body, headers)
+
+    def respond(self, request, status, body, headers=None):
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json;charset=UTF-8')
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def retrieve(self, request, record_type, identifier, view):
+        for source in self.sources:
+            data = source.get(record_type, identifier, view)
+            if data is not None:
+                return 200, data, {}
+            if getattr(source, 'not_found', None) is not None and source.not_found(record_type, identifier, view):
+                return 404, error_body(404), {}
+        if self.upstream is None:
+            return 404, error_body(404), {}
+        status, body, headers = self.forward(request)
+        if status == 200:
+            self.record(record_type, identifier, view, body)
+        elif status == 404:
+            self.record('NotFound', record_type + '/' + identifier, view, body)
+        return status, body, headers
+
+    def search(self, request, params):
+        query, view = params.get('query', ''), params.get('view', '')
+        entries = None
+        for source in self.sources:
+            entries = source.search(query, view)
+            if entries is not None:
+                break
+        if entries is None and self.upstream is not None:
+            status, body, headers = self.forward(request)
+            if status == 200:
+                self.record_page(query, view, json.loads(body))
+            return status, body, headers
+        entries = entries or []
+
+        # pages of `count` entries, with start= or cursor= (the next cursor is the start of the next page)
+        count = int(params.get('count', 25))
+        cursor = params.get('cursor')
+        first = int(params.get('start', 0)) if cursor is None else (0 if cursor == '*' else int(cursor))
+        page = entries[first:first + count]
+        results = {'opensearch:totalResults': str(len(entries)), 'opensearch:startIndex': str(first),
+                   'opensearch:itemsPerPage': str(len(page)),
+                   'entry': page if entries else [{'@_fa': 'true', 'error': 'Result set was empty'}]}
+        if cursor is not None:
+            results['cursor'] = {'@current': cursor, '@next': str(first + count)}
+        return 200, json.dumps({'search-results': results}).encode(), {}
+
+    def forward(self, request):
+        # the same request to the upstream API, with the caller's key; returns (status, body, rate limit headers)
+        headers = {name: request.headers[name] for name in ('X-ELS-APIKey', 'X-ELS-Insttoken', 'Accept', 'User-Agent')
+                   if request.headers.get(name) is not None}
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.upstream + request.path, headers=headers),
+                                        timeout=self.timeout) as response:
+                status, body, response_headers = response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            status, body, response_headers = e.code, e.read(), e.headers
+        return status, body, {name: response_headers[name] for name in
+                              ('X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset')
+                              if response_headers.get(name) is not None}
+
+    def record(self, record_type, identifier, view, data):
+        if self.store is None:
+            return
+        self.store.put(record_type, identifier, view, data)
+        with self._lock:
+            self.recorded += 1
+
+    def record_page(self, query, view, page):
+        # collect the pages of a search, the search is recorded once all of its entries came in
+        results = page.get('search-results', {})
+        total = int(results.get('opensearch:totalResults', 0))
+        entries = [entry for entry in results.get('entry', []) if 'error' not in entry]
+        with self._lock:
+            collected = self._pages.setdefault((query, view), [])
+            collected.extend(entries)
+            done = len(collected) >= total
+            if done:
+                del self._pages[(query, view)]
+        if done:
+            self.record('ScopusSearch', query, view, '\n'.join(json.dumps(entry) for entry in collected).encode())
+
+
+def error_body(status):
+    code, text = ERROR_TEXT.get(status, ('GENERAL_SYSTEM_ERROR', 'Error'))
+    return json.dumps({'service-error': {'status': {'statusCode': code, 'statusText': text}}}).encode()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve Scopus records locally (see scopus_tools/stand_in.py)')
+    parser.add_argument("--store", type=str, default='scopus_stand_in.db', help="RecordStore file with the records to serve (recordings are added to it)")
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many seconds added at random")
+    parser.add_argument("--errors", type=str, default='', help="probability of error responses, e.g. 404=0.01,500=0.005,429=0.001")
+    parser.add_argument("--malformed", type=float, default=0, help="probability of a response with invalid JSON")
+    parser.add_argument("--quota", type=int, default=None, help="requests per API key and API before 429 responses")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the injected faults")
+    parser.add_argument("--record", type=str, default=None, help="download missing records from this URL (e.g. https://api.elsevier.com) and add them to the store")
+    args = parser.parse_args()
+
+    from scopus_tools.record_store import RecordStore
+    server = StandInServer(store=RecordStore(args.store), upstream=args.record, host=args.host, port=args.port, quota=args.quota,
+                           faults=Faults(args.latency, args.jitter, parse_errors(args.errors), args.malformed, seed=args.seed))
+    print('Serving ' + args.store + ' at ' + server.url + ' (SCOPUS_STAND_IN=' + server.url + ')')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats(), indent=1))
@@ -11,8 +11,15 @@ from tqdm import tqdm
 import unidecode
 import numpy as np
 import argparse
+import os
 import matplotlib.pyplot as plt
 import seaborn as sns
+from concurrent.futures import ThreadPoolExecutor
+from scopus_tools.record_store import RecordStore
+from scopus_tools.key_scheduler import KeyScheduler, QuotaExhaustedError
+from scopus_tools.metrics import Metrics
+from scopus_tools.reference_cache import ReferenceAuthorCache
+from scopus_tools.self_citation_kernel import SelfCitationBatch
 
 numref = []
 refresh_rate = 30  # number of days until refreshing Scopus results
@@ -20,132 +27,274 @@ refresh_rate = 30  # number of days until refreshing Scopus results
 # add arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("--ID", type=int, help="Scopus ID of author")
+parser.add_argument("--ID_file", type=str, default=None, help="file with one Scopus author ID per line, to run for many authors at once instead of --ID")
+parser.add_argument("--summary", type=str, default='./results/batch_summary.csv', help="file for the combined results of all authors of --ID_file")
+parser.add_argument("--ref_cache", type=str, default='reference_authors.db', help="file where the author IDs of cited papers are kept for all authors and later runs, empty to keep them in memory only")
 parser.add_argument("--allow_initial", type=int, default=0, help="whether to allow for using 'Surname, Given name initial' if IDs are not found. NOT recommended if you expect to have a relatively common Surname + Initial combination", choices=[0, 1])
 parser.add_argument("--make_plots", type=int, default=1, help="whether to plot results, default will plot", choices=[0, 1])
+parser.add_argument("--store", type=str, default='scopus_records.db', help="file where downloaded Scopus records are stored")
+parser.add_argument("--key_state", type=str, default='key_quota.json', help="file where the remaining quota of each API key is kept between runs")
+parser.add_argument("--workers", type=int, default=1, help="number of references to download concurrently, default downloads one at a time")
+parser.add_argument("--incremental", type=int, default=0, help="whether to reuse the results of the last run and only process new articles and articles that failed before (use the same --allow_initial as that run)", choices=[0, 1])
 
 # parse arguments
 args = parser.parse_args()
-ID = args.ID
+if (args.ID is None) == (args.ID_file is None):
+    parser.error('give either --ID or --ID_file')
 allow_initial = (args.allow_initial==1)  # True if allowing initial
 make_plots = (args.make_plots==1)  # True if wanting to make plots
+incremental = (args.incremental==1)  # True if reusing the previous results
+workers = max(1, args.workers)
+metrics = Metrics()  # retrieval latency, store hits and errors, stage timings; saved with the results
+scheduler = KeyScheduler(state_path=args.key_state, metrics=metrics)  # spread downloads over all API keys in the pybliometrics config
+store = RecordStore(args.store, fetch=scheduler.fetch, metrics=metrics)
+reference_authors = ReferenceAuthorCache(args.ref_cache or None, refresh=refresh_rate)  # shared by all authors of a run
 
-# load author information and their documents
-auth = AuthorRetrieval(ID, refresh=refresh_rate)
-scopus_indexed_name = auth.indexed_name.replace(' ', ', ')
-all_docs = auth.get_documents()
-docs_df = pd.DataFrame(all_docs)
-docs_df = docs_df[['eid', 'title', 'author_count', 'author_names', 'coverDate', 'coverDisplayDate']]
-ndocs = len(docs_df)
-
-# initialize empty arrays
-auth_position = np.nan + np.zeros((ndocs, ))
-sc_count = np.nan + np.zeros((ndocs, ))
-sc_count_any = np.nan + np.zeros((ndocs, ))
-numref = np.nan + np.zeros((ndocs, ))
-missing_ref_count = np.nan + np.zeros((ndocs, ))
-
-# loop over documents
-for i, doc_eid in enumerate(tqdm(list(docs_df.eid))):
-    
+
+def fetch_reference(eid_to_download):
+    # author IDs of a reference paper, None if Scopus does not have them (each paper is read once for all authors)
+    return reference_authors.get(eid_to_download, download_reference_authors)
+
+
+def download_reference_authors(eid_to_download):
+    # download a reference paper and return its author IDs, None if Scopus does not have them
     try:  # try to read document based on Scopus EID
-        ab = AbstractRetrieval(doc_eid, refresh=refresh_rate, view="FULL")
-        
-    except pybliometrics.scopus.exception.Scopus404Error:  # if Scopus failure (not available), skip this
-        ab = []
-        continue
-    
-    # get author IDs
-    author_IDs = np.array([author_entry.auid for author_entry in ab.authors if author_entry.auid is not None])
-    author_indexed_names = [author_entry.indexed_name.replace(' ', ', ') for author_entry in ab.authors if author_entry.indexed_name is not None]
-
-    if ID in author_IDs:  # find author position of given author (e.g., first author)
-        auth_position[i] = np.where(ID==author_IDs)[0][0] + 1
-
-    try:  # get reference paper Scopus EIDs
-        ref_EID = ['2-s2.0-' + ref_entry.id for ref_entry in ab.references if ref_entry.id is not None]
-    except TypeError:  # if no references available, skip
-        continue
-
-    numref[i] = len(ab.references)
-    sc_doc = 0  # number of self-citations for a given document
-    sc_doc_any = 0
-    missing_ref = 0  # number of references missing info for a given document
-    for ref_idx, eid_to_download in enumerate(ref_EID):  # download reference papeers
+        ref_ab = store.retrieve(AbstractRetrieval, eid_to_download, refresh=refresh_rate, view="FULL")
+    except pybliometrics.scopus.exception.Scopus404Error:
+        return None
+
+    try:  # try to read reference author IDs
+        return np.array([author_entry.auid for author_entry in ref_ab.authors if author_entry.auid is not None])
+    except TypeError:  # no reference author IDs available
+        return None
+
+
+def fetch_references(ref_EID):
+    # at most `workers` downloads are in flight, results come back in the same order as ref_EID
+    if workers > 1:
+        return executor.map(fetch_reference, ref_EID)
+    return map(fetch_reference, ref_EID)
+
+
+def fetch_reference_author_IDs(doc_eid, ref_EID):
+    # author IDs for each reference of a document (None if missing)
+    # most come from a single REF view download, only references without author IDs there are downloaded in FULL view
+    try:
+        ab_ref = store.retrieve(AbstractRetrieval, doc_eid, refresh=refresh_rate, view="REF")
+        ref_view_auids = {ref_entry.id: ref_entry.authors_auid for ref_entry in ab_ref.references or []}
+    except pybliometrics.scopus.exception.Scopus404Error:
+        ref_view_auids = {}
+
+    ref_auth_IDs = [None]*len(ref_EID)
+    missing_idx = []
+    for ref_idx, eid in enumerate(ref_EID):
+        authors_auid = ref_view_auids.get(eid.replace('2-s2.0-', ''))
+        if authors_auid is not None:
+            ref_auth_IDs[ref_idx] = np.array([int(auid) for auid in authors_auid.split(';')])
+        else:
+            missing_idx.append(ref_idx)
+
+    for ref_idx, ref_auth_IDs_entry in zip(missing_idx, fetch_references([ref_EID[idx] for idx in missing_idx])):
+        ref_auth_IDs[ref_idx] = ref_auth_IDs_entry
+    return ref_auth_IDs
+
+def previous_results(results_file):
+    # rows of an earlier run by EID, only for articles that were processed completely (no missing counts)
+    if not os.path.exists(results_file):
+        return {}
+    previous_df = pd.read_csv(results_file, index_col=0)
+    previous_df = previous_df.dropna(subset=['numref', 'sc_count', 'sc_count_any', 'missing_ref_count'])
+    return {row['eid']: row for _, row in previous_df.iterrows()}
+
+
+def run_author(ID):
+    # compute, save and plot the self-citations of one author, returns their overall numbers
+    # load author information and their documents
+    auth = store.retrieve(AuthorRetrieval, ID, refresh=refresh_rate)
+    scopus_indexed_name = auth.indexed_name.replace(' ', ', ')
+    results_file = './results/results_df_' + scopus_indexed_name + '.csv'
+    with metrics.stage('author document search'):
+        if incremental:  # the document list is cached by pybliometrics, so update it to find new articles
+            all_docs = auth.get_documents(refresh=True)
+        else:
+            all_docs = auth.get_documents()
+    docs_df = pd.DataFrame(all_docs)
+    docs_df = docs_df[['eid', 'title', 'author_count', 'author_names', 'coverDate', 'coverDisplayDate']]
+    ndocs = len(docs_df)
+    reused = previous_results(results_file) if incremental else {}  # EID -> previous row, these are not processed again
+
+    # initialize empty arrays
+    auth_position = np.nan + np.zeros((ndocs, ))
+    sc_count = np.nan + np.zeros((ndocs, ))
+    sc_count_any = np.nan + np.zeros((ndocs, ))
+    numref = np.nan + np.zeros((ndocs, ))
+    missing_ref_count = np.nan + np.zeros((ndocs, ))
+
+    if incremental:
+        for i, doc_eid in enumerate(docs_df.eid):
+            if doc_eid in reused:
+                auth_position[i] = reused[doc_eid]['auth_position']
+                sc_count[i] = reused[doc_eid]['sc_count']
+                sc_count_any[i] = reused[doc_eid]['sc_count_any']
+                numref[i] = reused[doc_eid]['numref']
+                missing_ref_count[i] = reused[doc_eid]['missing_ref_count']
+        nreused = sum(doc_eid in reused for doc_eid in docs_df.eid)
+        print('Incremental update: reusing {:d} of {:d} articles from {:s}, processing {:d}'.format(
+            nreused, ndocs, results_file, ndocs - nreused))
+
+    ref_stats_start = reference_authors.stats()
+
+    # loop over documents: collect the author IDs of each document and of its references
+    docs = []  # (document index, record, author IDs, author names, author IDs of each reference, slice of its references)
+    own = SelfCitationBatch()  # the author of interest citing their own papers
+    anyone = SelfCitationBatch()  # any author of the document citing their own papers
+    for i, doc_eid in enumerate(tqdm(list(docs_df.eid))):
+        if doc_eid in reused:  # done in an earlier run
+            continue
+
         try:  # try to read document based on Scopus EID
-            ref_ab = AbstractRetrieval(eid_to_download, refresh=refresh_rate, view="FULL")
-        except pybliometrics.scopus.exception.Scopus404Error:  # if we cannot find article, count as a missing reference
+            ab = store.retrieve(AbstractRetrieval, doc_eid, refresh=refresh_rate, view="FULL")
+
+        except pybliometrics.scopus.exception.Scopus404Error:  # if Scopus failure (not available), skip this
+            ab = []
+            continue
+
+        # get author IDs
+        author_IDs = np.array([author_entry.auid for author_entry in ab.authors if author_entry.auid is not None])
+        author_indexed_names = [author_entry.indexed_name.replace(' ', ', ') for author_entry in ab.authors if author_entry.indexed_name is not None]
+
+        if ID in author_IDs:  # find author position of given author (e.g., first author)
+            auth_position[i] = np.where(ID==author_IDs)[0][0] + 1
+
+        try:  # get reference paper Scopus EIDs
+            ref_EID = ['2-s2.0-' + ref_entry.id for ref_entry in ab.references if ref_entry.id is not None]
+        except TypeError:  # if no references available, skip
+            continue
 
-            if allow_initial==False:  # if not allowing initial, then consider reference missing
-              missing_ref+=1
-            else: # if allowing to use initials, then use "Given Name, Initial" to determine self-citation
-              if scopus_indexed_name in ab.references[ref_idx].authors:  
-                sc_doc +=1
+        numref[i] = len(ab.references)
+        with metrics.stage('reference authors (with downloads)'):
+            all_ref_auth_IDs = fetch_reference_author_IDs(doc_eid, ref_EID)
+        own.add([ID], all_ref_auth_IDs)
+        docs.append((i, ab, author_IDs, author_indexed_names, all_ref_auth_IDs, anyone.add(author_IDs, all_ref_auth_IDs)))
 
-              if any([indexed_name_tmp in ab.references[ref_idx].authors for indexed_name_tmp in author_indexed_names]):
-                sc_doc_any +=1
-            
-            continue  # skip loop if no abstract available for download
+    # self-citations of all references at once (scopus_tools/self_citation_kernel.py), then count them per document
+    with metrics.stage('self-citations'):
+        sc_own = own.compute()['sc_fa'] == 1
+        sc_anyone = anyone.compute()['sc_any'] > 0
+    for i, ab, author_IDs, author_indexed_names, all_ref_auth_IDs, refs in docs:
+        sc_doc = 0  # number of self-citations for a given document
+        sc_doc_any = 0
+        missing_ref = 0  # number of references missing info for a given document
+        sc_own_doc, sc_anyone_doc = sc_own[refs], sc_anyone[refs]
+        for ref_idx, ref_auth_IDs in enumerate(all_ref_auth_IDs):
+            if ref_auth_IDs is None:  # if we cannot find article or its author IDs, count as a missing reference
 
-        try:  # try to read reference author IDs
-            ref_auth_IDs = np.array([author_entry.auid for author_entry in ref_ab.authors if author_entry.auid is not None])
+                if allow_initial==False:  # if not allowing initial, then consider reference missing
+                  missing_ref+=1
+                else: # if allowing to use initials, then use "Given Name, Initial" to determine self-citation
+                  if scopus_indexed_name in ab.references[ref_idx].authors:  
+                    sc_doc +=1
+
+                  if any([indexed_name_tmp in ab.references[ref_idx].authors for indexed_name_tmp in author_indexed_names]):
+                    sc_doc_any +=1
+
+                continue  # skip loop if no author information available
 
             if len(ref_auth_IDs)>=1:  # make sure some authors were found
-                if ID in ref_auth_IDs:
+                if sc_own_doc[ref_idx]:  # ID in ref_auth_IDs
                     sc_doc+=1
 
-                if any([id_tmp in ref_auth_IDs for id_tmp in author_IDs]):
+                if sc_anyone_doc[ref_idx]:  # any author of the document in ref_auth_IDs
                     sc_doc_any+=1
 
-        except TypeError:  # if no reference author IDs available, count as a missing reference
+            missing_ref_count[i] = missing_ref
+            sc_count[i] = sc_doc
+            sc_count_any[i] = sc_doc_any
 
-            if allow_initial==False:  # if not allowing initial, then consider reference missing
-              missing_ref+=1
-            else: # if allowing to use initials, then use "Given Name, Initial" to determine self-citation
-              if scopus_indexed_name in ab.references[ref_idx].authors:  
-                sc_doc +=1
+    # Save results
+    docs_df['Year'] = [int(date[:4]) for date in docs_df.coverDate]
+    docs_df['auth_position'] = auth_position
+    docs_df['sc_count'] = sc_count
+    docs_df['sc_count_any'] = sc_count_any
+    docs_df['numref'] = numref
+    docs_df['missing_ref_count'] = missing_ref_count
+    docs_df['sc_rate'] = docs_df['sc_count'] / docs_df['numref']
+    docs_df['sc_rate_any'] = docs_df['sc_count_any'] / docs_df['numref']
+    with metrics.stage('write results'):
+        docs_df.to_csv(results_file)
+    reference_authors.flush()
+    print('Overall self-citation rate: {:.4f}'.format( np.nansum(docs_df.sc_count) / np.nansum(docs_df.numref)) )
 
-              if any([indexed_name_tmp in ab.references[ref_idx].authors for indexed_name_tmp in author_indexed_names]):
-                sc_doc_any +=1
-            continue
-        
-        missing_ref_count[i] = missing_ref
-        sc_count[i] = sc_doc
-        sc_count_any[i] = sc_doc_any
-       
-
-# Save results
-docs_df['Year'] = [int(date[:4]) for date in docs_df.coverDate]
-docs_df['auth_position'] = auth_position
-docs_df['sc_count'] = sc_count
-docs_df['sc_count_any'] = sc_count_any
-docs_df['numref'] = numref
-docs_df['missing_ref_count'] = missing_ref_count
-docs_df['sc_rate'] = docs_df['sc_count'] / docs_df['numref']
-docs_df['sc_rate_any'] = docs_df['sc_count_any'] / docs_df['numref']
-docs_df.to_csv('./results/results_df_' + scopus_indexed_name + '.csv')
-print('Overall self-citation rate: {:.4f}'.format( np.nansum(docs_df.sc_count) / np.nansum(docs_df.numref)) )
-
-if make_plots:
-    fig, ax = plt.subplots(figsize=(8, 5))
-    sns.histplot(x='sc_rate', data=docs_df, color='#1b9e77', ax=ax)
-    ax.set_xlabel('Author-Author self-citation rate')
-    ax.set_ylabel('Count')
-    fig.savefig('./results/' + scopus_indexed_name + '_single_author_hist.png', format="png", transparent=True, dpi=400, bbox_inches='tight')
-
-    fig, ax = plt.subplots(figsize=(8, 5))
-    sns.histplot(x='sc_rate_any', data=docs_df, color='#d95f02', ax=ax)
-    ax.set_xlabel('Any Author self-citation rate')
-    ax.set_ylabel('Count')
-    fig.savefig('./results/' + scopus_indexed_name + '_any_author_hist.png', format="png", transparent=True, dpi=400, bbox_inches='tight')
-
-
-    fig, ax = plt.subplots(figsize=(8, 5))
-    df_by_year = docs_df.groupby(['Year']).agg({'sc_count':'sum', 'numref':'sum'})
-    df_by_year['sc_rate'] = df_by_year['sc_count'] / df_by_year['numref']
-    ax.set_xlabel('Year')
-    ax.set_ylabel('Author-Author self-citation rate')
-    sns.scatterplot(data=df_by_year, x='Year', y='sc_rate', color='#1b9e77', ax=ax)
-    fig.savefig('./results/' + scopus_indexed_name + '_single_author_time.png', format="png", transparent=True, dpi=400, bbox_inches='tight')
+    if make_plots:
+        fig, ax = plt.subplots(figsize=(8, 5))
+        sns.histplot(x='sc_rate', data=docs_df, color='#1b9e77', ax=ax)
+        ax.set_xlabel('Author-Author self-citation rate')
+        ax.set_ylabel('Count')
+        fig.savefig('./results/' + scopus_indexed_name + '_single_author_hist.png', format="png", transparent=True, dpi=400, bbox_inches='tight')
+
+        fig, ax = plt.subplots(figsize=(8, 5))
+        sns.histplot(x='sc_rate_any', data=docs_df, color='#d95f02', ax=ax)
+        ax.set_xlabel('Any Author self-citation rate')
+        ax.set_ylabel('Count')
+        fig.savefig('./results/' + scopus_indexed_name + '_any_author_hist.png', format="png", transparent=True, dpi=400, bbox_inches='tight')
+
+
+        fig, ax = plt.subplots(figsize=(8, 5))
+        df_by_year = docs_df.groupby(['Year']).agg({'sc_count':'sum', 'numref':'sum'})
+        df_by_year['sc_rate'] = df_by_year['sc_count'] / df_by_year['numref']
+        ax.set_xlabel('Year')
+        ax.set_ylabel('Author-Author self-citation rate')
+        sns.scatterplot(data=df_by_year, x='Year', y='sc_rate', color='#1b9e77', ax=ax)
+        fig.savefig('./results/' + scopus_indexed_name + '_single_author_time.png', format="png", transparent=True, dpi=400, bbox_inches='tight')
+        plt.close('all')
+
+    metrics.write('./results/metrics_' + scopus_indexed_name, labels={'script': 'self_citation_author', 'author': ID})
+    store_counts = metrics.summary()['store'].values()  # records read from the store (e.g. shared with other authors) or downloaded
+    metrics.reset()
+
+    ref_stats = reference_authors.stats()
+    return {'ID': ID, 'name': scopus_indexed_name, 'ndocs': ndocs,
+            'sc_count': np.nansum(docs_df.sc_count), 'sc_count_any': np.nansum(docs_df.sc_count_any),
+            'numref': np.nansum(docs_df.numref), 'missing_ref_count': np.nansum(docs_df.missing_ref_count),
+            'sc_rate': np.nansum(docs_df.sc_count) / np.nansum(docs_df.numref),
+            'sc_rate_any': np.nansum(docs_df.sc_count_any) / np.nansum(docs_df.numref),
+            'records_reused': sum(counts['hit'] for counts in store_counts),
+            'records_downloaded': sum(counts['miss'] + counts['refresh'] for counts in store_counts),
+            'ref_lookups': ref_stats['lookups'] - ref_stats_start['lookups'],
+            'ref_reused': (ref_stats['reused_memory'] + ref_stats['reused_disk']) -
+                          (ref_stats_start['reused_memory'] + ref_stats_start['reused_disk'])}
 
+def read_author_IDs(ID_file):
+    # one Scopus author ID per line (blank lines and lines starting with # are skipped), each ID once
+    with open(ID_file) as f:
+        IDs = [int(line.strip().split(',')[0]) for line in f if line.strip() and not line.strip().startswith('#')]
+    return list(dict.fromkeys(IDs))
 
 
+executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+if args.ID_file is None:
+    run_author(args.ID)
+else:
+    author_IDs_batch = read_author_IDs(args.ID_file)
+    summary = []
+    for author_idx, ID in enumerate(author_IDs_batch):
+        print('Author {:d} of {:d}: {:d}'.format(author_idx + 1, len(author_IDs_batch), ID))
+        try:
+            summary.append({**run_author(ID), 'error': None})
+        except QuotaExhaustedError:
+            raise
+        except Exception as e:  # e.g. unknown author ID, keep going with the others
+            print('Failed for author {:d}: {:s}'.format(ID, repr(e)))
+            summary.append({'ID': ID, 'error': repr(e)})
+        pd.DataFrame(summary).to_csv(args.summary, index=False)  # rewritten after each author, so a stopped run keeps its summary
+    ref_stats = reference_authors.stats()
+    print('Done: {:d} authors ({:d} failed), summary saved to {:s}'.format(
+        len(summary), sum(entry['error'] is not None for entry in summary), args.summary))
+    print('Records: {:d} read from the record store, {:d} downloaded'.format(
+        int(sum(entry.get('records_reused', 0) for entry in summary)), int(sum(entry.get('records_downloaded', 0) for entry in summary))))
+    print('Reference author lists: {:d} lookups, {:d} reused from other authors or articles in this run, {:d} from earlier runs, '
+          '{:d} read from the record store or downloaded'.format(ref_stats['lookups'], ref_stats['reused_memory'],
+                                                                 ref_stats['reused_disk'], ref_stats['computed']))
+if executor is not None:
+    executor.shutdown()
+reference_authors.close()